@@ -374,7 +374,7 @@ class Bank(SimulationObject):
         @param tBank:
         @param amount:
         """
-        self.simInfo.loanNetwork.add_edge(self, tBank, amount=amount)
+        network.set_loan(self.simInfo, self, tBank, amount)
         tBank.record_borrowing_history(self, amount)
         logger.debug("%r.  Added loan of %f from %s to %s" % (self.simInfo.updateCount, amount, self, tBank))
         if self.followMe:
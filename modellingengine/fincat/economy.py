@@ -251,5 +251,7 @@ class Investment(SimulationObject):
             self.holdingHistory[holder] = [(when, amount)]
 
     def set_price(self, newPrice):
+        oldPrice = self.currentPrice
         self.currentPrice = newPrice
+        network.revalue_holdings(self.simInfo, self, oldPrice)
         self.record_price_history(newPrice)
@@ -4,10 +4,13 @@ import logging
 
 import networkx as nx
 
-from utils import ProportionError
+from utils import ProportionError, ConsistencyError
 
 logger = logging.getLogger("fc." + __name__)
 
+# how far a bank's running total may drift from the networks (relative to the total) before it's an error
+TOTAL_TOLERANCE = 1e-9
+
 
 def clear_networks(simInfo):
     """Initialise the graphs to empty graphs
@@ -16,6 +19,7 @@ def clear_networks(simInfo):
     """
     simInfo.loanNetwork = nx.DiGraph()
     simInfo.assetNetwork = nx.Graph()
+    simInfo.clear_totals()
 
 
 def reset_networks(simInfo):
@@ -56,6 +60,7 @@ def do_loan_changes(simInfo, bank, prop, isDefault):
     if bank.followMe:
         bank.logger.debug("%r. Doing loan %s (%f)" % (simInfo.updateCount, opString, prop))
     lenders = simInfo.loanNetwork.predecessors(bank)
+    totalBorrowing = 0
     for counterparty in lenders:
         amt = simInfo.loanNetwork[counterparty][bank]['amount']
         if isDefault:
@@ -67,10 +72,13 @@ def do_loan_changes(simInfo, bank, prop, isDefault):
             newAmount = amt - proceeds
 
         if newAmount == 0.0:
-            simInfo.loanNetwork.remove_edge(counterparty, bank)
+            remove_loan(simInfo, counterparty, bank)
         else:
-            simInfo.loanNetwork[counterparty][bank]['amount'] = newAmount
+            set_loan(simInfo, counterparty, bank, newAmount)
+            totalBorrowing += newAmount
         bank.record_borrowing_history(counterparty, newAmount)
+    # every one of the bank's borrowings has changed, so its total is worked out afresh rather than adjusted
+    simInfo.borrowingTotals[bank] = totalBorrowing
     return lenders
 
 
@@ -98,6 +106,71 @@ def do_default_loans(simInfo, bank, prop):
     return do_loan_changes(simInfo, bank, prop, True)
 
 
+def set_loan(simInfo, lender, borrower, amount):
+    """Set the amount lent by one bank to another, adding the loan if it doesn't exist
+
+    The lender's lending total and the borrower's borrowing total are adjusted to match.
+    @param lender:
+    @param borrower:
+    @param amount:
+    """
+    if simInfo.loanNetwork.has_edge(lender, borrower):
+        change = amount - simInfo.loanNetwork[lender][borrower]['amount']
+    else:
+        change = amount
+    simInfo.loanNetwork.add_edge(lender, borrower, amount=amount)
+    simInfo.lendingTotals[lender] = simInfo.lendingTotals.get(lender, 0) + change
+    simInfo.borrowingTotals[borrower] = simInfo.borrowingTotals.get(borrower, 0) + change
+
+
+def remove_loan(simInfo, lender, borrower):
+    """Remove the loan from one bank to another
+
+    A bank left with no loans has its total set to zero, so that no rounding errors linger.
+    @param lender:
+    @param borrower:
+    """
+    amount = simInfo.loanNetwork[lender][borrower]['amount']
+    simInfo.loanNetwork.remove_edge(lender, borrower)
+    if simInfo.loanNetwork.out_degree(lender):
+        simInfo.lendingTotals[lender] -= amount
+    else:
+        simInfo.lendingTotals[lender] = 0
+    if simInfo.loanNetwork.in_degree(borrower):
+        simInfo.borrowingTotals[borrower] -= amount
+    else:
+        simInfo.borrowingTotals[borrower] = 0
+
+
+def check_total(simInfo, bank, description, total, fromNetwork):
+    """Make sure a bank's running total matches the value worked out from the networks
+
+    Only done if simInfo.checkTotals is set.
+    @param description: what the total is, for the error message
+    @param total: the running total
+    @param fromNetwork: a function giving the total from the networks
+    @raise: ConsistencyError
+    """
+    if simInfo.checkTotals:
+        expected = fromNetwork()
+        if abs(total - expected) > TOTAL_TOLERANCE * max(1.0, abs(expected)):
+            msg = "%r. %s of %s is %r but should be %r" % (simInfo.updateCount, description, bank, total, expected)
+            logger.error(msg)
+            raise ConsistencyError(msg)
+
+
+def rebuild_totals(simInfo):
+    """Work out every bank's lending, borrowing and portfolio totals afresh from the networks
+
+    Only needed if the networks have been changed other than through the functions here.
+    """
+    simInfo.clear_totals()
+    for bank in simInfo.bankDirectory.values():
+        simInfo.lendingTotals[bank] = simInfo.loanNetwork.out_degree(bank, weight='amount')
+        simInfo.borrowingTotals[bank] = simInfo.loanNetwork.in_degree(bank, weight='amount')
+        simInfo.portfolioValues[bank] = network_portfolio_value(simInfo, bank)
+
+
 def bank_lending(simInfo, bank, other=None):
     """Get the bank lending from the specified bank to another bank or in total
 
@@ -107,7 +180,9 @@ def bank_lending(simInfo, bank, other=None):
     """
     # out edges from the bank
     if other is None:
-        ans = simInfo.loanNetwork.out_degree(bank, weight='amount')
+        ans = simInfo.lendingTotals.get(bank, 0)
+        check_total(simInfo, bank, "Total lending", ans,
+                    lambda: simInfo.loanNetwork.out_degree(bank, weight='amount'))
         if bank.followMe:
             bank.logger.debug("       Total lending is: %f" % ans)
     elif other in simInfo.loanNetwork.successors(bank):
@@ -128,7 +203,9 @@ def bank_borrowing(simInfo, bank, other=None):
     @return:
     """
     if other is None:
-        ans = simInfo.loanNetwork.in_degree(bank, weight='amount')
+        ans = simInfo.borrowingTotals.get(bank, 0)
+        check_total(simInfo, bank, "Total borrowing", ans,
+                    lambda: simInfo.loanNetwork.in_degree(bank, weight='amount'))
         if bank.followMe:
             bank.logger.debug("       Total borrowing is: %f" % ans)
     elif other in simInfo.loanNetwork.predecessors(bank):
@@ -158,22 +235,51 @@ def get_asset_holding(simInfo, investment, bank):
 def set_asset_holding(simInfo, investment, bank, quantity):
     """Set the quantity of an investment held by a bank
 
-    if the quantity is zero, remove the edge if it exists
+    if the quantity is zero, remove the edge if it exists.
+    The bank's portfolio value is adjusted to match.
     @param investment:
     @param bank:
     @param quantity:
     """
+    current = get_asset_holding(simInfo, investment, bank)
     if quantity > 0.0:
         # updates if the edge already exists
         simInfo.assetNetwork.add_edge(investment, bank, amount=quantity)
+        change = float(quantity) - current
     elif simInfo.assetNetwork.has_edge(investment, bank):
         simInfo.assetNetwork.remove_edge(investment, bank)
+        change = -current
+    else:
+        return
+    if simInfo.assetNetwork.degree(bank):
+        simInfo.portfolioValues[bank] = simInfo.portfolioValues.get(bank, 0) + change * investment.currentPrice
+    else:
+        # no holdings left, so no rounding errors either
+        simInfo.portfolioValues[bank] = 0
 
 
 def get_asset_volume(simInfo, investment):
     return simInfo.assetNetwork.degree(investment, weight='amount')
 
 
+def revalue_holdings(simInfo, investment, oldPrice):
+    """Adjust the portfolio values of all the holders of an investment whose price has changed
+
+    @param investment:
+    @param oldPrice: the price before the change
+    """
+    change = investment.currentPrice - oldPrice
+    if change:
+        for holder, eData in simInfo.assetNetwork.adj.get(investment, {}).iteritems():
+            simInfo.portfolioValues[holder] += float(eData['amount']) * change
+
+
 def get_portfolio_value(simInfo, bank):
+    ans = simInfo.portfolioValues.get(bank, 0)
+    check_total(simInfo, bank, "Portfolio value", ans, lambda: network_portfolio_value(simInfo, bank))
+    return ans
+
+
+def network_portfolio_value(simInfo, bank):
     # this relies on G.edges(node) always returning edges as (node, other) tuples.
     return sum([inv.currentPrice * float(eData['amount']) for bank, inv, eData in simInfo.assetNetwork.edges(bank, data=True)])
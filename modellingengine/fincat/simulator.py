@@ -128,6 +128,7 @@ def do_simulator_parameters(simInfo, pList, parameterDefs):
     simInfo.theParameters.get_params_from_pList(simParams)
     logLevel = simInfo.theParameters.get("logLevel", default="info")
     simInfo.followBank = simInfo.theParameters.get("followBank")
+    simInfo.checkTotals = simInfo.theParameters.get("checkTotals", default=False)
     logDir = simInfo.theParameters.get("logDirectory", default="logs/")
     setup_logging(logLevel, logDir, simInfo)
     logger.info('Setting up run %s' % simInfo.runDesc + simInfo.tString)
@@ -355,6 +356,7 @@ def define_parameters():
     runCount                 simulator  number of simulations to perform
     outputFreq               simulator  how often to write output files (every x updates)
     balanceSheetMethod       simulator  how to initialise the balance sheet (ear or cr)
+    checkTotals              simulator  check the banks' running totals against the networks whenever they're used
     fireSaleFactor           economy    decreases investment prices on sale
     investmentCount          economy    number of investments in economy at outset
     investmentShockFactor    economy    change in investment values as a shock event at the outset
@@ -392,6 +394,7 @@ def define_parameters():
     parameterDefs.add_definition('randomSeed', int)  # can be any hashable object, but need int for x-platform consistency
     parameterDefs.add_definition('followBank', str)
     parameterDefs.add_definition('balanceSheetMethod', str, pValid=["assets", "liabilities", "None"])
+    parameterDefs.add_definition('checkTotals', 'bool')
     parameterDefs.add_definition('fireSaleFactor', float, pValid=[0, 9999])
     parameterDefs.add_definition('investmentCount', int, pValid=[0, 9999])
     parameterDefs.add_definition('investmentShockFactor', float, pValid=[0, 1])
@@ -2,7 +2,8 @@ __author__ = 'Louise'
 
 from nose.tools import eq_, raises
 from utils import approx_equal, setup_banks1
-from FinCat.utils import ProportionError, UniqueError
+from FinCat.utils import ProportionError, UniqueError, ConsistencyError
+import FinCat.network as network
 from FinCat.bank import Bank
 
 
@@ -242,4 +243,43 @@ class TestBank:
         lastWhen = thisBank.stateHistory[-1][0]
         eq_(lastWhen, 7, "expected last item to be at count 7 but was %r" % lastWhen)
 
+    def test_totals(self):
+        # every change goes through the networks, so the running totals should always match them
+        self.simInfo.checkTotals = True
+        self.econ.params.set('fireSaleFactor', 1.0)
 
+        self.simInfo.updateCount = 1
+        self.banks[4].reduce_investments(0.5)   # sales push the prices of inv2 and inv3 down for banks 1-3 too
+        self.econ.revalue_investments(0.5)
+        network.do_loan_maturities(self.simInfo, self.banks[0], 0.25)
+        self.banks[1].add_loan(self.banks[0], amount=25)   # replaces the loan of 7.5 left after maturities
+        self.banks[2].add_loan(self.banks[3], amount=5)
+        network.do_default_loans(self.simInfo, self.banks[3], 0.0)
+        for b in self.banks:
+            b.record_state()   # uses all the totals, checking each one
+
+        lending = self.banks[1].total_lending()
+        assert approx_equal(25, lending, 0.0000001), "expected bank 1 to lend 25 but lends %r" % lending
+        borrowing = self.banks[0].total_borrowing()
+        assert approx_equal(92.5, borrowing, 0.0000001), "expected bank 0 to borrow 92.5 but borrows %r" % borrowing
+        eq_(0, self.banks[3].total_borrowing(), "expected bank 3 to have no borrowing after defaulting")
+        iVal = self.banks[4].investment_value()
+        inv2, inv3 = self.econ.investments[1:]
+        expected = 20 * inv2.currentPrice + 20 * inv3.currentPrice
+        assert approx_equal(expected, iVal, 0.0000001), "expected bank 4 investments of %r but has %r" % (expected, iVal)
+
+    @raises(ConsistencyError)
+    def test_totals_wrong(self):
+        self.simInfo.checkTotals = True
+        # changing the network directly leaves the totals behind
+        self.simInfo.loanNetwork[self.banks[1]][self.banks[0]]['amount'] = 15
+        self.banks[0].total_borrowing()
+
+    def test_rebuild_totals(self):
+        self.simInfo.loanNetwork[self.banks[1]][self.banks[0]]['amount'] = 15
+        self.simInfo.assetNetwork[self.econ.investments[0]][self.banks[0]]['amount'] = 40
+        network.rebuild_totals(self.simInfo)
+        self.simInfo.checkTotals = True
+        eq_(105, self.banks[0].total_borrowing(), "expected bank 0 to borrow 105 after rebuilding the totals")
+        eq_(40, self.banks[0].investment_value(), "expected bank 0 to have investments of 40 after rebuilding the totals")
+        eq_(-15, self.banks[0].equity_value(), "expected bank 0 to have capital of -15 after rebuilding the totals")
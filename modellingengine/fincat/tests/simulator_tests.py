@@ -36,7 +36,7 @@ class TestUpdate:
         for i in range(4):
             # a chain of banks
             loanAmount = 5 * (i + 1)
-            self.simInfo.loanNetwork.add_edge(self.banks[i + 1], self.banks[i], amount=loanAmount)
+            self.banks[i + 1].add_loan(self.banks[i], amount=loanAmount)
             self.banks[i].cash = 6
         self.banks[0].deposits = 2
         self.banks[4].deposits = 19
@@ -33,6 +33,11 @@ class SimulationInfo(object):
         self.assetNetwork = nx.Graph()
         self.lastId = 0
 
+        # running totals for each bank, kept up to date as the networks change (see network.py)
+        self.clear_totals()
+        # if set, every total is checked against the networks whenever it's used
+        self.checkTotals = False
+
     def __repr__(self):
         return "<SimulationInfo %r: %s>" % (self.runDesc, self.updateCount)
 
@@ -48,6 +53,17 @@ class SimulationInfo(object):
         self.bankDirectory.clear()
         self.loanNetwork = nx.DiGraph()
         self.assetNetwork = nx.Graph()
+        self.clear_totals()
+        self.checkTotals = False
+
+    def clear_totals(self):
+        """Forget the banks' lending, borrowing and portfolio totals
+
+        Needed whenever the networks are replaced.
+        """
+        self.lendingTotals = {}
+        self.borrowingTotals = {}
+        self.portfolioValues = {}
 
     def get_banks(self):
         """ Get a list of banks, always in the same order
@@ -104,6 +120,11 @@ class UniqueError(Exception):
     """
 
 
+class ConsistencyError(Exception):
+    """Exception raised when a bank's running total doesn't match the networks
+    """
+
+
 BankHistory = namedtuple('BankHistory', 'balanceSheets borrowings defaults')
 InvestmentHistory = namedtuple('InvestmentHistory', 'holdings prices')
 HoldingRecord = namedtuple('HoldingRecord', 'when investmentId bankId amount')
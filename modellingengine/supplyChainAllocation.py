@@ -0,0 +1,67 @@
+#!/usr/bin/python
+
+'''
+Allocation of stock to outstanding orders.
+
+allocate shares out the stock of many sellers at once. The orders of all
+the sellers are laid end to end in one array, oldest first within each
+seller, with starts marking where each seller's orders begin, as in a
+row-compressed matrix:
+
+    supply = [5, 4]
+    starts = [0, 2, 3]          # seller 0 has orders 0 and 1, seller 1 order 2
+    quantities = [4, 3, 6]
+    allocate(supply, starts, quantities, 'fifo')     # -> [4, 1, 4]
+    allocate(supply, starts, quantities, 'prorata')  # -> [3, 2, 4]
+
+Policies:
+    fifo      the oldest orders are filled first, in full where possible
+    prorata   every order gets the same fraction of what it asked for,
+              rounded down, with the units left over by rounding going one
+              apiece to the oldest orders that were rounded down
+Either way a seller with enough stock fills every order, and no seller
+ships more than it holds. All quantities are whole units.
+'''
+
+import numpy as np
+
+
+POLICIES = ('fifo', 'prorata')
+
+
+# Check that /policy/ is one of POLICIES.
+def checkPolicy(policy):
+    if not policy in POLICIES:
+        raise ValueError('Allocation policy must be one of %s, not %r' % (', '.join(POLICIES), policy))
+    return policy
+
+# Units of each order filled from the /supply/ of each seller. Seller i's
+# orders are quantities[starts[i]:starts[i+1]], oldest first.
+def allocate(supply, starts, quantities, policy='fifo'):
+    checkPolicy(policy)
+    supply = np.asarray(supply, dtype=np.int64)
+    starts = np.asarray(starts, dtype=np.int64)
+    quantities = np.asarray(quantities, dtype=np.int64)
+    if len(starts) != len(supply) + 1 or starts[-1] != len(quantities):
+        raise ValueError('starts should run from 0 to the number of orders, one more entry than supply')
+    if not len(quantities):
+        return np.zeros(0, dtype=np.int64)
+    seller = np.repeat(np.arange(len(supply)), np.diff(starts))
+    cumulative = np.zeros(len(quantities) + 1, dtype=np.int64)
+    np.cumsum(quantities, out=cumulative[1:])
+    if policy == 'fifo':
+        # Units ordered ahead of each order, by the same seller.
+        ahead = cumulative[:-1] - cumulative[starts[:-1]][seller]
+        return np.clip(supply[seller] - ahead, 0, quantities)
+    total = cumulative[starts[1:]] - cumulative[starts[:-1]]
+    available = np.minimum(supply, total)
+    shares = quantities*available[seller]
+    divisor = np.maximum(total, 1)[seller]
+    filled = shares//divisor
+    # Hand out the units lost to rounding down.
+    roundedDown = (shares % divisor != 0).astype(np.int64)
+    leftover = available - np.bincount(seller, weights=filled, minlength=len(supply)).astype(np.int64)
+    rank = np.cumsum(roundedDown)
+    rank -= np.concatenate(([0], rank))[starts[:-1]][seller]
+    filled += roundedDown*(rank <= leftover[seller])
+    return filled
@@ -0,0 +1,124 @@
+#!/usr/bin/python
+
+import numpy as np
+from nose.tools import eq_, raises
+from supplyChainAllocation import allocate
+import supplyChainModel as scm
+
+
+class TestAllocate:
+    def setUp(self):
+        # The example in the supplyChainAllocation docstring.
+        self.supply = [5, 4]
+        self.starts = [0, 2, 3]
+        self.quantities = [4, 3, 6]
+
+    def test_example_fifo(self):
+        eq_(allocate(self.supply, self.starts, self.quantities, 'fifo').tolist(), [4, 1, 4])
+
+    def test_example_prorata(self):
+        eq_(allocate(self.supply, self.starts, self.quantities, 'prorata').tolist(), [3, 2, 4])
+
+    def test_fifo_oldest_first(self):
+        eq_(allocate([6], [0, 3], [2, 5, 1], 'fifo').tolist(), [2, 4, 0])
+
+    def test_prorata_leftover_to_oldest(self):
+        # 5 units for 3 orders of 3: one apiece rounded down, then the 2 left over to the oldest two.
+        eq_(allocate([5], [0, 3], [3, 3, 3], 'prorata').tolist(), [2, 2, 1])
+        eq_(allocate([7], [0, 2], [6, 4], 'prorata').tolist(), [5, 2])
+
+    def test_zero_supply(self):
+        for policy in ['fifo', 'prorata']:
+            eq_(allocate([0, 0], self.starts, self.quantities, policy).tolist(), [0, 0, 0])
+
+    def test_supply_above_demand(self):
+        for policy in ['fifo', 'prorata']:
+            eq_(allocate([50, 40], self.starts, self.quantities, policy).tolist(), self.quantities)
+
+    def test_sellers_without_orders(self):
+        for policy in ['fifo', 'prorata']:
+            eq_(allocate([3, 5, 0, 4], [0, 0, 2, 2, 3], [4, 3, 6], policy).tolist(),
+                allocate([5, 4], self.starts, self.quantities, policy).tolist())
+            eq_(allocate([3, 5], [0, 0, 0], [], policy).tolist(), [])
+
+    def test_never_over_ships(self):
+        rng = np.random.RandomState(0)
+        for policy in ['fifo', 'prorata']:
+            for trial in range(50):
+                counts = rng.randint(0, 5, size=4)
+                starts = np.concatenate(([0], np.cumsum(counts)))
+                quantities = rng.randint(1, 10, size=starts[-1])
+                supply = rng.randint(0, 30, size=4)
+                filled = allocate(supply, starts, quantities, policy)
+                assert (filled >= 0).all() and (filled <= quantities).all(), "an order was filled outside 0 to its quantity"
+                for i in range(4):
+                    shipped = filled[starts[i]:starts[i+1]].sum()
+                    ordered = quantities[starts[i]:starts[i+1]].sum()
+                    eq_(shipped, min(supply[i], ordered), "seller %d shipped %d of %d units ordered from %d in stock" % (
+                        i, shipped, ordered, supply[i]))
+
+    @raises(ValueError)
+    def test_unknown_policy(self):
+        allocate(self.supply, self.starts, self.quantities, 'lottery')
+
+    @raises(ValueError)
+    def test_bad_starts(self):
+        allocate(self.supply, [0, 2], self.quantities)
+
+
+# Two commodity markets of steel, one selling to c0 and c1 and the other to
+# c2, stepped together by stepCommodityMarkets.
+class TestStepCommodityMarkets:
+    def setUp(self):
+        self.calls = []
+        self.allocate = scm.allocate
+        def recordingAllocate(supply, starts, quantities, policy='fifo'):
+            filled = self.allocate(supply, starts, quantities, policy)
+            self.calls.append((list(supply), list(starts), list(quantities), filled.tolist()))
+            return filled
+        scm.allocate = recordingAllocate
+
+    def tearDown(self):
+        scm.allocate = self.allocate
+
+    def network(self, policy):
+        steel = scm.supplyChainProduct('steel')
+        nodeSpecs = [{'label': label, 'nodeRole': 'commodity market', 'product': steel, 'initialSupply': supply,
+                      'minOrder': 0, 'initialInventory': 0, 'allocationPolicy': policy} for label, supply in [('a', 4), ('b', 4)]]
+        nodeSpecs += [{'label': label, 'nodeRole': 'retail market', 'product': scm.supplyChainProduct('laptop'),
+                       'initialDemand': 10, 'rngSeed': 0} for label in ['c0', 'c1', 'c2']]
+        edgeSpecs = [(n1, n2, {'timeToTraverse': 1}) for n1, n2 in [('a', 'c0'), ('a', 'c1'), ('b', 'c2')]]
+        scNetwork = scm.spec2Supply(nodeSpecs, edgeSpecs, 'allocation', 5)
+        scNetwork.giveNodeContext()
+        actors = dict((actor.label, actor) for actor in scNetwork.nodes_iter())
+        actors['a'].receiveOrder(actors['c0'], 4, steel)
+        actors['a'].receiveOrder(actors['c1'], 3, steel)
+        actors['b'].receiveOrder(actors['c2'], 6, steel)
+        return scNetwork, actors, steel
+
+    def check(self, policy, shipped):
+        scNetwork, actors, steel = self.network(policy)
+        markets = [actors['a'], actors['b']]
+        orders = [[entry[3].label for entry in market.orderBook[steel].openOrders()] for market in markets]
+        scm.stepCommodityMarkets(markets)
+        eq_(len(self.calls), 1, "the markets were not allocated in one call")
+        supply, starts, quantities, filled = self.calls[0]
+        eq_(supply, [4, 4])
+        expected = dict()
+        for i, market in enumerate(markets):
+            for label, units in zip(orders[i], filled[starts[i]:starts[i+1]]):
+                expected[(market.label, label)] = expected.get((market.label, label), 0) + units
+        for (market, customer), units in sorted(expected.items()):
+            eq_(actors[market].shipmentsMade.get(1, (actors[customer], steel)), units,
+                "%s shipped %r to %s, not the %r allocated" % (
+                    market, actors[market].shipmentsMade.get(1, (actors[customer], steel)), customer, units))
+        eq_(dict((customer, units) for (market, customer), units in expected.items()), shipped)
+        store = scNetwork.transport.shipments
+        eq_(store.quantity[store.liveRows()].sum(), sum(filled), "what is in transit is not what was allocated")
+
+    def test_fifo(self):
+        # Orders placed at the same time are filled smallest first.
+        self.check('fifo', {'c0': 1, 'c1': 3, 'c2': 4})
+
+    def test_prorata(self):
+        self.check('prorata', {'c0': 2, 'c1': 2, 'c2': 4})
@@ -0,0 +1,92 @@
+#!/usr/bin/python
+
+'''
+Batch (Monte Carlo) runs of the supply chain model.
+
+supplyChainBatch compiles the generic graph once, using its own seeded
+random.Random, into a supplyChainTemplate. Each replicate instantiates a
+fresh supplyChainNetwork from the template and drives its market noise
+from a private random.Random(seed), so replicates are independent of each
+other, of the global random module and of which process runs them.
+
+Replicates are spread over a multiprocessing pool. The template is
+sent to each worker once, and results are yielded as they complete:
+
+    batch = supplyChainBatch(G, 50, structureSeed=999)
+    for result in batch.run(range(100), processes=8):
+        healths.append(result['health'])
+
+Each result is a dict with the replicate's 'seed', 'variant' name, network
+'health', and 'nodeHealth' and 'salesLost' arrays aligned with
+batch.labels (NaN for actors removed by the variant).
+
+A variant is a dict with a 'name' and a list of node labels to
+'removeNodes', e.g. the nodes frozen by a footprint. Its actors keep the
+targets and recipes worked out for the intact network.
+'''
+
+import random
+import multiprocessing
+import supplyChainModel as scm
+
+
+# Worker state: the run specification, set once per process by initWorker.
+workerSpec = None
+
+def initWorker(spec):
+    global workerSpec
+    workerSpec = spec
+
+def runWorkerReplicate(task):
+    return runReplicate(workerSpec, *task)
+
+# Instantiate a fresh network from the template in /spec/ and run one replicate.
+def runReplicate(spec, seed, variant, engine='object'):
+    template, name, timesteps = spec
+    nodeSpecs = template.nodeSpecs
+    removed = set(variant.get('removeNodes', ())) if variant else set()
+    scNetwork = template.instantiate(name, timesteps + 1, removed, random.Random(seed))
+    scm.stepNetwork(scNetwork, timesteps, engine)
+    nodeHealth, salesLost = scm.nodeOutcomes(scNetwork, [nodeData['label'] for nodeData in nodeSpecs])
+    return {'seed': seed,
+            'variant': variant.get('name') if variant else None,
+            'health': scNetwork.health,
+            'nodeHealth': nodeHealth,
+            'salesLost': salesLost}
+
+
+# Many runs of one network, differing only in market noise and scenario variant.
+class supplyChainBatch(object):
+    def __init__(self, G, timesteps, structureSeed, networkName='supplyChainBatch', finishedProduct=None, cacheDir=None):
+        # Work on a copy, so the caller's graph is left as it was.
+        G = G.copy()
+        scm.calculateDepth(G)
+        if cacheDir is None:
+            template = scm.supplyChainTemplate.fromGraph(G, structureSeed, finishedProduct)
+        else:
+            template = scm.cachedTemplate(G, structureSeed, cacheDir, finishedProduct)
+        self.timesteps = timesteps
+        self.spec = (template, networkName, timesteps)
+        self.labels = [nodeData['label'] for nodeData in template.nodeSpecs]
+
+    def __repr__(self):
+        return "supplyChainBatch(nodes=%r,timesteps=%r)" % (len(self.labels), self.timesteps)
+
+    # Run every seed under every variant (None is the unshocked network), yielding
+    # results in completion order. processes=1 runs in this process.
+    def run(self, seeds, variants=(None,), processes=None, engine='object'):
+        tasks = [(seed, variant, engine) for variant in variants for seed in seeds]
+        if processes == 1:
+            for task in tasks:
+                yield runReplicate(self.spec, *task)
+            return
+        pool = multiprocessing.Pool(processes, initializer=initWorker, initargs=(self.spec,))
+        try:
+            for result in pool.imap_unordered(runWorkerReplicate, tasks):
+                yield result
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
@@ -0,0 +1,49 @@
+#!/usr/bin/python
+
+import copy
+import random
+import numpy as np
+from nose.tools import eq_
+from supplyChainBenchmark import tieredSupplyNetwork, SIZES
+from supplyChainBatch import supplyChainBatch
+
+
+# Replicates should depend only on their seed and variant, not on the
+# process that runs them, the order they run in or the global random module.
+class TestBatch:
+    def setUp(self):
+        self.G = tieredSupplyNetwork(seed=3, **SIZES['tiny'])
+        self.seeds = [1, 2, 3, 4]
+
+    def results(self, batch, **kwargs):
+        return dict((result['seed'], result) for result in batch.run(self.seeds, **kwargs))
+
+    def test_same_in_any_process(self):
+        batch = supplyChainBatch(self.G, 10, 999, networkName='batch')
+        inline = self.results(batch, processes=1)
+        random.seed(12345)
+        pooled = self.results(batch, processes=2)
+        eq_(sorted(pooled), self.seeds)
+        for seed in self.seeds:
+            eq_(pooled[seed]['health'], inline[seed]['health'])
+            assert np.array_equal(pooled[seed]['nodeHealth'], inline[seed]['nodeHealth']), \
+                "seed %r gave different node health in the pool" % (seed)
+            assert np.array_equal(pooled[seed]['salesLost'], inline[seed]['salesLost'])
+
+    def test_graph_unchanged(self):
+        nodes = copy.deepcopy(sorted(self.G.nodes(data=True)))
+        edges = copy.deepcopy(sorted(self.G.edges(data=True)))
+        batch = supplyChainBatch(self.G, 5, 999, networkName='batch')
+        list(batch.run(self.seeds[:1], processes=1))
+        eq_(sorted(self.G.nodes(data=True)), nodes)
+        eq_(sorted(self.G.edges(data=True)), edges)
+
+    def test_removed_nodes(self):
+        batch = supplyChainBatch(self.G, 10, 999, networkName='batch')
+        removed = [label for label in batch.labels if self.G.node[label]['tier'] > 0][:2]
+        variant = {'name': 'freeze', 'removeNodes': removed}
+        for result in batch.run(self.seeds[:2], variants=[None, variant], processes=1):
+            for label, health in zip(batch.labels, result['nodeHealth']):
+                if label in removed:
+                    eq_(np.isnan(health), result['variant'] == 'freeze',
+                        "node %s has health %r in variant %r" % (label, health, result['variant']))
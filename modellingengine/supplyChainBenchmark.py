@@ -0,0 +1,184 @@
+#!/usr/bin/python
+
+'''
+Benchmarks for the supply chain model.
+
+tieredSupplyNetwork generates a synthetic supply network as a generic
+graph, with the tier, activity, name and distance attributes that
+generic2Supply expects: retail markets (tier -1), then tiers 0, 1, ... of
+suppliers, each supplier shipping to customers in the tier above. The
+last tier is raw materials.
+
+benchmark times, for each network size and engine:
+    setup   compiling the graph (supplyChainTemplate.fromGraph) and
+            instantiating a network from it, plus any engine set up
+    tick    each timestep on its own
+    export  copying results back (vector engine) and exportAsGeneric
+Each phase is summarised over the repeats and written out as JSON:
+
+    python supplyChainBenchmark.py --sizes small,medium --timesteps 30 -o bench.json
+    python supplyChainBenchmark.py --compare bench.json -o bench2.json
+
+--compare lists the phases that are slower than in an earlier results file.
+'''
+
+import sys
+import json
+import time
+import random
+import platform
+import datetime
+import numpy as np
+import networkx as nx
+import supplyChainModel as scm
+
+
+# Network sizes: widths of tiers 0 onwards, and the number of retail markets.
+SIZES = {'tiny': {'tiers': (3, 6, 12), 'markets': 2},
+         'small': {'tiers': (6, 12, 24, 48), 'markets': 5},
+         'medium': {'tiers': (25, 50, 100, 200), 'markets': 20},
+         'large': {'tiers': (100, 200, 300, 400), 'markets': 50}}
+
+# Distances (in metres) drawn for edges; 800km of distance is one timestep.
+DISTANCES = (0, 400000.0, 1600000.0, 2500000.0)
+
+PHASES = ('setup', 'tick', 'export')
+
+
+# Generic graph of a tiered supply network. Each market and supply chain
+# node buys from between fanIn[0] and fanIn[1] suppliers in the tier below,
+# and every supplier sells to at least fanOut[0] and at most fanOut[1]
+# customers (where there are enough of them). Tier t makes one of
+# productsPerTier products ('component t.i'); tier 0 makes the finished
+# product.
+def tieredSupplyNetwork(tiers=(6, 12, 24, 48), markets=5, fanIn=(1, 3), fanOut=(1, 3), productsPerTier=2,
+                        distances=DISTANCES, seed=0):
+    rng = random.Random(seed)
+    G = nx.DiGraph()
+    layers = [['m%d' % (i) for i in range(markets)]]
+    for label in layers[0]:
+        G.add_node(label, tier=-1, activity='distribution hub', name='market %s' % (label), guid=label)
+    for tier, width in enumerate(tiers):
+        layer = ['t%d.%d' % (tier, i) for i in range(width)]
+        for i, label in enumerate(layer):
+            activity = 'assembly' if tier == 0 else 'component %d.%d' % (tier, i % productsPerTier)
+            G.add_node(label, tier=tier, activity=activity, name='supplier %s' % (label), guid=label)
+        customers = layers[-1]
+        for customer in customers:
+            for supplier in rng.sample(layer, min(rng.randint(*fanIn), len(layer))):
+                G.add_edge(supplier, customer, distance=rng.choice(distances))
+        for supplier in layer:
+            wanted = min(rng.randint(*fanOut), len(customers))
+            others = [customer for customer in customers if not G.has_edge(supplier, customer)]
+            for customer in rng.sample(others, max(min(fanOut[0], len(customers)) - G.out_degree(supplier), 0)):
+                G.add_edge(supplier, customer, distance=rng.choice(distances))
+            others = [customer for customer in others if not G.has_edge(supplier, customer)]
+            for customer in rng.sample(others, max(min(wanted - G.out_degree(supplier), len(others)), 0)):
+                G.add_edge(supplier, customer, distance=rng.choice(distances))
+        layers.append(layer)
+    return G
+
+# Minimum, median, mean and maximum of /times/ (seconds).
+def summarise(times):
+    times = np.asarray(times, dtype=np.float64)
+    return {'min': float(times.min()), 'median': float(np.median(times)),
+            'mean': float(times.mean()), 'max': float(times.max()), 'count': len(times)}
+
+# Time one run of /G/ for /timesteps/ steps with /engine/, returning the
+# seconds spent in each phase (a list of per-tick times for 'tick').
+def timeRun(G, timesteps, engine='object', seed=999):
+    G = G.copy()
+    times = dict()
+    start = time.time()
+    scm.calculateDepth(G)
+    template = scm.supplyChainTemplate.fromGraph(G, seed)
+    scNetwork = template.instantiate('benchmark', timesteps + 1)
+    if engine == 'vector':
+        from supplyChainVector import supplyChainVectorEngine
+        stepper = supplyChainVectorEngine(scNetwork)
+    elif engine == 'object':
+        stepper = scNetwork
+    else:
+        raise ValueError("engine must be 'object' or 'vector', not %r" % (engine,))
+    times['setup'] = time.time() - start
+    ticks = []
+    for i in range(timesteps):
+        start = time.time()
+        stepper.makeTimeStep()
+        ticks.append(time.time() - start)
+    times['tick'] = ticks
+    start = time.time()
+    if engine == 'vector':
+        stepper.writeBack()
+    scm.exportAsGeneric(scNetwork, G)
+    times['export'] = time.time() - start
+    times['health'] = scNetwork.health
+    return times
+
+# Run every size in /sizes/ (names in SIZES, or dicts of
+# tieredSupplyNetwork arguments) with every engine, /repeats/ times.
+# Returns the results as a JSON-ready dict.
+def benchmark(sizes=('small', 'medium'), timesteps=30, engines=('object', 'vector'), repeats=3, seed=0, log=None):
+    results = []
+    for size in sizes:
+        options = SIZES[size] if isinstance(size, basestring) else size
+        G = tieredSupplyNetwork(seed=seed, **options)
+        for engine in engines:
+            runs = [timeRun(G, timesteps, engine) for i in range(repeats)]
+            result = {'size': size if isinstance(size, basestring) else repr(sorted(size.items())),
+                      'engine': engine, 'nodes': G.number_of_nodes(), 'edges': G.number_of_edges(),
+                      'health': runs[0]['health'],
+                      'setup': summarise([run['setup'] for run in runs]),
+                      'tick': summarise([tick for run in runs for tick in run['tick']]),
+                      'export': summarise([run['export'] for run in runs])}
+            results.append(result)
+            if log is not None:
+                log.write('%-8s %-8s %6d nodes  setup %.3fs  tick %.4fs  export %.3fs\n' % (result['size'], engine,
+                          result['nodes'], result['setup']['median'], result['tick']['median'], result['export']['median']))
+    return {'created': datetime.datetime.today().isoformat(),
+            'python': platform.python_version(), 'platform': platform.platform(),
+            'numpy': np.__version__, 'networkx': nx.__version__,
+            'timesteps': timesteps, 'repeats': repeats, 'seed': seed,
+            'results': results}
+
+# Phases of /current/ whose median time is more than /tolerance/ (a
+# fraction) above the same size and engine in /baseline/, as a list of
+# (size, engine, phase, baseline seconds, current seconds).
+def compareResults(baseline, current, tolerance=0.1):
+    previous = dict(((result['size'], result['engine']), result) for result in baseline['results'])
+    slower = []
+    for result in current['results']:
+        old = previous.get((result['size'], result['engine']))
+        if old is None:
+            continue
+        for phase in PHASES:
+            before, after = old[phase]['median'], result[phase]['median']
+            if after > before*(1 + tolerance):
+                slower.append((result['size'], result['engine'], phase, before, after))
+    return slower
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Time the supply chain model on synthetic networks.')
+    parser.add_argument('--sizes', default='small,medium', help='comma separated sizes from: ' + ', '.join(sorted(SIZES)))
+    parser.add_argument('--engines', default='object,vector', help='comma separated engines from: ' + ', '.join(scm.ENGINES))
+    parser.add_argument('--timesteps', type=int, default=30)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='list phases slower than in this earlier JSON results file')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+
+    results = benchmark(args.sizes.split(','), args.timesteps, args.engines.split(','), args.repeats, args.seed, log=sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        slower = compareResults(baseline, results, args.tolerance)
+        for size, engine, phase, before, after in slower:
+            print '%s %s %s: %.4fs -> %.4fs (%+.0f%%)' % (size, engine, phase, before, after, 100*(after/before - 1))
+        sys.exit(1 if slower else 0)
@@ -0,0 +1,294 @@
+#!/usr/bin/python
+
+'''
+Binary interchange format for supply chain graphs.
+
+A faster, typed alternative to GEXF for the generic graphs that
+runSimulation reads and exportAsGeneric writes. A file holds the nodes,
+the edges, every node, edge and graph attribute, and optionally per-tick
+result columns (e.g. node health at every timestep). Reads are memory
+mapped, so opening a file costs little more than reading its header.
+
+Layout: MAGIC, the length of the header (uint32, little endian), the
+header as JSON, then the arrays it lists, each aligned to ALIGNMENT bytes
+from the start of the data that follows the header. All arrays are
+little endian.
+
+The header records the node and edge counts, how the node labels are
+stored, the graph attributes (as a Python literal), the result names and,
+for every array, its data offset, dtype and shape. The arrays are:
+    labels              node labels, in the file's node order
+    edgeSource, edgeTarget
+                        node positions of each edge's ends
+    <entity>.<kind>.*   attributes of 'node' or 'edge' entities, one row
+                        per (entity, key, value): entity position, key
+                        position (in <entity>.keys) and value, in a table
+                        for the value's type
+    result.<name>       a (timesteps x nodes) array
+Values are stored by type (int, float, bool, str, unicode, or any other
+Python literal), so they come back as they went in.
+
+String tables are held as an int64 'offsets' array (one more than the
+number of strings) and a uint8 'blob' array of the encoded strings.
+'''
+
+import os
+import ast
+import json
+import struct
+import numpy as np
+import networkx as nx
+
+
+MAGIC = '\x89SCN\r\n\x1a\n'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+EXTENSION = '.scn'
+
+# Value kinds, each stored in its own tables (see valueKind).
+KINDS = ('bool', 'int', 'float', 'bytes', 'unicode', 'literal')
+INT64_RANGE = (-2**63, 2**63 - 1)
+
+
+def valueKind(value):
+    kind = type(value)
+    if kind is bool:
+        return 'bool'
+    if kind in (int, long):
+        return 'int' if INT64_RANGE[0] <= value <= INT64_RANGE[1] else 'literal'
+    if kind is float:
+        return 'float'
+    if kind is str:
+        return 'bytes'
+    if kind is unicode:
+        return 'unicode'
+    return 'literal'
+
+# Encode /values/ of one kind as a dict of arrays.
+def encodeValues(kind, values):
+    if kind == 'bool':
+        return {'values': np.array(values, dtype=np.uint8)}
+    if kind == 'int':
+        return {'values': np.array(values, dtype='<i8')}
+    if kind == 'float':
+        return {'values': np.array(values, dtype='<f8')}
+    if kind == 'unicode':
+        values = [value.encode('utf-8') for value in values]
+    elif kind == 'literal':
+        values = [literalRepr(value) for value in values]
+    offsets = np.zeros(len(values) + 1, dtype='<i8')
+    offsets[1:] = np.cumsum([len(value) for value in values])
+    return {'offsets': offsets, 'blob': np.frombuffer(''.join(values), dtype=np.uint8)}
+
+def literalRepr(value):
+    text = repr(value)
+    try:
+        ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        raise TypeError('Cannot store %r in a binary network file; values must be Python literals.' % (value,))
+    return text
+
+# Decode the arrays of one kind back into a list of values.
+def decodeValues(kind, arrays):
+    if kind == 'bool':
+        return [bool(value) for value in arrays['values'].tolist()]
+    if kind in ('int', 'float'):
+        return arrays['values'].tolist()
+    offsets = arrays['offsets'].tolist()
+    blob = arrays['blob'].tobytes()
+    values = [blob[offsets[i]:offsets[i+1]] for i in range(len(offsets) - 1)]
+    if kind == 'unicode':
+        return [value.decode('utf-8') for value in values]
+    if kind == 'literal':
+        return [ast.literal_eval(value) for value in values]
+    return values
+
+# The single kind that stores all of /values/.
+def commonKind(values):
+    kinds = set(valueKind(value) for value in values)
+    if len(kinds) == 1:
+        return kinds.pop()
+    return 'literal' if kinds else 'bytes'
+
+
+# Write graph /G/ to /filename/. /results/ is an optional dict of
+# (timesteps x nodes) arrays, with columns in G.nodes() order.
+def writeNetwork(G, filename, results=None):
+    nodes = G.nodes()
+    position = dict((node, i) for i, node in enumerate(nodes))
+    arrays = []
+    labelKind = commonKind(nodes)
+    for name, array in encodeValues(labelKind, nodes).iteritems():
+        arrays.append(('labels.' + name, array))
+    edges = G.edges(data=True)
+    arrays.append(('edgeSource', np.array([position[u] for u, v, data in edges], dtype='<i8')))
+    arrays.append(('edgeTarget', np.array([position[v] for u, v, data in edges], dtype='<i8')))
+    attributes = {}
+    for entity, items in [('node', [(i, G.node[node]) for i, node in enumerate(nodes)]),
+                          ('edge', [(i, data) for i, (u, v, data) in enumerate(edges)])]:
+        keys, keyIndex = [], {}
+        rows = dict((kind, ([], [], [])) for kind in KINDS)
+        for i, data in items:
+            for key, value in data.iteritems():
+                if not key in keyIndex:
+                    keyIndex[key] = len(keys)
+                    keys.append(key)
+                entityRows, keyRows, values = rows[valueKind(value)]
+                entityRows.append(i)
+                keyRows.append(keyIndex[key])
+                values.append(value)
+        for name, array in encodeValues('literal', keys).iteritems():
+            arrays.append(('%s.keys.%s' % (entity, name), array))
+        attributes[entity] = []
+        for kind in KINDS:
+            entityRows, keyRows, values = rows[kind]
+            if not values:
+                continue
+            attributes[entity].append(kind)
+            arrays.append(('%s.%s.entity' % (entity, kind), np.array(entityRows, dtype='<i8')))
+            arrays.append(('%s.%s.key' % (entity, kind), np.array(keyRows, dtype='<i8')))
+            for name, array in encodeValues(kind, values).iteritems():
+                arrays.append(('%s.%s.%s' % (entity, kind, name), array))
+    resultNames = []
+    for name, result in sorted((results or {}).iteritems()):
+        result = np.asarray(result)
+        if result.ndim != 2 or result.shape[1] != len(nodes):
+            raise ValueError('Result %r should have a column per node, not shape %r' % (name, result.shape))
+        resultNames.append(name)
+        arrays.append(('result.' + name, result.astype(result.dtype.newbyteorder('<'))))
+    header = {'version': FORMAT_VERSION, 'directed': G.is_directed(),
+              'graph': literalRepr(G.graph), 'nodes': len(nodes), 'edges': len(edges),
+              'labels': labelKind, 'attributes': attributes, 'results': resultNames, 'arrays': {}}
+    offset = 0
+    for name, array in arrays:
+        header['arrays'][name] = {'offset': offset, 'dtype': array.dtype.str, 'shape': array.shape}
+        offset += -(-array.nbytes//ALIGNMENT)*ALIGNMENT
+    headerText = json.dumps(header, sort_keys=True)
+    with open(filename, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(headerText)))
+        f.write(headerText)
+        f.write('\0'*(-f.tell() % ALIGNMENT))
+        for name, array in arrays:
+            data = np.ascontiguousarray(array).tobytes()
+            f.write(data)
+            f.write('\0'*(-len(data) % ALIGNMENT))
+
+# Whether /filename/ is a binary network file.
+def isBinaryNetwork(filename):
+    try:
+        with open(filename, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except IOError:
+        return False
+
+
+# A binary network file opened for reading. Arrays are views of the
+# memory mapped file (or of the file read into memory, with mmap=False).
+class supplyChainBinaryNetwork(object):
+    def __init__(self, filename, mmap=True):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('%s is not a binary network file' % (filename,))
+            headerLength = struct.unpack('<I', f.read(4))[0]
+            self.header = json.loads(f.read(headerLength))
+            start = f.tell()
+        if self.header['version'] > FORMAT_VERSION:
+            raise ValueError('%s is in binary network format %r; only up to %r can be read'
+                             % (filename, self.header['version'], FORMAT_VERSION))
+        start += -start % ALIGNMENT
+        if os.path.getsize(filename) <= start:
+            self.data = np.zeros(0, dtype=np.uint8)
+        elif mmap:
+            self.data = np.memmap(filename, dtype=np.uint8, mode='r', offset=start)
+        else:
+            with open(filename, 'rb') as f:
+                f.seek(start)
+                self.data = np.frombuffer(f.read(), dtype=np.uint8)
+        self.numNodes = self.header['nodes']
+        self.numEdges = self.header['edges']
+        self.resultNames = [str(name) for name in self.header['results']]
+
+    def __repr__(self):
+        return "supplyChainBinaryNetwork(filename=%r,nodes=%r,edges=%r)" % (self.filename, self.numNodes, self.numEdges)
+
+    def array(self, name):
+        spec = self.header['arrays'][name]
+        dtype = np.dtype(str(spec['dtype']))
+        count = int(np.prod(spec['shape']))
+        return self.data[spec['offset']:spec['offset'] + count*dtype.itemsize].view(dtype).reshape(spec['shape'])
+
+    def values(self, prefix, kind):
+        names = ['values'] if kind in ('bool', 'int', 'float') else ['offsets', 'blob']
+        return decodeValues(kind, dict((name, self.array('%s.%s' % (prefix, name))) for name in names))
+
+    def labels(self):
+        return self.values('labels', self.header['labels'])
+
+    def graphAttributes(self):
+        return ast.literal_eval(self.header['graph'])
+
+    # (source, target) arrays of node positions.
+    def edges(self):
+        return self.array('edgeSource'), self.array('edgeTarget')
+
+    # The (timesteps x nodes) result column /name/.
+    def result(self, name):
+        return self.array('result.' + name)
+
+    # Attribute dicts of every 'node' or 'edge', in file order.
+    def attributes(self, entity):
+        data = [dict() for i in range(self.numNodes if entity == 'node' else self.numEdges)]
+        keys = self.values(entity + '.keys', 'literal')
+        for kind in self.header['attributes'][entity]:
+            rows = self.array('%s.%s.entity' % (entity, kind)).tolist()
+            keyRows = self.array('%s.%s.key' % (entity, kind)).tolist()
+            for i, key, value in zip(rows, keyRows, self.values('%s.%s' % (entity, kind), kind)):
+                data[i][keys[key]] = value
+        return data
+
+    # Values of attribute /key/ of every 'node' or 'edge', as (positions, values).
+    def column(self, entity, key):
+        keys = self.values(entity + '.keys', 'literal')
+        if not key in keys:
+            return np.zeros(0, dtype=np.int64), []
+        keyPosition = keys.index(key)
+        positions, values = [], []
+        for kind in self.header['attributes'][entity]:
+            chosen = np.flatnonzero(self.array('%s.%s.key' % (entity, kind)) == keyPosition)
+            if len(chosen):
+                positions.append(self.array('%s.%s.entity' % (entity, kind))[chosen])
+                kindValues = self.values('%s.%s' % (entity, kind), kind)
+                values.extend(kindValues[i] for i in chosen)
+        positions = np.concatenate(positions) if positions else np.zeros(0, dtype=np.int64)
+        order = np.argsort(positions, kind='mergesort')
+        return positions[order], [values[i] for i in order]
+
+    def toGraph(self):
+        G = nx.DiGraph() if self.header['directed'] else nx.Graph()
+        G.graph.update(self.graphAttributes())
+        labels = self.labels()
+        G.add_nodes_from(zip(labels, self.attributes('node')))
+        source, target = self.edges()
+        G.add_edges_from((labels[u], labels[v], data)
+                         for u, v, data in zip(source.tolist(), target.tolist(), self.attributes('edge')))
+        return G
+
+# Read the graph in binary network file /filename/.
+def readNetwork(filename, mmap=True):
+    return supplyChainBinaryNetwork(filename, mmap).toGraph()
+
+# Read /filename/ as a binary network file, or else as GEXF.
+def readGraph(filename):
+    if isBinaryNetwork(filename):
+        return readNetwork(filename)
+    return nx.read_gexf(filename)
+
+# Write /G/ to /filename/: as a binary network file if it ends in
+# EXTENSION, otherwise as GEXF (which has no room for /results/).
+def writeGraph(G, filename, results=None):
+    if filename.endswith(EXTENSION):
+        writeNetwork(G, filename, results)
+    else:
+        nx.write_gexf(G, filename)
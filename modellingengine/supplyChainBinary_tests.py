@@ -0,0 +1,107 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import tempfile
+import numpy as np
+import networkx as nx
+from nose.tools import eq_, raises
+from supplyChainBenchmark import tieredSupplyNetwork, SIZES
+import supplyChainBinary as scb
+import supplyChainModel as scm
+
+
+class TestBinaryFormat:
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'network' + scb.EXTENSION)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def roundTrip(self, G, results=None, mmap=True):
+        scb.writeNetwork(G, self.filename, results)
+        return scb.supplyChainBinaryNetwork(self.filename, mmap)
+
+    def test_attribute_types(self):
+        G = nx.DiGraph(name='types', created=(2015, 3))
+        G.add_node('a', tier=1, health=0.5, frozen=True, name='supplier a', longName=u'fournisseur \xe0',
+                   big=2**70, products=['steel', 'glass'], missing=None)
+        G.add_node(u'b\xe9', tier=-1)
+        G.add_edge('a', u'b\xe9', distance=400000.0, timeToTraverse=1)
+        H = self.roundTrip(G).toGraph()
+        eq_(H.graph, G.graph)
+        eq_(sorted(H.nodes(data=True)), sorted(G.nodes(data=True)))
+        eq_(H.edges(data=True), G.edges(data=True))
+        for key, value in G.node['a'].iteritems():
+            eq_(type(H.node['a'][key]), type(value), "attribute %s came back as %s, not %s" % (
+                key, type(H.node['a'][key]).__name__, type(value).__name__))
+
+    def test_results(self):
+        G = tieredSupplyNetwork(**SIZES['tiny'])
+        health = np.random.RandomState(0).rand(5, G.number_of_nodes())
+        for mmap in [True, False]:
+            network = self.roundTrip(G, {'health': health}, mmap)
+            eq_(network.resultNames, ['health'])
+            assert np.array_equal(network.result('health'), health), "health results changed in the file"
+
+    def test_column(self):
+        G = tieredSupplyNetwork(**SIZES['tiny'])
+        network = self.roundTrip(G)
+        positions, tiers = network.column('node', 'tier')
+        labels = network.labels()
+        eq_([G.node[labels[i]]['tier'] for i in positions], tiers)
+        eq_(len(network.column('node', 'nowhere')[1]), 0)
+
+    def test_read_graph(self):
+        G = tieredSupplyNetwork(**SIZES['tiny'])
+        scb.writeGraph(G, self.filename)
+        assert scb.isBinaryNetwork(self.filename), "writeGraph did not write a binary file for %s" % (scb.EXTENSION)
+        eq_(sorted(scb.readGraph(self.filename).edges(data=True)), sorted(G.edges(data=True)))
+        gexf = os.path.join(self.directory, 'network.gexf')
+        scb.writeGraph(G, gexf)
+        assert not scb.isBinaryNetwork(gexf), "writeGraph did not write GEXF"
+        eq_(sorted(scb.readGraph(gexf).nodes()), sorted(G.nodes()))
+
+    @raises(ValueError)
+    def test_not_binary(self):
+        with open(self.filename, 'wb') as f:
+            f.write('<gexf/>')
+        scb.supplyChainBinaryNetwork(self.filename)
+
+    @raises(ValueError)
+    def test_wrong_results_shape(self):
+        G = tieredSupplyNetwork(**SIZES['tiny'])
+        scb.writeNetwork(G, self.filename, {'health': np.zeros((3, 2))})
+
+
+# Runs of a network read from, or written to, a binary network file should
+# match the run of the graph in memory.
+class TestBinaryRuns:
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.G = tieredSupplyNetwork(**SIZES['tiny'])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run(self, G, **kwargs):
+        return scm.runSimulation(G, 20, 999, networkName='binaryRun', **kwargs)
+
+    def test_run_from_file(self):
+        filename = os.path.join(self.directory, 'network' + scb.EXTENSION)
+        scb.writeGraph(self.G, filename)
+        G, health = self.run(filename)
+        expectedG, expectedHealth = self.run(tieredSupplyNetwork(**SIZES['tiny']))
+        eq_(health, expectedHealth)
+        eq_(sorted(G.nodes(data=True)), sorted(expectedG.nodes(data=True)))
+
+    def test_results_file(self):
+        filename = os.path.join(self.directory, 'results' + scb.EXTENSION)
+        G, health = self.run(self.G, finOutFile=filename)
+        network = scb.supplyChainBinaryNetwork(filename)
+        eq_(sorted(network.toGraph().nodes(data=True)), sorted(G.nodes(data=True)))
+        history = network.result('health')
+        eq_(history.shape, (21, G.number_of_nodes()))
+        labels = network.labels()
+        eq_([history[-1, i] for i in range(len(labels))], [G.node[label]['health'] for label in labels])
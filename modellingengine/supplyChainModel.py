@@ -1,9 +1,24 @@
 #!/usr/bin/python
 
 import networkx as nx
+import numpy as np
 import random
 import math
+import heapq
+import collections
+import hashlib
+import os
+import stat
+import time
+import tempfile
+import cPickle
+import cStringIO
+import gzip
+import zlib
 from operator import attrgetter, itemgetter
+from supplyChainSink import FIELDS as sinkFields, FIELD_TYPES as sinkFieldTypes
+from supplyChainBinary import readGraph, writeGraph, EXTENSION as binaryExtension
+from supplyChainAllocation import allocate, checkPolicy
 import datetime
 
 
@@ -12,11 +27,28 @@ def noneToZero(value):
 
 # NetworkX graph subclass with methods specific to the Supply Chain Modelling problem.
 class supplyChainNetwork(nx.DiGraph):
-    def __init__(self,name,simulationLength=100,data=None,**attr):
+    def __init__(self,name,simulationLength=100,data=None,shipmentHistory=False,historyWindow=None,**attr):
         nx.DiGraph.__init__(self, data=None, **attr)
         self.name = name
         self.health = 1.0
         self.simulationLength=simulationLength
+        self.currentTime = 0
+        self.historyWindow = historyWindow # Timesteps of history the actors keep, or None to keep it all (see newLedger).
+        self.transport = supplyChainTransport(self, shipmentHistory and historyWindow is None) # Shipments in transit (and, with shipmentHistory, delivered) between actors.
+        self.rng = random # Seeds the market noise; a random.Random gives the network a private stream.
+        self.demandSeed = None # Network part of every retail market's demand seed, drawn from rng.
+        self.sinks = [] # Result sinks sent a record at the end of every timestep (see supplyChainSink).
+        self.sinkNodes = None # Node order of the records, fixed when the first sink is added.
+        self.healthNodes = [] # Actors in name order, as in the columns of nodeHealthHistory.
+        self.healthColumn = dict() # Actor -> column of nodeHealthHistory.
+        self.nodeHealth = np.ones(0) # Latest health of each actor, aligned with healthNodes.
+        self.healthSquares = 0.0 # Running sum of the squares of nodeHealth.
+        self.healthHistory = np.ones(self.healthRows()) # Network health at each timestep held (see healthRows).
+        self.nodeHealthHistory = np.ones((self.healthRows(), 0)) # Actor health at each timestep held.
+        self.healthStale = False # Actors have been added or removed since the health index was built.
+        self.structureVersion = 0 # Incremented whenever actors or edges are added or removed.
+        self.orderedCache = None # (structureVersion, actors in stepping order), see orderedNodes.
+        self.profiler = None # Times each phase of every timestep if set (see supplyChainProfiler).
 
     def __repr__(self):
         return "supplyChainNetwork(name=%r)" % (self.name)
@@ -28,11 +60,73 @@ class supplyChainNetwork(nx.DiGraph):
         else:
             self.productCatalogue = dict(product=[])
 
+    # A ledger for an actor's records. With a historyWindow, it only holds
+    # that many timesteps (and the totals), so a long run takes memory in
+    # proportion to the window rather than the simulation length. Each
+    # timestep's summary still goes to the result sinks (see addSink), and
+    # delivered shipments are not kept.
+    def newLedger(self, productKeyed=False):
+        if self.historyWindow is None:
+            return supplyChainLedger(self.simulationLength, productKeyed)
+        return supplyChainWindowedLedger(self.simulationLength, productKeyed, self.historyWindow)
+
+    # Rows of the health histories. Timestep t is held in row t % healthRows(),
+    # so with a historyWindow only the latest window of timesteps is held.
+    def healthRows(self):
+        if self.historyWindow is None:
+            return self.simulationLength + 1
+        return self.historyWindow
+
+    # Timesteps held in the health histories, oldest first, and their rows.
+    def heldTimes(self):
+        times = np.arange(max(0, self.currentTime + 1 - self.healthRows()), self.currentTime + 1)
+        return times, times % self.healthRows()
+
+    # A list of per-timestep values for an actor, each starting as /default/
+    # (or default(), if it can be called). With a historyWindow, it is a
+    # supplyChainHistory holding that many timesteps.
+    def newHistory(self, default):
+        if self.historyWindow is None:
+            return [default() if callable(default) else default for __ in range(self.simulationLength)]
+        history = supplyChainHistory(self.historyWindow, default)
+        history[0] = default() if callable(default) else default
+        return history
+
+    # Note a change to the network's structure, so that cached node orders and
+    # neighbours are rebuilt, refreshing the neighbours of /actors/ at once.
+    # If actors were added or removed (/actorsChanged/), the health index is
+    # rebuilt before the network's health is next used (see checkHealthIndex).
+    def structureChanged(self, actors=(), actorsChanged=False):
+        self.structureVersion += 1
+        if actorsChanged:
+            self.healthStale = True
+        for actor in actors:
+            actor.getNeighbours()
+
     # Method for adding an edge to the graph, updating the relevant nodes neighbour-knowledge.
+    # Changing the attributes of an existing edge leaves the structure as it was.
     def add_edge(self,u, v, attr_dict=None, **attr):
+        isNew = not self.has_edge(u, v)
         nx.DiGraph.add_edge(self,u,v,attr_dict,**attr)
-        u.getNeighbours()
-        v.getNeighbours()
+        if isNew:
+            self.structureChanged([u, v])
+
+    def add_edges_from(self, ebunch, attr_dict=None, **attr):
+        for edge in ebunch:
+            edata = dict(attr_dict or {})
+            edata.update(attr)
+            if len(edge) == 3:
+                edata.update(edge[2])
+            self.add_edge(edge[0], edge[1], edata)
+
+    def remove_edge(self, u, v):
+        nx.DiGraph.remove_edge(self, u, v)
+        self.structureChanged([u, v])
+
+    def remove_edges_from(self, ebunch):
+        for edge in ebunch:
+            if self.has_edge(edge[0], edge[1]):
+                self.remove_edge(edge[0], edge[1])
 
     # Method for adding many products to the graph.
     def addProductCatalogue(self,productCatalogue):
@@ -71,44 +165,159 @@ class supplyChainNetwork(nx.DiGraph):
 
     # Method for adding a node to the graph.
     def add_node(self, n, attr_dict=None, **attr):
+        isNew = not n in self.node
         nx.DiGraph.add_node(self,n,attr_dict, **attr)
+        if isNew:
+            self.structureChanged(actorsChanged=True)
+
+    def add_nodes_from(self, nodes, **attr):
+        numNodes = len(self)
+        nx.DiGraph.add_nodes_from(self, nodes, **attr)
+        if len(self) != numNodes:
+            self.structureChanged(actorsChanged=True)
+
+    # Remove node /n/, and its edges, refreshing its neighbours' neighbours.
+    def remove_node(self, n):
+        neighbours = set(self.successors(n)) | set(self.predecessors(n))
+        nx.DiGraph.remove_node(self, n)
+        self.structureChanged(neighbours, actorsChanged=True)
+
+    def remove_nodes_from(self, nodes):
+        for n in list(nodes):
+            if n in self.node:
+                self.remove_node(n)
 
     def giveNodeContext(self):
+        if self.demandSeed is None:
+            self.demandSeed = self.rng.getrandbits(32)
         for node in self.nodes_iter():
             node.getGraphContext()
             if isinstance(node, supplyChainNode):
                 for product in node.products:
                     self.addStockist(product,node)
+        self.orderedCache = None # Depths may have changed.
+        self.indexHealth()
+
+    # Give each actor a column in the health history and start the running
+    # sum of squares from their current health.
+    def indexHealth(self):
+        self.healthNodes = sorted(self.nodes(), key=attrgetter('name'))
+        self.healthColumn = dict((node, i) for i, node in enumerate(self.healthNodes))
+        self.nodeHealthHistory = np.ones((self.healthRows(), len(self.healthNodes)))
+        self.healthStale = False
+        self.recordHealth([node.health for node in self.healthNodes])
+
+    # Rebuild the health index if actors have been added or removed since it
+    # was built. Removed actors stop counting towards the network's health and
+    # lose their column; the actors that remain keep their history and latest
+    # health, and added actors start from their own health.
+    def checkHealthIndex(self):
+        if not self.healthStale:
+            return
+        oldColumn, oldHistory, oldHealth = self.healthColumn, self.nodeHealthHistory, self.nodeHealth
+        self.healthNodes = sorted(self.nodes(), key=attrgetter('name'))
+        self.healthColumn = dict((node, i) for i, node in enumerate(self.healthNodes))
+        self.nodeHealthHistory = np.ones((self.healthRows(), len(self.healthNodes)))
+        kept = [(i, oldColumn[node]) for i, node in enumerate(self.healthNodes) if node in oldColumn]
+        if kept:
+            columns, oldColumns = zip(*kept)
+            self.nodeHealthHistory[:, columns] = oldHistory[:, oldColumns]
+        self.nodeHealth = np.array([oldHealth.item(oldColumn[node]) if node in oldColumn else node.health
+                                    for node in self.healthNodes], dtype=np.float64)
+        self.healthSquares = math.fsum(self.nodeHealth**2)
+        self.healthStale = False
+
+    # Record the new health of /node/, as each actor does at the end of its
+    # timestep, updating the running sum of squares by the change.
+    def updateHealth(self, node, health):
+        i = self.healthColumn[node]
+        self.healthSquares += health**2 - self.nodeHealth.item(i)**2
+        self.nodeHealth.itemset(i, health)
+
+    # Record the health of every actor at once, aligned with healthNodes,
+    # resetting the sum of squares exactly.
+    def recordHealth(self, nodeHealth):
+        self.nodeHealth = np.array(nodeHealth, dtype=np.float64)
+        self.healthSquares = math.fsum(self.nodeHealth**2)
+        return self.currentHealth()
+
+    # Health of /node/ at every timestep so far (with a historyWindow, at
+    # the timesteps still held, see heldTimes).
+    def getNodeHealthHistory(self, node):
+        self.checkHealthIndex()
+        return self.nodeHealthHistory[self.heldTimes()[1], self.healthColumn[node]]
+
+    def getHealthHistory(self):
+        return self.healthHistory[self.heldTimes()[1]]
     
+    # Actors in stepping order: by depth, then by name. Sorted again only
+    # after the structure (or the actors' context) changes.
     def orderedNodes(self):
-        nameSortedNodes = sorted(self.nodes(), key=attrgetter('name'))
-        tierSortedNodes = sorted(nameSortedNodes, key=attrgetter('depth'))
-        return tierSortedNodes
+        if self.orderedCache is None or self.orderedCache[0] != self.structureVersion:
+            nameSortedNodes = sorted(self.nodes(), key=attrgetter('name'))
+            tierSortedNodes = sorted(nameSortedNodes, key=attrgetter('depth'))
+            self.orderedCache = (self.structureVersion, tierSortedNodes)
+        return list(self.orderedCache[1])
     
+    # Advance the clock by one timestep. Shipments are not touched; each node
+    # collects those due to arrive from the transport calendar.
     def moveShipments(self):
-        for node1, node2 in self.edges():
-            edata = self[node1][node2]
-            if isinstance(edata,dict):
-                for key in edata:
-                    if isinstance(key,tuple):
-                        if edata[key] is None:
-                            continue
-                        travelTime, quant, prod = edata[key]
-                        edata[key]  = (travelTime + 1, quant, prod)
-                for key, val in edata.items():
-                    if val == None:
-                        del self[node1][node2][key]
+        self.currentTime += 1
+
+    # The edge attribute dict as it used to be stored on the graph: static
+    # attributes plus {(timeWhenShipped, origin, target): (timeOnEdge, quantity, product)}
+    # for every shipment made along the edge.
+    def shipmentEdgeData(self, u, v):
+        edata = dict(self.get_edge_data(u, v, dict()))
+        edata.update(self.transport.edgeShipments(u, v))
+        return edata
                     
-    def calculateHealth(self):
-        healthList = [node.calculateHealth() for node in self.nodes()]
-        self.health = (sum([health**2 for health in healthList])/len(healthList))**0.5
+    # Network health from the actors' pushed health (see updateHealth),
+    # recorded in the health histories for the current timestep.
+    def currentHealth(self):
+        self.checkHealthIndex()
+        t = self.currentTime % self.healthRows()
+        if self.healthNodes:
+            self.health = (max(self.healthSquares, 0.0)/len(self.healthNodes))**0.5
+        self.healthHistory[t] = self.health
+        self.nodeHealthHistory[t] = self.nodeHealth
         return self.health
 
+    # Recalculate every actor's health and the network's from scratch. The
+    # sum of squares is recalculated exactly too, correcting any rounding
+    # drift in the running total.
+    def calculateHealth(self):
+        self.checkHealthIndex()
+        return self.recordHealth([node.calculateHealth() for node in self.healthNodes])
+
     def makeTimeStep(self):
+        self.checkHealthIndex()
+        if self.profiler is not None:
+            self.profiler.profileStep(self, [('moveShipments', self.moveShipments),
+                                             ('stepActors', self.stepActors),
+                                             ('currentHealth', self.currentHealth),
+                                             ('emitRecord', self.emitRecord)], hot=False)
+            return
+        self.moveShipments()
+        self.stepActors()
+        self.currentHealth()
+        self.emitRecord()
+
+    # Step every actor, in orderedNodes order. Commodity markets are held
+    # back and stepped together (see stepCommodityMarkets) before the first
+    # of their customers steps, which gives the same result as stepping
+    # each in turn.
+    def stepActors(self):
         nodeList = self.orderedNodes()
-        moveShipments(self)
+        commodityMarkets = []
         #print '------------------------------------------'
         for node in nodeList:
+            if isinstance(node, supplyChainCommodityMarket):
+                commodityMarkets.append(node)
+                continue
+            if commodityMarkets and not set(commodityMarkets).isdisjoint(node.downstream):
+                stepCommodityMarkets(commodityMarkets)
+                commodityMarkets = []
             #print ''
             ## Ensure the node has been initialised properly.
             #if node.currentTime == 0:
@@ -116,9 +325,294 @@ class supplyChainNetwork(nx.DiGraph):
             #print node.name + ':'
             #print
             node.makeTimeStep()
+        stepCommodityMarkets(commodityMarkets)
         #print '------------------------------------------'
-        self.calculateHealth()
-        
+
+    # Attach a result sink. It is sent a record of every actor's state at the
+    # end of each timestep, with actors in name order.
+    def addSink(self, sink):
+        if self.sinkNodes is None:
+            self.sinkNodes = sorted(self.nodes(), key=attrgetter('name'))
+        sink.open([node.label for node in self.sinkNodes])
+        self.sinks.append(sink)
+
+    # Record of the current timestep, with an array per field of supplyChainSink.FIELDS.
+    def tickRecord(self):
+        summaries = np.array([node.getTickSummary() for node in self.sinkNodes], dtype=np.float64).reshape(-1, len(sinkFields))
+        record = {'time': self.currentTime}
+        for i, field in enumerate(sinkFields):
+            record[field] = summaries[:, i].astype(sinkFieldTypes[field])
+        return record
+
+    # Send the current timestep to every sink; /record/ overrides tickRecord.
+    def emitRecord(self, record=None):
+        if not self.sinks:
+            return
+        if record is None:
+            record = self.tickRecord()
+        for sink in self.sinks:
+            sink.write(record)
+
+    def closeSinks(self):
+        for sink in self.sinks:
+            sink.close()
+
+    # Save the state of the run (actors, ledgers, order books, shipments in
+    # transit and market random state) to /path/, so that restore() can carry
+    # on from this timestep. Sinks are not saved, nor is the state of a
+    # supplyChainVectorEngine stepping the network.
+    def checkpoint(self, path):
+        directory = os.path.dirname(os.path.abspath(path))
+        handle, tempName = tempfile.mkstemp(dir=directory)
+        with os.fdopen(handle, 'wb') as f:
+            gzipFile = gzip.GzipFile(fileobj=f, mode='wb')
+            writeCheckpoint(self, gzipFile)
+            gzipFile.close()
+        os.rename(tempName, path)
+
+    # The network saved at /path/ by checkpoint(). If it drew its noise from
+    # the random module, the module's state is restored too.
+    @classmethod
+    def restore(cls, path):
+        gzipFile = gzip.open(path, 'rb')
+        try:
+            return readCheckpoint(gzipFile)
+        finally:
+            gzipFile.close()
+
+    # An independent copy of the network as it stands, to branch a scenario
+    # from. The copy carries on with the same market noise, unless another
+    # /rng/ is given to draw fresh noise for the rest of the run from.
+    def fork(self, rng=None):
+        buf = cStringIO.StringIO()
+        writeCheckpoint(self, buf)
+        buf.seek(0)
+        scNetwork = readCheckpoint(buf, restoreRandom=False)
+        if rng is not None:
+            scNetwork.reseedDemand(rng)
+        return scNetwork
+
+    # Redraw every retail market's demand noise after the current timestep,
+    # from a network seed drawn from /rng/.
+    def reseedDemand(self, rng):
+        self.rng = rng
+        self.demandSeed = rng.getrandbits(32)
+        for node in self.nodes_iter():
+            if isinstance(node, supplyChainRetailMarket):
+                node.seedDemand(self.currentTime + 1)
+
+# A shipment of /quantity/ units of /product/ from /origin/ to /target/.
+class supplyChainShipment(object):
+    def __init__(self, timeWhenShipped, origin, target, quantity, product):
+        self.timeWhenShipped = timeWhenShipped # (int) The shipping node's clock when shipped (part of the shipment key).
+        self.origin = origin
+        self.target = target
+        self.quantity = quantity
+        self.product = product
+        self.timePlaced = None # (int) Network timestep in which the shipment was put on the edge.
+        self.arrivalTime = None # (int) First network timestep at which the target can receive it.
+        self.timeReceived = None
+        self.sequence = None
+
+    def __repr__(self):
+        return ("supplyChainShipment(%r -> %r, quantity=%r, product=%r, arrivalTime=%r)"
+            % (self.origin.name, self.target.name, self.quantity, self.product, self.arrivalTime))
+
+
+# Shipments held in typed columns, one row per shipment. Rows are appended,
+# killed (sequence set to -1) once they are no longer wanted, and dropped
+# by compact(), so the store only grows with the shipments it holds.
+class supplyChainShipmentStore(object):
+    COLUMNS = ('origin', 'target', 'product', 'timeWhenShipped', 'timePlaced',
+               'arrivalTime', 'timeReceived', 'quantity', 'sequence')
+
+    def __init__(self, capacity=64):
+        self.size = 0 # Rows in use, dead or alive.
+        self.dead = 0
+        for name in self.COLUMNS:
+            setattr(self, name, np.empty(capacity, dtype=np.int64))
+
+    def __repr__(self):
+        return "supplyChainShipmentStore(rows=%r,dead=%r)" % (self.size, self.dead)
+
+    def __len__(self):
+        return self.size - self.dead
+
+    def _grow(self):
+        for name in self.COLUMNS:
+            column = getattr(self, name)
+            newColumn = np.empty(2*len(column), dtype=np.int64)
+            newColumn[:self.size] = column[:self.size]
+            setattr(self, name, newColumn)
+
+    # Add a row; origin, target and product are indices (see supplyChainTransport).
+    def append(self, origin, target, product, timeWhenShipped, timePlaced, arrivalTime, timeReceived, quantity, sequence):
+        row = self.size
+        if row == len(self.sequence):
+            self._grow()
+        for name, value in zip(self.COLUMNS, (origin, target, product, timeWhenShipped, timePlaced,
+                                              arrivalTime, timeReceived, quantity, sequence)):
+            getattr(self, name).itemset(row, value)
+        self.size += 1
+        return row
+
+    def kill(self, row):
+        self.sequence.itemset(row, -1)
+        self.dead += 1
+
+    # Rows that are alive, in the order they were appended.
+    def liveRows(self):
+        return np.flatnonzero(self.sequence[:self.size] >= 0)
+
+    # Drop the dead rows, keeping the others in order.
+    def compact(self):
+        keep = self.liveRows()
+        for name in self.COLUMNS:
+            column = getattr(self, name)
+            column[:len(keep)] = column[keep]
+        self.size = len(keep)
+        self.dead = 0
+
+
+# Transport subsystem for the supply chain. Shipments in transit are held in a
+# supplyChainShipmentStore and on a calendar (a heap per target, ordered by
+# arrival timestep), not on the graph edges, so delivering a timestep's
+# shipments costs O(arrivals). Delivered shipments leave the store; with
+# keepHistory they are appended to the history store (for exportAsGeneric),
+# otherwise the transport's memory stays flat however long the run.
+class supplyChainTransport(object):
+    def __init__(self, supplyChain, keepHistory=False):
+        self.supplyChain = supplyChain
+        self.actors = [] # Actors by index, as used in the stores.
+        self.actorIndex = dict()
+        self.products = [] # Products by index.
+        self.productIndex = dict()
+        self.shipments = supplyChainShipmentStore() # Shipments in transit.
+        self.history = supplyChainShipmentStore() if keepHistory else None # Shipments delivered.
+        self.calendar = dict() # Keyed by target; heaps of (arrivalTime, sequence).
+        self.live = dict() # Sequence -> row in self.shipments, for shipments in transit.
+        self.liveKeys = dict() # (origin, target, timeWhenShipped) -> sequence, for shipments in transit.
+        self.sequence = 0 # Tie-break so that arrivals are delivered in the order shipped.
+        self.edgeRows = None # Cached rows of each edge, see edgeShipments.
+
+    def __repr__(self):
+        return "supplyChainTransport(inTransit=%r)" % (self.inTransit)
+
+    @property
+    def inTransit(self):
+        return len(self.live)
+
+    def actorId(self, actor):
+        index = self.actorIndex.get(actor)
+        if index is None:
+            index = self.actorIndex[actor] = len(self.actors)
+            self.actors.append(actor)
+        return index
+
+    def productId(self, product):
+        index = self.productIndex.get(product)
+        if index is None:
+            index = self.productIndex[product] = len(self.products)
+            self.products.append(product)
+        return index
+
+    # Place a shipment on the edge origin -> target. It arrives once it has spent
+    # timeToTraverse timesteps on the edge.
+    def ship(self, origin, target, quantity, product, timeWhenShipped):
+        timeToTraverse = self.supplyChain[origin][target].get('timeToTraverse',0)
+        currentTime = self.supplyChain.currentTime
+        self.place(origin, target, quantity, product, timeWhenShipped, currentTime,
+                   currentTime + max(int(math.ceil(timeToTraverse)), 0))
+
+    # Put a shipment in transit, to arrive at timestep /arrivalTime/. As when
+    # shipments were stored on the edge under (timeWhenShipped, origin, target),
+    # a second shipment with the same key replaces the first.
+    def place(self, origin, target, quantity, product, timeWhenShipped, timePlaced, arrivalTime):
+        key = (origin, target, timeWhenShipped)
+        previous = self.liveKeys.get(key)
+        if previous is not None:
+            self.shipments.kill(self.live.pop(previous))
+        sequence = self.sequence
+        self.sequence += 1
+        self.live[sequence] = self.shipments.append(self.actorId(origin), self.actorId(target), self.productId(product),
+            timeWhenShipped, timePlaced, arrivalTime, -1, quantity, sequence)
+        self.liveKeys[key] = sequence
+        heapq.heappush(self.calendar.setdefault(target, []), (arrivalTime, sequence))
+        self.edgeRows = None
+
+    # Record a shipment that was delivered at /timeReceived/, if history is kept.
+    def recordDelivered(self, origin, target, quantity, product, timeWhenShipped, timePlaced, arrivalTime, timeReceived):
+        if self.history is not None:
+            self.history.append(self.actorId(origin), self.actorId(target), self.productId(product),
+                timeWhenShipped, timePlaced, arrivalTime, timeReceived, quantity, self.sequence)
+            self.sequence += 1
+            self.edgeRows = None
+
+    # Remove and return the shipments that have reached /target/ by timestep /currentTime/.
+    def arrivals(self, target, currentTime):
+        queue = self.calendar.get(target)
+        arrived = []
+        store = self.shipments
+        while queue and queue[0][0] <= currentTime:
+            __, sequence = heapq.heappop(queue)
+            row = self.live.pop(sequence, None)
+            if row is None:
+                # Superseded by a later shipment under the same key.
+                continue
+            shipment = supplyChainShipment(store.timeWhenShipped.item(row), self.actors[store.origin.item(row)],
+                target, store.quantity.item(row), self.products[store.product.item(row)])
+            shipment.timePlaced = store.timePlaced.item(row)
+            shipment.arrivalTime = store.arrivalTime.item(row)
+            shipment.timeReceived = currentTime
+            shipment.sequence = sequence
+            del self.liveKeys[(shipment.origin, target, shipment.timeWhenShipped)]
+            self.recordDelivered(shipment.origin, target, shipment.quantity, shipment.product,
+                shipment.timeWhenShipped, shipment.timePlaced, shipment.arrivalTime, currentTime)
+            store.kill(row)
+            arrived.append(shipment)
+        if store.dead > max(len(store), 64):
+            self.compact()
+        return arrived
+
+    # Drop delivered and superseded shipments from the in-transit store.
+    def compact(self):
+        self.shipments.compact()
+        self.live = dict(zip(self.shipments.sequence[:self.shipments.size].tolist(), range(self.shipments.size)))
+        self.edgeRows = None
+
+    # Rows of the history and in-transit stores along each edge, keyed by
+    # (origin index, target index).
+    def groupEdgeRows(self):
+        if self.edgeRows is None:
+            self.edgeRows = []
+            for store in [self.history, self.shipments]:
+                rows = collections.defaultdict(list)
+                if store is not None:
+                    live = store.liveRows()
+                    for row, origin, target in zip(live.tolist(), store.origin[live].tolist(), store.target[live].tolist()):
+                        rows[(origin, target)].append(row)
+                self.edgeRows.append(rows)
+        return self.edgeRows
+
+    # Shipments made along the edge origin -> target, in the old edge attribute form
+    # {(timeWhenShipped, origin, target): (timeOnEdge, quantity, product)}.
+    # Delivered shipments (if history is kept) have their timeOnEdge offset by -simulationLength.
+    def edgeShipments(self, origin, target):
+        currentTime = self.supplyChain.currentTime
+        edata = dict()
+        key = (self.actorIndex.get(origin), self.actorIndex.get(target))
+        deliveredRows, transitRows = self.groupEdgeRows()
+        for row in deliveredRows.get(key, ()):
+            timeOnEdge = currentTime - self.history.timeReceived.item(row) - self.supplyChain.simulationLength
+            edata[(self.history.timeWhenShipped.item(row), origin, target)] = (timeOnEdge,
+                self.history.quantity.item(row), self.products[self.history.product.item(row)])
+        for row in transitRows.get(key, ()):
+            timeOnEdge = currentTime - self.shipments.timePlaced.item(row)
+            edata[(self.shipments.timeWhenShipped.item(row), origin, target)] = (timeOnEdge,
+                self.shipments.quantity.item(row), self.products[self.shipments.product.item(row)])
+        return edata
+
+
 # A product in the supply chain
 class supplyChainProduct(object):
     def __init__(self,name,mass=1,warehouseSize=1,value=1,shippingSize=-1,
@@ -152,79 +646,875 @@ class supplyChainProduct(object):
         return self.stockists[supplyChainNetwork]
 
 
+# Compact time-series record keeping for the supply chain actors.
+# Replaces the old per-timestep lists of dicts: values live in a single
+# (time x counterparty x product) integer array, with index maps from
+# counterparties and products to array positions. Keys are exactly as the
+# old dicts were keyed, i.e. (counterparty, product) tuples (including the
+# 'allNodes'/'allProducts' aggregates) or, for productKeyed ledgers, bare
+# products. The final row (index simulationLength) holds the time totals.
+class supplyChainLedger(object):
+    MISSING = np.iinfo(np.int64).min # Marks a cell in which nothing has been recorded.
+
+    def __init__(self, simulationLength, productKeyed=False):
+        self.simulationLength = simulationLength
+        self.productKeyed = productKeyed # (bool) Keyed by product alone rather than (counterparty, product).
+        self.nodeIndex = dict() # Counterparty -> position on axis 1.
+        self.productIndex = dict() # Product -> position on axis 2.
+        self.nodes = [] # Counterparties in index order.
+        self.products = [] # Products in index order.
+        self.keyIndex = dict() # Key -> (axis 1, axis 2) position, so each access is one lookup.
+        self.aggregateIndex = dict() # (counterparty, product) -> positions of it and its aggregates.
+        if self.productKeyed:
+            self.nodeIndex[None] = 0
+            self.nodes.append(None)
+        # The store starts empty, and grows as keys are recorded.
+        self.data = np.empty((self._rowCount(), len(self.nodes), 0), dtype=np.int64)
+        # Last-written index: for every key, the two most recent (distinct) times
+        # below the totals row at which a value was recorded, or -1. This lets
+        # findPrev answer carry-forward queries without walking back in time.
+        self.lastWritten = np.empty(self.data.shape[1:], dtype=np.int64)
+        self.prevWritten = np.empty(self.data.shape[1:], dtype=np.int64)
+
+    def __repr__(self):
+        return "supplyChainLedger(counterparties=%r, products=%r)" % (len(self.nodes), len(self.products))
+
+    # Row-style access, ledger[t], behaving like the old per-timestep dict.
+    def __getitem__(self, t):
+        return supplyChainLedgerRow(self, t % (self.simulationLength + 1))
+
+    def __len__(self):
+        return self.simulationLength + 1
+
+    # Rows of the store: one per timestep, and the totals row.
+    def _rowCount(self):
+        return self.simulationLength + 1
+
+    # Grow the store so it can hold at least /nodeCount/ counterparties and
+    # /productCount/ products.
+    def _grow(self, nodeCount, productCount):
+        shape = list(self.data.shape)
+        for axis, size in [(1, nodeCount), (2, productCount)]:
+            if size > shape[axis]:
+                shape[axis] = max(size, 2*shape[axis])
+        # Most ledgers grow once, from empty, with nothing to copy over.
+        copy = self.data.size > 0
+        newData = np.empty(shape, dtype=np.int64)
+        newData.fill(self.MISSING)
+        if copy:
+            newData[:, :self.data.shape[1], :self.data.shape[2]] = self.data
+        self.data = newData
+        for name in ['lastWritten', 'prevWritten']:
+            oldIndex = getattr(self, name)
+            newIndex = np.empty(shape[1:], dtype=np.int64)
+            newIndex.fill(-1)
+            if copy:
+                newIndex[:oldIndex.shape[0], :oldIndex.shape[1]] = oldIndex
+            setattr(self, name, newIndex)
+
+    def _splitKey(self, key):
+        if self.productKeyed:
+            return None, key
+        return key
+
+    # Array position of /key/, or None if it has never been recorded.
+    def _position(self, key):
+        return self.keyIndex.get(key)
+
+    # Array position of /key/, creating index entries as required.
+    def _createPosition(self, key):
+        pos = self.keyIndex.get(key)
+        if pos is not None:
+            return pos
+        node, product = self._splitKey(key)
+        nodePos = self.nodeIndex.get(node)
+        if nodePos is None:
+            nodePos = self.nodeIndex[node] = len(self.nodes)
+            self.nodes.append(node)
+        productPos = self.productIndex.get(product)
+        if productPos is None:
+            productPos = self.productIndex[product] = len(self.products)
+            self.products.append(product)
+        if nodePos >= self.data.shape[1] or productPos >= self.data.shape[2]:
+            self._grow(nodePos + 1, productPos + 1)
+        pos = self.keyIndex[key] = (nodePos, productPos)
+        return pos
+
+    # Array positions of /keys/, creating index entries as required, and
+    # growing the store at most once.
+    def _createPositions(self, keys):
+        positions = []
+        for key in keys:
+            pos = self.keyIndex.get(key)
+            if pos is None:
+                node, product = self._splitKey(key)
+                nodePos = self.nodeIndex.get(node)
+                if nodePos is None:
+                    nodePos = self.nodeIndex[node] = len(self.nodes)
+                    self.nodes.append(node)
+                productPos = self.productIndex.get(product)
+                if productPos is None:
+                    productPos = self.productIndex[product] = len(self.products)
+                    self.products.append(product)
+                pos = self.keyIndex[key] = (nodePos, productPos)
+            positions.append(pos)
+        if len(self.nodes) > self.data.shape[1] or len(self.products) > self.data.shape[2]:
+            self._grow(len(self.nodes), len(self.products))
+        return positions
+
+    # Take on the counterparties, products and keys of /ledger/, so ledgers
+    # kept for the same pairs resolve their keys once between them, and with
+    # /values/, everything recorded in it too. A ledger that already holds
+    # keys keeps its own, and returns False.
+    def copyLayout(self, ledger, values=False):
+        if self.keyIndex or self.productKeyed != ledger.productKeyed or type(self) != type(ledger):
+            return False
+        self.nodeIndex = dict(ledger.nodeIndex)
+        self.productIndex = dict(ledger.productIndex)
+        self.nodes = list(ledger.nodes)
+        self.products = list(ledger.products)
+        self.keyIndex = dict(ledger.keyIndex)
+        self.aggregateIndex = dict(ledger.aggregateIndex)
+        if values:
+            self._copyStore(ledger)
+        else:
+            self._grow(len(self.nodes), len(self.products))
+        return True
+
+    def _copyStore(self, ledger):
+        self.data = ledger.data.copy()
+        self.lastWritten = ledger.lastWritten.copy()
+        self.prevWritten = ledger.prevWritten.copy()
+
+    def has(self, t, key):
+        pos = self.keyIndex.get(key)
+        return pos is not None and self.data.item(t, pos[0], pos[1]) != self.MISSING
+
+    # get, set and add are called for every order and shipment, so they
+    # work from keyIndex directly.
+    def get(self, t, key, default=0):
+        pos = self.keyIndex.get(key)
+        if pos is None:
+            return default
+        value = self.data.item(t, pos[0], pos[1])
+        if value == self.MISSING:
+            return default
+        return value
+
+    def set(self, t, key, value):
+        pos = self.keyIndex.get(key)
+        if pos is None:
+            pos = self._createPosition(key)
+        self._setAt(t, pos, value)
+
+    def add(self, t, key, quantity):
+        pos = self.keyIndex.get(key)
+        if pos is None:
+            pos = self._createPosition(key)
+        self._addAt(t, pos, quantity)
+
+    # set and add, given the array position. Most writes are to a key
+    # already written at t, which leaves the last-written index as it is.
+    def _setAt(self, t, pos, value):
+        nodePos, productPos = pos
+        self.data.itemset(t, nodePos, productPos, value)
+        if t < self.simulationLength and t != self.lastWritten.item(nodePos, productPos):
+            self._noteWrite(nodePos, productPos, t)
+
+    def _addAt(self, t, pos, quantity):
+        nodePos, productPos = pos
+        value = self.data.item(t, nodePos, productPos)
+        self.data.itemset(t, nodePos, productPos, (0 if value == self.MISSING else value) + quantity)
+        if t < self.simulationLength and t != self.lastWritten.item(nodePos, productPos):
+            self._noteWrite(nodePos, productPos, t)
+
+    # Set every key in /keys/ to /value/ at each of /times/.
+    def setMany(self, times, keys, value):
+        positions = self._createPositions(keys)
+        data = self.data
+        value = int(value)
+        for t in times:
+            for pos in positions:
+                data.itemset((t,) + pos, value)
+                if t < self.simulationLength:
+                    lastTime = self.lastWritten.item(pos)
+                    if t > lastTime:
+                        self.prevWritten.itemset(pos, lastTime)
+                        self.lastWritten.itemset(pos, t)
+                    elif t < lastTime:
+                        self._noteWrite(pos[0], pos[1], t)
+
+    # Keep the last-written index up to date following a write at time t.
+    def _noteWrite(self, nodePos, productPos, t):
+        lastTime = self.lastWritten.item(nodePos, productPos)
+        if t > lastTime:
+            self.prevWritten.itemset((nodePos, productPos), lastTime)
+            self.lastWritten.itemset((nodePos, productPos), t)
+        elif t < lastTime and t > self.prevWritten.item(nodePos, productPos):
+            self.prevWritten.itemset((nodePos, productPos), t)
+
+    # Rebuild the last-written index for one key from the stored values.
+    def _reindex(self, nodePos, productPos):
+        recorded = np.flatnonzero(self.data[:self.simulationLength, nodePos, productPos] != self.MISSING)
+        self.lastWritten.itemset((nodePos, productPos), recorded[-1] if len(recorded) > 0 else -1)
+        self.prevWritten.itemset((nodePos, productPos), recorded[-2] if len(recorded) > 1 else -1)
+
+    # Array positions of (counterparty, product) and of its node, product
+    # and node+product aggregates, resolved once per pair.
+    def aggregatePositions(self, counterparty, product):
+        positions = self.aggregateIndex.get((counterparty, product))
+        if positions is None:
+            keys = [(counterparty, product), ('allNodes', product), (counterparty, 'allProducts'), ('allNodes', 'allProducts')]
+            positions = self.aggregateIndex[(counterparty, product)] = tuple(self._createPosition(key) for key in keys)
+        return positions
+
+    # Record /quantity/ for (counterparty, product) at time t, in place of
+    # what is recorded there (or, with /add/, added to it), and add it to
+    # the time total and to the aggregates (see updateAggregatesTemporal).
+    # record and carry run for every order and shipment, so each works
+    # from the positions of the pair and its aggregates.
+    def record(self, t, counterparty, product, quantity, add=False):
+        positions = self.aggregateIndex.get((counterparty, product)) or self.aggregatePositions(counterparty, product)
+        if add:
+            self._addAt(t, positions[0], quantity)
+        else:
+            self._setAt(t, positions[0], quantity)
+        self._addAggregates(t, positions, quantity)
+
+    # Carry the value of (counterparty, product), and of its aggregates,
+    # forward to time t, plus /quantity/ (see updateAggregatesPersistent).
+    def carry(self, t, counterparty, product, quantity):
+        positions = self.aggregateIndex.get((counterparty, product)) or self.aggregatePositions(counterparty, product)
+        self._carry(t, positions, quantity)
+
+    def addAggregates(self, t, counterparty, product, quantity):
+        self._addAggregates(t, self.aggregatePositions(counterparty, product), quantity)
+
+    def carryAggregates(self, t, counterparty, product, quantity):
+        self._carry(t, self.aggregatePositions(counterparty, product)[1:], quantity)
+
+    # Add /quantity/ to the time total of the pair at positions[0], and to
+    # its aggregates, at positions[1:], both at time t and in the time totals.
+    def _addAggregates(self, t, positions, quantity):
+        item, itemset = self.data.item, self.data.itemset
+        missing = self.MISSING
+        totals = self.simulationLength
+        nodePos, productPos = positions[0]
+        value = item(totals, nodePos, productPos)
+        itemset(totals, nodePos, productPos, (0 if value == missing else value) + quantity)
+        for nodePos, productPos in positions[1:]:
+            value = item(t, nodePos, productPos)
+            itemset(t, nodePos, productPos, (0 if value == missing else value) + quantity)
+            value = item(totals, nodePos, productPos)
+            itemset(totals, nodePos, productPos, (0 if value == missing else value) + quantity)
+            if t < totals:
+                lastTime = self.lastWritten.item(nodePos, productPos)
+                if t > lastTime:
+                    self.prevWritten.itemset(nodePos, productPos, lastTime)
+                    self.lastWritten.itemset(nodePos, productPos, t)
+                elif t < lastTime:
+                    self._noteWrite(nodePos, productPos, t)
+
+    # Set the keys at /positions/ at time t to their previous values (carried
+    # forward to t) plus /quantity/.
+    def _carry(self, t, positions, quantity):
+        if t >= self.simulationLength:
+            for pos in positions:
+                self._setAt(t, pos, noneToZero(self._prevAt(pos, t)[0]) + quantity)
+            return
+        item, itemset = self.data.item, self.data.itemset
+        lastWritten = self.lastWritten
+        for nodePos, productPos in positions:
+            lastTime = lastWritten.item(nodePos, productPos)
+            if lastTime < 0:
+                value = 0
+            elif lastTime <= t:
+                value = item(lastTime, nodePos, productPos)
+            else:
+                value = noneToZero(self._prevAt((nodePos, productPos), t)[0])
+            itemset(t, nodePos, productPos, value + quantity)
+            if t > lastTime:
+                self.prevWritten.itemset(nodePos, productPos, lastTime)
+                lastWritten.itemset(nodePos, productPos, t)
+            elif t < lastTime:
+                self._noteWrite(nodePos, productPos, t)
+
+    def delete(self, t, key):
+        pos = self._position(key)
+        if pos is not None:
+            self.data.itemset((t, pos[0], pos[1]), self.MISSING)
+            if t < self.simulationLength:
+                self._reindex(pos[0], pos[1])
+
+    # Value accumulated in the final (time totals) row.
+    def total(self, key, default=0):
+        return self.get(self.simulationLength, key, default)
+
+    # Array positions (on axis 2) of the products /keys/ of a productKeyed
+    # ledger, for getAt, creating index entries as required.
+    def positions(self, keys):
+        assert self.productKeyed
+        return np.array([self._createPosition(key)[1] for key in keys], dtype=np.int64)
+
+    # Values at time t of the products at /positions/, as an array, with
+    # /default/ where nothing is recorded.
+    def getAt(self, t, positions, default=0):
+        values = self.data[t, 0, positions]
+        values[values == self.MISSING] = default
+        return values
+
+    # Dictionary of everything recorded at time t.
+    def row(self, t):
+        values = dict()
+        recorded = np.argwhere(self.data[t] != self.MISSING)
+        for nodePos, productPos in recorded:
+            if self.productKeyed:
+                key = self.products[productPos]
+            else:
+                key = (self.nodes[nodePos], self.products[productPos])
+            values[key] = self.data.item(t, nodePos, productPos)
+        return values
+
+    # Copy everything recorded at time /source/ over to time /target/. It is
+    # used on inventories, of a handful of products, so goes key by key.
+    def copyRow(self, source, target):
+        data = self.data
+        for nodePos, productPos in self.keyIndex.itervalues():
+            value = data.item(source, nodePos, productPos)
+            if value != self.MISSING:
+                data.itemset((target, nodePos, productPos), value)
+                if target < self.simulationLength:
+                    self._noteWrite(nodePos, productPos, target)
+
+    # Most recent value recorded for /key/ at or before /startTime/,
+    # returning (value, time), or (None, 0) if there is none.
+    def findPrev(self, key, startTime):
+        assert startTime >= 0
+        pos = self.keyIndex.get(key)
+        if pos is None:
+            return None, 0
+        return self._prevAt(pos, startTime)
+
+    # findPrev, given the array position.
+    def _prevAt(self, pos, startTime):
+        nodePos, productPos = pos
+        if startTime >= self.simulationLength:
+            value = self.data.item(self.simulationLength, nodePos, productPos)
+            if value != self.MISSING:
+                return value, self.simulationLength
+            startTime = self.simulationLength - 1
+        # Constant time answers from the last-written index.
+        prevTime = self.lastWritten.item(nodePos, productPos)
+        if prevTime > startTime:
+            prevTime = self.prevWritten.item(nodePos, productPos)
+        if prevTime < 0:
+            return None, 0
+        if prevTime <= startTime:
+            return self.data.item(prevTime, nodePos, productPos), prevTime
+        # Looking further back than the index covers.
+        recorded = np.flatnonzero(self.data[:startTime + 1, nodePos, productPos] != self.MISSING)
+        if len(recorded) == 0:
+            return None, 0
+        prevTime = int(recorded[-1])
+        return self.data.item(prevTime, nodePos, productPos), prevTime
+
+    # First value recorded for /key/ at or after /startTime/, returning
+    # (value, time), or (None, stopTime + 1) if nothing is recorded up to
+    # and including stopTime + 1.
+    def findNext(self, key, startTime, stopTime):
+        pos = self._position(key)
+        if pos is None:
+            return None, stopTime + 1
+        recorded = np.flatnonzero(self.data[startTime:max(startTime, stopTime + 1) + 1, pos[0], pos[1]] != self.MISSING)
+        if len(recorded) == 0:
+            return None, stopTime + 1
+        nextTime = startTime + int(recorded[0])
+        return self.data.item(nextTime, pos[0], pos[1]), nextTime
+
+    # Bytes held by the store.
+    def nbytes(self):
+        return self.data.nbytes
+
+
+# A dict-like view of one row of a supplyChainLedger.
+class supplyChainLedgerRow(object):
+    def __init__(self, ledger, t):
+        self.ledger = ledger
+        self.t = t
+
+    def __getitem__(self, key):
+        value = self.ledger.get(self.t, key, None)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.ledger.set(self.t, key, value)
+
+    def __delitem__(self, key):
+        self.ledger.delete(self.t, key)
+
+    def __contains__(self, key):
+        return self.ledger.has(self.t, key)
+
+    def __len__(self):
+        return len(self.ledger.row(self.t))
+
+    def __eq__(self, other):
+        return self.ledger.row(self.t) == dict(other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return repr(self.ledger.row(self.t))
+
+    def get(self, key, default=None):
+        return self.ledger.get(self.t, key, default)
+
+    def copy(self):
+        return self.ledger.row(self.t)
+
+    def keys(self):
+        return self.ledger.row(self.t).keys()
+
+    def items(self):
+        return self.ledger.row(self.t).items()
+
+    def iteritems(self):
+        return self.ledger.row(self.t).iteritems()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+
+# A supplyChainLedger holding only the latest /window/ timesteps, and the
+# totals row, for long runs (see supplyChainNetwork's historyWindow).
+# Timestep t is kept in row t % window until timestep t + window is
+# written over it. The last two values recorded for every key are kept as
+# well, so findPrev still answers carry-forward queries (outstanding
+# orders, say) however long ago the key was written. Otherwise a timestep
+# that has left the window reads as if nothing were recorded at it, and
+# writing to one raises ValueError.
+class supplyChainWindowedLedger(supplyChainLedger):
+    def __init__(self, simulationLength, productKeyed=False, window=2):
+        if window < 2:
+            raise ValueError('A ledger window must hold at least 2 timesteps, not %r' % (window,))
+        self.window = window
+        supplyChainLedger.__init__(self, simulationLength, productKeyed)
+        self.rowTime = np.empty(window, dtype=np.int64) # Timestep held in each row.
+        self.rowTime.fill(self.MISSING)
+        # Values recorded at the lastWritten and prevWritten times.
+        self.lastValue = np.zeros(self.lastWritten.shape, dtype=np.int64)
+        self.prevValue = self.lastValue.copy()
+
+    def __repr__(self):
+        return "supplyChainWindowedLedger(counterparties=%r, products=%r, window=%r)" % (len(self.nodes), len(self.products), self.window)
+
+    def _rowCount(self):
+        return self.window + 1
+
+    def _grow(self, nodeCount, productCount):
+        supplyChainLedger._grow(self, nodeCount, productCount)
+        for name in ['lastValue', 'prevValue']:
+            oldValues = getattr(self, name)
+            newValues = np.zeros(self.lastWritten.shape, dtype=np.int64)
+            if oldValues.size > 0:
+                newValues[:oldValues.shape[0], :oldValues.shape[1]] = oldValues
+            setattr(self, name, newValues)
+
+    # Row holding timestep t, or None if it is not held. With /write/, the
+    # oldest timestep is dropped to make room for t.
+    def _row(self, t, write=False):
+        if t == self.simulationLength:
+            return self.window
+        row = t % self.window
+        rowTime = self.rowTime.item(row)
+        if rowTime == t:
+            return row
+        if not write:
+            return None
+        if t < rowTime:
+            raise ValueError('Timestep %r has left the window of the last %r timesteps' % (t, self.window))
+        self.data[row].fill(self.MISSING)
+        self.rowTime.itemset(row, t)
+        return row
+
+    def has(self, t, key):
+        pos = self._position(key)
+        row = self._row(t)
+        return pos is not None and row is not None and self.data.item(row, pos[0], pos[1]) != self.MISSING
+
+    def get(self, t, key, default=0):
+        pos = self._position(key)
+        if pos is None:
+            return default
+        if t == self.simulationLength:
+            row = self.window
+        else:
+            row = t % self.window
+            if self.rowTime.item(row) != t:
+                return default
+        value = self.data.item(row, pos[0], pos[1])
+        if value == self.MISSING:
+            return default
+        return value
+
+    def _setAt(self, t, pos, value):
+        value = int(value)
+        if t == self.simulationLength:
+            self.data.itemset((self.window,) + pos, value)
+            return
+        row = t % self.window
+        if self.rowTime.item(row) != t:
+            row = self._row(t, True)
+        self.data.itemset((row,) + pos, value)
+        self._noteValue(pos, t, value)
+
+    def _addAt(self, t, pos, quantity):
+        if t == self.simulationLength:
+            row = self.window
+        else:
+            row = t % self.window
+            if self.rowTime.item(row) != t:
+                row = self._row(t, True)
+        value = self.data.item((row,) + pos)
+        value = int((0 if value == self.MISSING else value) + quantity)
+        self.data.itemset((row,) + pos, value)
+        if row != self.window:
+            self._noteValue(pos, t, value)
+
+    def _copyStore(self, ledger):
+        supplyChainLedger._copyStore(self, ledger)
+        self.rowTime = ledger.rowTime.copy()
+        self.lastValue = ledger.lastValue.copy()
+        self.prevValue = ledger.prevValue.copy()
+
+    # Only the rows held are written, through _addAt, _setAt and _prevAt.
+    def setMany(self, times, keys, value):
+        positions = self._createPositions(keys)
+        for t in times:
+            for pos in positions:
+                self._setAt(t, pos, value)
+
+    def _addAggregates(self, t, positions, quantity):
+        self._addAt(self.simulationLength, positions[0], quantity)
+        for pos in positions[1:]:
+            self._addAt(t, pos, quantity)
+            self._addAt(self.simulationLength, pos, quantity)
+
+    def _carry(self, t, positions, quantity):
+        for pos in positions:
+            self._setAt(t, pos, noneToZero(self._prevAt(pos, t)[0]) + quantity)
+
+    # As _noteWrite, also keeping the values at the last-written times.
+    def _noteValue(self, pos, t, value):
+        lastTime = self.lastWritten.item(pos)
+        if t == lastTime:
+            self.lastValue.itemset(pos, value)
+        elif t > lastTime:
+            self.prevWritten.itemset(pos, lastTime)
+            self.prevValue.itemset(pos, self.lastValue.item(pos))
+            self.lastWritten.itemset(pos, t)
+            self.lastValue.itemset(pos, value)
+        elif t >= self.prevWritten.item(pos):
+            self.prevWritten.itemset(pos, t)
+            self.prevValue.itemset(pos, value)
+
+    # Only the timesteps still held can be searched again.
+    def _reindex(self, nodePos, productPos):
+        held = sorted((self.rowTime.item(row), row) for row in range(self.window)
+                      if self.rowTime.item(row) != self.MISSING and self.data.item(row, nodePos, productPos) != self.MISSING)
+        self.lastWritten.itemset((nodePos, productPos), -1)
+        self.prevWritten.itemset((nodePos, productPos), -1)
+        for t, row in held[-2:]:
+            self._noteValue((nodePos, productPos), t, self.data.item(row, nodePos, productPos))
+
+    def delete(self, t, key):
+        pos = self._position(key)
+        row = self._row(t)
+        if pos is not None and row is not None:
+            self.data.itemset((row, pos[0], pos[1]), self.MISSING)
+            if t < self.simulationLength:
+                self._reindex(pos[0], pos[1])
+
+    def getAt(self, t, positions, default=0):
+        row = self._row(t)
+        if row is None:
+            values = np.empty(len(positions), dtype=np.int64)
+            values.fill(default)
+            return values
+        values = self.data[row, 0, positions]
+        values[values == self.MISSING] = default
+        return values
+
+    def row(self, t):
+        row = self._row(t)
+        if row is None:
+            return dict()
+        return supplyChainLedger.row(self, row)
+
+    def copyRow(self, source, target):
+        sourceRow = self._row(source)
+        if sourceRow is None:
+            return
+        targetRow = self._row(target, True)
+        recorded = self.data[sourceRow] != self.MISSING
+        self.data[targetRow][recorded] = self.data[sourceRow][recorded]
+        if target < self.simulationLength:
+            for pos in map(tuple, np.argwhere(recorded).tolist()):
+                self._noteValue(pos, target, self.data.item((targetRow,) + pos))
+
+    def _prevAt(self, pos, startTime):
+        if startTime >= self.simulationLength:
+            value = self.data.item(self.window, pos[0], pos[1])
+            if value != self.MISSING:
+                return value, self.simulationLength
+            startTime = self.simulationLength - 1
+        for prevTime, values in [(self.lastWritten.item(pos), self.lastValue), (self.prevWritten.item(pos), self.prevValue)]:
+            if prevTime < 0:
+                return None, 0
+            if prevTime <= startTime:
+                return values.item(pos), prevTime
+        # Looking further back, through the timesteps still held.
+        for prevTime in sorted(self.rowTime.tolist(), reverse=True):
+            if prevTime != self.MISSING and prevTime <= startTime:
+                value = self.data.item(self._row(prevTime), pos[0], pos[1])
+                if value != self.MISSING:
+                    return value, prevTime
+        return None, 0
+
+    def findNext(self, key, startTime, stopTime):
+        pos = self._position(key)
+        if pos is not None:
+            for nextTime in sorted(self.rowTime.tolist()):
+                if nextTime != self.MISSING and startTime <= nextTime <= max(startTime, stopTime + 1):
+                    value = self.data.item(self._row(nextTime), pos[0], pos[1])
+                    if value != self.MISSING:
+                        return value, nextTime
+        return None, stopTime + 1
+
+
+# A list of per-timestep values holding only the latest /window/ of them,
+# as supplyChainWindowedLedger does for ledgers. A timestep that is not
+# held reads as /default/ (or default(), if it can be called).
+class supplyChainHistory(object):
+    def __init__(self, window, default=None):
+        self.window = window
+        self.default = default
+        self.times = [None]*window # Timestep held in each slot.
+        self.values = [None]*window
+
+    def __repr__(self):
+        return "supplyChainHistory(window=%r)" % (self.window)
+
+    def __len__(self):
+        return self.window
+
+    def __getitem__(self, t):
+        slot = t % self.window
+        if self.times[slot] != t:
+            return self.default() if callable(self.default) else self.default
+        return self.values[slot]
+
+    def __setitem__(self, t, value):
+        slot = t % self.window
+        self.times[slot] = t
+        self.values[slot] = value
+
+
+# FIFO book of the orders a node has received for one product but not yet
+# shipped. Orders sit on a heap keyed by (orderTime, quantity, sequence), and
+# in a queue per customer so that shipments can draw down that customer's
+# oldest orders first. Filled orders leave the heap lazily.
+class supplyChainOrderBook(object):
+    def __init__(self):
+        self.heap = [] # Entries are [orderTime, quantity, sequence, customer, remaining].
+        self.byCustomer = dict() # Keyed by customer; deques of the same entries, oldest first.
+        self.sequence = 0
+        self.totalRemaining = 0
+
+    def __repr__(self):
+        return "supplyChainOrderBook(orders=%r,remaining=%r)" % (len(self), self.totalRemaining)
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.byCustomer.itervalues())
+
+    # Record an order of /quantity/ units from /customer/, made at /orderTime/.
+    def addOrder(self, customer, quantity, orderTime):
+        entry = [orderTime, quantity, self.sequence, customer, quantity]
+        self.sequence += 1
+        heapq.heappush(self.heap, entry)
+        self.byCustomer.setdefault(customer, collections.deque()).append(entry)
+        self.totalRemaining += quantity
+
+    # Draw /quantity/ units shipped to /customer/ down from its oldest orders.
+    # Returns the quantity shipped beyond what was on the book.
+    def consume(self, customer, quantity):
+        entries = self.byCustomer.get(customer)
+        while quantity > 0 and entries:
+            entry = entries[0]
+            filled = min(quantity, entry[4])
+            entry[4] -= filled
+            quantity -= filled
+            self.totalRemaining -= filled
+            if entry[4] == 0:
+                entries.popleft()
+        if entries is not None and not entries:
+            del self.byCustomer[customer]
+        return quantity
+
+    # The oldest order with something still to ship, or None.
+    def oldest(self):
+        heap = self.heap
+        while heap and heap[0][4] == 0:
+            heapq.heappop(heap)
+        return heap[0] if heap else None
+
+    # The oldest unfilled order from /customer/, or None.
+    def oldestFrom(self, customer):
+        entries = self.byCustomer.get(customer)
+        return entries[0] if entries else None
+
+    def outstanding(self, customer):
+        return sum(entry[4] for entry in self.byCustomer.get(customer, ()))
+
+    # Entries of the unfilled orders, oldest first.
+    def openOrders(self):
+        return sorted(entry for entries in self.byCustomer.itervalues() for entry in entries)
+
+    # Unfilled orders as (customer, orderTime, remaining, age), oldest first.
+    def backlog(self, currentTime):
+        return [(entry[3], entry[0], entry[4], currentTime - entry[0]) for entry in self.openOrders()]
+
+    # Age of the oldest unfilled order (0 if there are none).
+    def backlogAge(self, currentTime):
+        entry = self.oldest()
+        return currentTime - entry[0] if entry else 0
+
+
 def findPrevValueRecur(dictionary, targetNode, product, startTime):
     " Starting at startTime, goes to dictionary to find the most \
     recent value recorded for targetNode and product."
+    if isinstance(dictionary, supplyChainLedger):
+        return dictionary.findPrev((targetNode, product), startTime)
     assert startTime >= 0
-    currDict = dictionary[startTime]
-    prevVal = currDict.get((targetNode,product),False)
-    if prevVal is False and startTime == 0:
-        return None, 0
-    elif prevVal is False:
-        return findPrevValueRecur(dictionary, targetNode, product, startTime -1)
-    else:
-        return prevVal, startTime
+    # Walk back iteratively, so long histories can't hit the recursion limit.
+    for prevTime in xrange(startTime, -1, -1):
+        prevVal = dictionary[prevTime].get((targetNode,product),False)
+        if not prevVal is False:
+            return prevVal, prevTime
+    return None, 0
     
 def findNextValueRecur(dictionary, targetNode, product, startTime):
     " Starting at startTime, goes to dictionary to find the most \
     recent value recorded for targetNode and product"
     assert startTime >= 0 and startTime <= targetNode.supplyChain.simulationLength
-    currDict = dictionary[startTime]
-    nextVal = currDict.get((targetNode,product),False)
-    if (nextVal is False) and (startTime > targetNode.currentTime):
-        return None, targetNode.currentTime + 1
-    elif nextVal is False:
-        return findNextValueRecur(dictionary, targetNode, product, startTime +1)
-    else:
-        return nextVal, startTime
+    if isinstance(dictionary, supplyChainLedger):
+        return dictionary.findNext((targetNode, product), startTime, targetNode.currentTime)
+    for nextTime in xrange(startTime, max(startTime, targetNode.currentTime + 1) + 1):
+        nextVal = dictionary[nextTime].get((targetNode,product),False)
+        if not nextVal is False:
+            return nextVal, nextTime
+    return None, targetNode.currentTime + 1
 
 
 # Update aggregate records
-def updateAggregatesPersistent(thisNode,dictionary,currentTime,targetNode,product,quantity):
-    "Updates aggregate records for dictionaries where old values should be carried forward \
+def updateAggregatesPersistent(thisNode,ledger,currentTime,targetNode,product,quantity):
+    "Updates aggregate records for ledgers where old values should be carried forward \
     i.e. values which persist across time periods, e.g. outstanding orders."
-    
-    # Update nodes aggregate
-    prevValue = noneToZero(findPrevValueRecur(dictionary,'allNodes',product,currentTime)[0])
-    dictionary[currentTime][('allNodes',product)] = prevValue + quantity
-   
-    # Update products aggregate
-    prevValue = noneToZero(findPrevValueRecur(dictionary,targetNode,'allProducts',currentTime)[0])
-    dictionary[currentTime][(targetNode,'allProducts')] = prevValue + quantity
-    
-    # Update total aggregate
-    prevValue = noneToZero(findPrevValueRecur(dictionary,'allNodes','allProducts',currentTime)[0])
-    dictionary[currentTime][('allNodes','allProducts')] = prevValue + quantity
+    # Nodes, products and total aggregates.
+    ledger.carryAggregates(currentTime, targetNode, product, quantity)
     
 
 # Update aggregate records
-def updateAggregatesTemporal(thisNode,dictionary,currentTime,targetNode,product,quantity):
-    "Updates aggregate records for dictionaries where old values should NOT be carried forward."
-    # Final entry in array is used to store aggregates over time.
-    # Update time aggregates
-    SIMULATION_LENGTH = thisNode.supplyChain.simulationLength
-    prevValue = dictionary[SIMULATION_LENGTH].get((targetNode,product),0)
-    dictionary[SIMULATION_LENGTH][(targetNode, product)] = prevValue + quantity
-    # Get the dictionary for the current time period
-    currDict = dictionary[currentTime]
-    # Update nodes aggregate
-    prevValue = currDict.get(('allNodes',product),0)
-    dictionary[currentTime][('allNodes',product)] = prevValue + quantity
-    # Update node/time aggregates
-    prevValue = dictionary[SIMULATION_LENGTH].get(('allNodes',product),0)
-    dictionary[SIMULATION_LENGTH][('allNodes',product)] = prevValue + quantity
-    # Update products aggregate
-    prevValue = currDict.get((targetNode,'allProducts'),0)
-    dictionary[currentTime][(targetNode,'allProducts')] = prevValue + quantity
-    # Update product/time aggregates
-    prevValue = dictionary[SIMULATION_LENGTH].get((targetNode,'allProducts'),0)
-    dictionary[SIMULATION_LENGTH][(targetNode,'allProducts')] = prevValue + quantity
-    # Update node/product aggregate
-    prevValue = currDict.get(('allNodes','allProducts'),0)
-    dictionary[currentTime][('allNodes','allProducts')] = prevValue + quantity
-    # Update node/product/time aggregates
-    prevValue = dictionary[SIMULATION_LENGTH].get(('allNodes','allProducts'),0)
-    dictionary[SIMULATION_LENGTH][('allNodes','allProducts')] = prevValue + quantity
+def updateAggregatesTemporal(thisNode,ledger,currentTime,targetNode,product,quantity):
+    "Updates aggregate records for ledgers where old values should NOT be carried forward."
+    # Time aggregates (in the final row of the ledger), and node, product and
+    # node/product aggregates with their time aggregates.
+    ledger.addAggregates(currentTime, targetNode, product, quantity)
+
+# A node's buildInstructions as a sparse matrix: row i is the recipe for
+# outputs[i], column j is products[j] (the outputs, then the other
+# components), and each entry is the number of units of the column's
+# product that one unit of the row's output takes. Entries are held by row,
+# as arrays (rowStart, columns, quantities), and by column, as a list of
+# (row, column, quantity) entries for componentDemand, which the nodes call
+# every timestep on a handful of entries. Rows are in buildInstructions
+# order, which is the order products are built in.
+class supplyChainRecipeMatrix(object):
+    def __init__(self, buildInstructions):
+        self.outputs = list(buildInstructions)
+        self.products = list(self.outputs)
+        self.productIndex = dict((product, j) for j, product in enumerate(self.products))
+        rowStart, columns, quantities = [0], [], []
+        for product in self.outputs:
+            for component, quantity in buildInstructions[product].iteritems():
+                # Zero-use components never limit a build.
+                if quantity == 0:
+                    continue
+                if not component in self.productIndex:
+                    self.productIndex[component] = len(self.products)
+                    self.products.append(component)
+                columns.append(self.productIndex[component])
+                quantities.append(quantity)
+            rowStart.append(len(columns))
+        self.rowStart = np.array(rowStart, dtype=np.int64)
+        self.columns = np.array(columns, dtype=np.int64)
+        self.quantities = np.array(quantities, dtype=np.int64)
+        self.components = set(self.products[j] for j in columns)
+        # A recipe with no components builds nothing. As ever, a node only
+        # builds if one of its recipes has more than one component.
+        self.buildRows = []
+        if any(rowStart[i+1] - rowStart[i] > 1 for i in range(len(self.outputs))):
+            self.buildRows = [i for i in range(len(self.outputs)) if rowStart[i+1] > rowStart[i]]
+        self.changed = np.union1d(np.array(self.buildRows, dtype=np.int64), self.columns).tolist()
+        # Rows can be built all at once unless a component is shared or is itself built.
+        self.independent = len(set(columns)) == len(columns) and not any(j < len(self.outputs) for j in columns)
+        rows = np.repeat(np.arange(len(self.outputs)), np.diff(self.rowStart)).tolist()
+        self.entries = sorted(zip(rows, columns, quantities), key=itemgetter(1))
+
+    def __repr__(self):
+        return "supplyChainRecipeMatrix(outputs=%r,products=%r,entries=%r)" % (len(self.outputs), len(self.products), len(self.columns))
+
+    # Units of each output that /stock/ (a vector over products) has the
+    # components for: the least, over the recipe, of stock over quantity.
+    def buildCapacity(self, stock):
+        capacity = np.zeros(len(self.outputs), dtype=np.int64)
+        if self.buildRows:
+            ratios = stock[self.columns] // self.quantities
+            capacity[self.buildRows] = np.minimum.reduceat(ratios, self.rowStart[self.buildRows])
+        return capacity
+
+    # Units of each product (a list over products) taken to build
+    # /outputUnits/ (a sequence over outputs): the matrix-vector product.
+    def componentDemand(self, outputUnits):
+        demand = [0]*len(self.products)
+        for row, column, quantity in self.entries:
+            demand[column] += quantity*outputUnits[row]
+        return demand
+
+    # Build, in row order, as many of each output as /processingCapacity/
+    # (keyed by product) and /stock/ allow, taking the components out of
+    # /stock/ and adding the outputs to it. Returns the units built, by row.
+    def build(self, stock, processingCapacity):
+        built = np.zeros(len(self.outputs), dtype=np.int64)
+        if self.independent:
+            limit = np.array([processingCapacity[self.outputs[i]] for i in self.buildRows], dtype=np.int64)
+            built[self.buildRows] = np.minimum(self.buildCapacity(stock)[self.buildRows], limit)
+            stock -= self.componentDemand(built)
+            stock[:len(self.outputs)] += built
+            return built
+        for i in self.buildRows:
+            entries = slice(self.rowStart.item(i), self.rowStart.item(i+1))
+            columns = self.columns[entries]
+            quantities = self.quantities[entries]
+            units = min(processingCapacity[self.outputs[i]], (stock[columns] // quantities).min())
+            stock[columns] -= units*quantities
+            stock[i] += units
+            built[i] = units
+        return built
+
 
 # Class for the actors in the supply chain
 
@@ -259,33 +1549,35 @@ class supplyChainNode(object):
         
         
         # Initialise some attributes for record keeping.
-        self.inventory = [dict() for x in range(self.simulationLength + 1)] # Inventory array (by time) of dicts (each keyed by product)
-        self.oldestOrder = dict((product, dict()) for product in self.products) # Dict of dicts, first keyed on product, second keyed on node. Stores time of oldest outstanding orders
-        self.oldestOrderLastCall = -1 # Currently unused, potential optimisation
+        self.inventory = self.supplyChain.newLedger(productKeyed=True) # Inventory ledger (by time and product)
+        self.orderBook = dict((product, supplyChainOrderBook()) for product in self.products) # Unfilled orders received, keyed by product.
         self.myHash = hash((self.name, self.supplyChain.name)) # To allow use as keys in dictionaries, etc.
-        self.unitsBuilt = [dict() for x in range(self.simulationLength + 1)] # Record of number of units built.
-        self.overstock = [dict() for x in range(self.simulationLength + 1)] # Record of items discarded due to lack of warehousing.
-        self.salesLost = [dict() for x in range(self.simulationLength + 1)] # Record of sales lost due to lack of inventory.
+        self.unitsBuilt = self.supplyChain.newLedger(productKeyed=True) # Record of number of units built.
+        self.overstock = self.supplyChain.newLedger(productKeyed=True) # Record of items discarded due to lack of warehousing.
+        self.salesLost = self.supplyChain.newLedger() # Record of sales lost due to lack of inventory.
         self.stockistPreferences = dict((product,dict()) for product in self.products)
         
         self.depth = None
         self.health = 1.0
+        self.neighboursVersion = None # Network structureVersion when upstream and downstream were found.
         
         # Initialise current stock to safety threshold
         for product in self.products:
-            self.inventory[self.currentTime][product] = self.targetInventory.get(product,0)
+            self.inventory.set(self.currentTime, product, self.targetInventory.get(product,0))
             self.storageInUse += self.targetInventory.get(product,0)*product.warehouseSize
             # Let supplyChainNetwork know you are a stockist for /product/
             # self.supplyChain.addStockist(product,self)
+        self.recipes = supplyChainRecipeMatrix(self.buildInstructions) # buildInstructions, compiled for buildProducts and calculateDeficit.
+        self.recipeStock = self.inventory.positions(self.recipes.products) # Inventory positions of the recipe products.
 
         # Initialise core dictionaries for record keeping
-        self.ordersMade = [dict() for x in range(self.simulationLength + 1)]
-        self.downstreamOutstanding = [dict() for x in range(self.simulationLength + 1)]
-        self.shipmentsReceived = [dict() for x in range(self.simulationLength + 1)]
-        self.ordersReceived = [dict() for x in range(self.simulationLength + 1)]
-        self.upstreamOutstanding = [dict() for x in range(self.simulationLength + 1)]
-        self.shipmentsMade = [dict() for x in range(self.simulationLength + 1)]
-        self.unitsSold = [dict() for x in range(self.simulationLength + 1)]
+        self.ordersMade = self.supplyChain.newLedger()
+        self.downstreamOutstanding = self.supplyChain.newLedger()
+        self.shipmentsReceived = self.supplyChain.newLedger()
+        self.ordersReceived = self.supplyChain.newLedger()
+        self.upstreamOutstanding = self.supplyChain.newLedger()
+        self.shipmentsMade = self.supplyChain.newLedger()
+        self.unitsSold = self.supplyChain.newLedger(productKeyed=True)
 
     # Human readable __repr__
     def __repr__(self):
@@ -305,8 +1597,7 @@ class supplyChainNode(object):
         
         # Note the slightly unintuitive convention. This is because edges point in direction of shipments
         # whereas, in a market driven model, one tends to think of upstream and downstream in terms of orders.
-        self.upstream = self.supplyChain.successors(self)
-        self.downstream = self.supplyChain.predecessors(self)
+        self.getNeighbours()
         for neighbour in self.upstream:
             if isinstance(neighbour, supplyChainRetailMarket):
                 self.depth = 1
@@ -320,81 +1611,53 @@ class supplyChainNode(object):
             markets = [node for node in self.upstream if isinstance(node, supplyChainRetailMarket)]
             for market in markets:
                 for product in self.products:
-                    self.salesLost[self.currentTime][(market, product)] = 0
-                    self.salesLost[self.simulationLength][(market, product)] = 0
-                    updateAggregatesTemporal(self,self.salesLost,self.currentTime,market,product,0)
+                    self.salesLost.record(self.currentTime, market, product, 0)
                 
         
-        # Initialize stored history dictionaries.
-        for product in self.products:
-            self.unitsBuilt[self.currentTime][product] = 0
-            self.overstock[self.currentTime][product]  = 0
-            for downstreamNode in self.downstream:
-                self.ordersMade[self.currentTime][( downstreamNode ,product)] = 0
-                self.ordersMade[self.simulationLength][( downstreamNode ,product)] = 0
-                self.downstreamOutstanding[self.currentTime][( downstreamNode ,product)] = 0
-                self.shipmentsReceived[self.currentTime][( downstreamNode ,product)] = 0
-                self.shipmentsReceived[self.simulationLength][( downstreamNode ,product)] = 0
-                # Create product aggregates.
-                self.ordersMade[self.currentTime][(downstreamNode ,'allProducts')] = 0
-                self.ordersMade[self.simulationLength][(downstreamNode ,'allProducts')] = 0
-                self.downstreamOutstanding[self.currentTime][(downstreamNode ,'allProducts')] = 0
-                self.shipmentsReceived[self.currentTime][(downstreamNode ,'allProducts')] = 0
-                self.shipmentsReceived[self.simulationLength][(downstreamNode ,'allProducts')] = 0
-            for upstreamNode in self.upstream:    
-                self.ordersReceived[self.currentTime][(upstreamNode ,product)] = 0
-                self.ordersReceived[self.simulationLength][(upstreamNode ,product)] = 0
-                self.upstreamOutstanding[self.currentTime][(upstreamNode ,product)] = 0
-                self.shipmentsMade[self.currentTime][(upstreamNode ,product)] = 0
-                self.shipmentsMade[self.simulationLength][(upstreamNode ,product)] = 0
-                # Create product aggregates.
-                self.ordersReceived[self.currentTime][(upstreamNode ,'allProducts')] = 0
-                self.ordersReceived[self.simulationLength][(upstreamNode ,'allProducts')] = 0
-                self.upstreamOutstanding[self.currentTime][(upstreamNode ,'allProducts')] = 0
-                self.shipmentsMade[self.currentTime][(upstreamNode ,'allProducts')] = 0
-                self.shipmentsMade[self.simulationLength][(upstreamNode ,'allProducts')] = 0
-            # Create node aggregates.
-            self.ordersMade[self.currentTime][('allNodes',product)] = 0
-            self.ordersMade[self.simulationLength][('allNodes',product)] = 0
-            self.downstreamOutstanding[self.currentTime][('allNodes',product)] = 0
-            self.shipmentsReceived[self.currentTime][('allNodes',product)] = 0
-            self.shipmentsReceived[self.simulationLength][('allNodes',product)] = 0
-            self.ordersReceived[self.currentTime][('allNodes',product)] = 0
-            self.ordersReceived[self.simulationLength][('allNodes',product)] = 0
-            self.upstreamOutstanding[self.currentTime][('allNodes',product)] = 0
-            self.shipmentsMade[self.currentTime][('allNodes',product)] = 0
-            self.shipmentsMade[self.simulationLength][('allNodes',product)] = 0
-        # Create node+product aggregates.
-        self.ordersReceived[self.currentTime][('allNodes','allProducts')] = 0
-        self.ordersReceived[self.simulationLength][('allNodes','allProducts')] = 0
-        self.upstreamOutstanding[self.currentTime][('allNodes','allProducts')] = 0
-        self.shipmentsMade[self.currentTime][('allNodes','allProducts')] = 0
-        self.shipmentsMade[self.simulationLength][('allNodes','allProducts')] = 0
-        self.ordersMade[self.currentTime][('allNodes','allProducts')] = 0
-        self.ordersMade[self.simulationLength][('allNodes','allProducts')] = 0
-        self.downstreamOutstanding[self.currentTime][('allNodes','allProducts')] = 0
-        self.shipmentsReceived[self.currentTime][('allNodes','allProducts')] = 0
-        self.shipmentsReceived[self.simulationLength][('allNodes','allProducts')] = 0
+        # Initialize stored history ledgers. Temporal records are also zeroed in
+        # the final (time totals) row, persistent records only at the current time.
+        # Ledgers starting out alike copy the first of them, rather than resolve
+        # the same keys and record the same values again.
+        self.unitsBuilt.setMany([self.currentTime], self.products, 0)
+        if not self.overstock.copyLayout(self.unitsBuilt, values=True):
+            self.overstock.setMany([self.currentTime], self.products, 0)
+        for neighbours, temporal, outstanding in [(self.downstream, [self.ordersMade, self.shipmentsReceived], self.downstreamOutstanding),
+                                                  (self.upstream, [self.ordersReceived, self.shipmentsMade], self.upstreamOutstanding)]:
+            # Product, node and node+product aggregates alongside the per-product records.
+            keys = []
+            for product in self.products:
+                for node in neighbours:
+                    keys += [(node, product), (node, 'allProducts')]
+                keys.append(('allNodes', product))
+            keys.append(('allNodes', 'allProducts'))
+            temporal[0].setMany([self.currentTime, self.simulationLength], keys, 0)
+            if not temporal[1].copyLayout(temporal[0], values=True):
+                temporal[1].setMany([self.currentTime, self.simulationLength], keys, 0)
+            outstanding.copyLayout(temporal[0])
+            outstanding.setMany([self.currentTime], keys, 0)
         
     # Add a new product to the node.
     def addProduct(self,product,quantity=0):
         self.products.append(product)
-        self.inventory[self.currentTime][product] = quantity
+        self.inventory.set(self.currentTime, product, quantity)
         self.graph.addStockist(product,self)
         for downstreamNode in self.downstream:
-            self.ordersMade[self.currentTime][(downstreamNode ,product)] = 0
-            self.downstreamOutstanding[self.currentTime][(downstreamNode ,product)] = 0
-            self.shipmentsReceived[self.currentTime][(downstreamNode ,product)] = 0
+            self.ordersMade.set(self.currentTime, (downstreamNode ,product), 0)
+            self.downstreamOutstanding.set(self.currentTime, (downstreamNode ,product), 0)
+            self.shipmentsReceived.set(self.currentTime, (downstreamNode ,product), 0)
         for upstreamNode in self.upstream:
-            self.ordersReceived[self.currentTime][(upstreamNode ,product)] = 0
-            self.upstreamOutstanding[self.currentTime][(upstreamNode ,product)] = 0
-            self.shipmentsMade[self.currentTime][(upstreamNode ,product)] = 0
+            self.ordersReceived.set(self.currentTime, (upstreamNode ,product), 0)
+            self.upstreamOutstanding.set(self.currentTime, (upstreamNode ,product), 0)
+            self.shipmentsMade.set(self.currentTime, (upstreamNode ,product), 0)
         
     
-    # Query the graph for the node's neighbours            
+    # Query the graph for the node's neighbours, unless the structure of the
+    # graph is unchanged since they were last found.
     def getNeighbours(self):
-        self.upstream = (self.supplyChain).successors(self)
-        self.downstream = (self.supplyChain).predecessors(self)
+        if self.neighboursVersion != self.supplyChain.structureVersion:
+            self.upstream = tuple(self.supplyChain.successors(self))
+            self.downstream = tuple(self.supplyChain.predecessors(self))
+            self.neighboursVersion = self.supplyChain.structureVersion
 
     # Calculate available storage  
     def getAvailableStorage(self):
@@ -404,11 +1667,9 @@ class supplyChainNode(object):
     def receiveOrder(self,originNode,quantity,product):
         #print("Node %r receiving order of %r units of %r from %r" % (self, quantity, product, originNode))
         if quantity > self.minOrder[product]:
-            self.ordersReceived[self.currentTime][(originNode,product)] = quantity
-            updateAggregatesTemporal(self,self.ordersReceived,self.currentTime,originNode,product,quantity)
-            previouslyOutstanding = noneToZero(findPrevValueRecur(self.upstreamOutstanding, originNode, product, self.currentTime)[0])
-            self.upstreamOutstanding[self.currentTime][(originNode,product)] = previouslyOutstanding + quantity
-            updateAggregatesPersistent(self,self.upstreamOutstanding,self.currentTime,originNode,product,quantity)
+            self.ordersReceived.record(self.currentTime, originNode, product, quantity)
+            self.upstreamOutstanding.carry(self.currentTime, originNode, product, quantity)
+            self.orderBook[product].addOrder(originNode, quantity, self.currentTime)
         else:
             pass
             #print('Node ' + originNode.name + ' attempted to order ' + str(quantity) + ' units of ' + product.name + ', fewer than the minimum order (' +str(self.minOrder[product]) + ') for ' + self.name + '.')
@@ -421,12 +1682,8 @@ class supplyChainNode(object):
         threshold = targetNode.minOrder[product]
         if quantity > threshold:
             targetNode.receiveOrder(self,quantity,product)
-            prevValue = self.ordersMade[self.currentTime].get((targetNode,product),0)
-            self.ordersMade[self.currentTime][(targetNode,product)] = prevValue + quantity
-            updateAggregatesTemporal(self,self.ordersMade,self.currentTime,targetNode,product,quantity)
-            previousValue = noneToZero(findPrevValueRecur(self.downstreamOutstanding, targetNode, product, self.currentTime)[0])
-            self.downstreamOutstanding[self.currentTime][(targetNode,product)] = previousValue + quantity
-            updateAggregatesPersistent(self,self.downstreamOutstanding,self.currentTime,targetNode,product,quantity)
+            self.ordersMade.record(self.currentTime, targetNode, product, quantity, add=True)
+            self.downstreamOutstanding.carry(self.currentTime, targetNode, product, quantity)
         else:
             pass
             #print('Node ' + self.name + ' attempted to order ' +str(quantity) + 'units of ' + product.name + ',fewer than the minimum order (' + str(targetNode.minOrder[product]) + ') for ' + targetNode.name  + '.')
@@ -436,7 +1693,7 @@ class supplyChainNode(object):
         # Make sure sufficient product exists
         #print("Making shipment of %r units of %r to %r" % (quantity, product, targetNode))
         assert quantity > 0
-        if quantity > self.inventory[self.currentTime][product]:
+        if quantity > self.inventory.get(self.currentTime, product):
             #print 'Attempted to ship more stock than currently available in inventory'
             #print 'Shipment cancelled'
             return False
@@ -450,36 +1707,28 @@ class supplyChainNode(object):
                 self.getNeighbours()
         else:
             # Place the shipment on the edge
-            # Note how shipments are stored on an edge:{(timeWhenShipped, origin, target) : (timeOnEdge,quantity,product)}
-            self.supplyChain.add_edge(self, targetNode, {(self.currentTime,self,targetNode):(0,quantity,product)})
-            self.inventory[self.currentTime][product] -= quantity
+            self.supplyChain.transport.ship(self, targetNode, quantity, product, self.currentTime)
+            self.inventory.add(self.currentTime, product, -quantity)
             # Update the outstanding orders
-            previouslyOutstanding = noneToZero(findPrevValueRecur(self.upstreamOutstanding, targetNode, product, self.currentTime-1)[0])
-            self.upstreamOutstanding[self.currentTime][(targetNode,product)] = previouslyOutstanding - quantity
-            updateAggregatesPersistent(self,self.upstreamOutstanding,self.currentTime,targetNode,product,-quantity)
-            self.shipmentsMade[self.currentTime][(targetNode,product)] = quantity
-            updateAggregatesTemporal(self,self.shipmentsMade,self.currentTime,targetNode,product,quantity)
+            self.upstreamOutstanding.carry(self.currentTime, targetNode, product, -quantity)
+            self.orderBook[product].consume(targetNode, quantity)
+            self.shipmentsMade.record(self.currentTime, targetNode, product, quantity)
             self.storageInUse -= quantity*(product.warehouseSize)
             return True
     
     # Finds the time period of the oldest outstanding order from /node/
     # returns the outstanding quantity and the period in which it was ordered.
-    def findOldestOutstandingOrder(self,node,product,startTime):
-        assert self.shipmentsMade[self.simulationLength][(node,product)] <= self.ordersReceived[node.supplyChain.simulationLength][(node,product)]
-        quantity, orderTime = findNextValueRecur(self.ordersReceived, node, product, 0)
-        shipment, shipmentTime = findNextValueRecur(self.shipmentsMade, node, product, 0)
-        while shipment and (shipmentTime < self.currentTime + 1):
-            quantity -= shipment
-            if quantity <= 0:
-                nextOrder = findNextValueRecur(node.ordersMade, self, product, orderTime)
-                if nextOrder:
-                    quantity  += nextOrder[0]
-                    orderTime = nextOrder[1]
-                else:
-                    quantity = None
-                    orderTime = self.currentTime
-            shipment, shipmentTime = findNextValueRecur(self.shipmentsMade, node, product, shipmentTime)
-        return (quantity, orderTime)
+    def findOldestOutstandingOrder(self,node,product,startTime=0):
+        entry = self.orderBook[product].oldestFrom(node)
+        if entry is None:
+            return (None, self.currentTime)
+        return (entry[4], entry[0])
+
+    # Age of the oldest unfilled order for /product/ (over all products if None).
+    def getBacklogAge(self,product=None):
+        if product is None:
+            return max([self.orderBook[prod].backlogAge(self.currentTime) for prod in self.products] + [0])
+        return self.orderBook[product].backlogAge(self.currentTime)
     
     def hasOrdersOutstanding(self,targetNode,product,time):
         if targetNode in self.upstream:
@@ -502,10 +1751,10 @@ class supplyChainNode(object):
         if totalOutstanding == 0:
             return 
         # Check there is any stock to fill orders with
-        if self.inventory[self.currentTime][product] == 0:
+        if self.inventory.get(self.currentTime, product) == 0:
             return
         # If we have enough product to fulfill all orders, do so
-        currInventory = self.inventory[self.currentTime].get(product,0)
+        currInventory = self.inventory.get(self.currentTime, product,0)
         if currInventory >= totalOutstanding:
             for node in self.upstream:
                 currOutstanding = findPrevValueRecur(self.upstreamOutstanding,node,product,self.currentTime)[0]
@@ -513,54 +1762,14 @@ class supplyChainNode(object):
                     self.makeShipment(node, currOutstanding, product)
         # Otherwise, fulfil those orders that one can, starting with the oldest.
         else:
-            # Keep going until no more outstanding orders or no more inventory
-            while self.inventory[self.currentTime][product] > 0 and totalOutstanding > 0:
-                # Only look at nodes with some outstanding orders
-                nodesToCheck = [ node for node in self.upstream if self.hasOrdersOutstanding(node,product,self.currentTime)]
-                # Don't bother with the following rigmarole unless there's >1 upstream neighbour!
-                if len(nodesToCheck)>1:
-                    # Go through all nodes to find who should get priority
-                    priorityNode = None
-                    for node in nodesToCheck:
-                        #print("Considering node %r in attempts to find oldest outstanding order" % (node))
-                        oldestOrders = self.oldestOrder[product]
-                        oldestOrders[node] = self.findOldestOutstandingOrder(node, product, 0)
-                        self.oldestOrderLastCall = self.currentTime
-                        noBest = [(0, self.currentTime), None]
-                        candBest = oldestOrders[node]
-                        (oldBestQuant, oldBestTime), priorityNode  = oldestOrders.get('allNodes',noBest)
-                        if candBest[1] < oldBestTime:
-                            oldestOrders['allNodes'] = [candBest, node]
-                            priorityNode = node
-                        elif (candBest[0] == oldBestTime
-                            and candBest[1] > oldBestQuant):
-                            oldestOrders['allNodes'] = [candBest, node]
-                            priorityNode = node
-                        elif (priorityNode and
-                              candBest[0] == oldBestTime and
-                              candBest[1] == oldBestQuant and
-                              self.ordersReceived[self.simulationLength][(node,product)] >
-                              self.ordersReceived[self.simulationLength].get((priorityNode,product),0) ):
-                            oldestOrders['allNodes'] = [candBest, node]
-                            priorityNode = node
-                    # Having found the oldest order, fulfil in totality if possible.
-                    outstandingOld = oldestOrders.get('allNodes',[0])[0]
-                    if outstandingOld < 1:
-                        #print "Less than 1"
-                        #print "Current inventory of %r, totalOutstanding %r" % (self.inventory[self.currentTime][product], totalOutstanding)
-                        #print "Currently oustanding to %r: %r" % (node, self.upstreamOutstanding[self.currentTime][(node,product)])
-                        continue
-                    elif priorityNode == None:
-                        pass
-                        #print "No priority node."
-                    shipmentSize = min(currInventory, outstandingOld)
-                    if not self.makeShipment(priorityNode, shipmentSize, product):
-                        continue
-                    #print(self.name + ' shipped ' + str(shipmentSize) + ' units of ' + product.name + 'to ' + priorityNode.name +'.')
-                else:
-                    prodRemaining = self.inventory[self.currentTime][product]
-                    self.makeShipment(nodesToCheck[0],prodRemaining,product)
-                    #print(self.name + ' shipped ' + str(prodRemaining) + ' units of ' + product.name + ' to its sole upstream neighbour, ' + self.upstream[0].name +'.')
+            orderBook = self.orderBook[product]
+            while self.inventory.get(self.currentTime, product) > 0:
+                entry = orderBook.oldest()
+                if entry is None:
+                    break
+                shipmentSize = min(self.inventory.get(self.currentTime, product), entry[4])
+                if not self.makeShipment(entry[3], shipmentSize, product):
+                    break
 
     # Make shipments of all products
     def makeAllShipments(self):
@@ -573,44 +1782,35 @@ class supplyChainNode(object):
         
     
     # Calculate the product deficit
-    def calculateDeficit(self, product):
-        currDemand = findPrevValueRecur(self.upstreamOutstanding, 'allNodes', product, self.currentTime)[0]
-        currInven = self.inventory[self.currentTime].get(product,0)
-        # Assume orders will 'come good'. Could add a coefficient x in (0,1] to represent reliability.
-        incomingInven = findPrevValueRecur(self.downstreamOutstanding, 'allNodes', product, self.currentTime)[0]
-        try:
-            directDeficit = currDemand - currInven -incomingInven
-        except TypeError:
-            #print 'calculateDeficit encountered a type error when calculating directDeficit, \
-            #    probably from None values introduced by findPrevValueRecur. \
-            #    Converting potential None values to zero.'
-            currDemand = noneToZero(currDemand)
-            incomingInven = noneToZero(incomingInven)
-            directDeficit = currDemand - currInven -incomingInven
+    def calculateDeficit(self, product, componentDemand=None):
+        directDeficit = self.netDemand(product)
+        # Units needed to build the deficit of the products /product/ goes into,
+        # from componentDemand (see outputDeficits) if it has been worked out.
         implicitDeficit = 0
-        for complexProduct in self.buildInstructions:
-            multiplier = self.buildInstructions[complexProduct].get(product,0)
-            if multiplier > 0:
-                currDemand = findPrevValueRecur(self.upstreamOutstanding, 'allNodes', complexProduct, self.currentTime)[0]
-                currInven = self.inventory[self.currentTime][complexProduct]
-                incInven = findPrevValueRecur(self.downstreamOutstanding,'allNodes',complexProduct,self.currentTime)[0]
-                try:
-                    complexProductDeficit = currDemand - currInven - incInven
-                except TypeError:
-                    print ('calculateDeficit encountered a type error when calculating complexProductDeficit\
-                       probably from None values introduced by findPrevValueRecur. \
-                        Converting potential None values to zero.' )
-                    currDemand = noneToZero(currDemand)
-                    incInven = noneToZero(incInven)
-                    complexProductDeficit = currDemand - currInven - incInven
-                implicitDeficit += max(complexProductDeficit,0)*multiplier
+        if product in self.recipes.components:
+            if componentDemand is None:
+                componentDemand = self.recipes.componentDemand(self.outputDeficits())
+            implicitDeficit = componentDemand[self.recipes.productIndex[product]]
         totalDeficit = max(directDeficit + implicitDeficit + self.targetInventory.get(product,0),0)
         return totalDeficit
+
+    # Units of /product/ on order from customers, less those in stock and those on order from suppliers.
+    def netDemand(self, product):
+        currDemand = noneToZero(findPrevValueRecur(self.upstreamOutstanding, 'allNodes', product, self.currentTime)[0])
+        currInven = self.inventory.get(self.currentTime, product,0)
+        # Assume orders will 'come good'. Could add a coefficient x in (0,1] to represent reliability.
+        incomingInven = noneToZero(findPrevValueRecur(self.downstreamOutstanding, 'allNodes', product, self.currentTime)[0])
+        return currDemand - currInven - incomingInven
+
+    # Deficit of each product the node builds, as a list over recipes.outputs.
+    # recipes.componentDemand turns it into the components needed.
+    def outputDeficits(self):
+        return [max(self.netDemand(product),0) for product in self.recipes.outputs]
     
     # Make orders of /product/ according to predicted need
-    def makeAllProductOrders(self,product):
+    def makeAllProductOrders(self,product,componentDemand=None):
         suppliers = [node for node in self.downstream if product in node.products]
-        unitsRequired = self.calculateDeficit(product)
+        unitsRequired = self.calculateDeficit(product,componentDemand)
         if unitsRequired == 0:
             return True
         if unitsRequired < 0:
@@ -640,22 +1840,23 @@ class supplyChainNode(object):
     
     # Make orders for all products
     def makeAllOrders(self):
-        complexProducts = [product for product in self.buildInstructions if product in self.products]
+        complexProducts = [product for product in self.recipes.outputs if product in self.products]
         atomicProducts = [product for product in self.products if not product in complexProducts]
         for complexProduct in complexProducts:
             self.makeAllProductOrders(complexProduct)
+        # Ordering atomic products leaves the deficits of complex ones as they are.
+        componentDemand = None
+        if atomicProducts and self.recipes.entries:
+            componentDemand = self.recipes.componentDemand(self.outputDeficits())
         for atomicProduct in atomicProducts:
-            self.makeAllProductOrders(atomicProduct)
+            self.makeAllProductOrders(atomicProduct, componentDemand)
 
 
     # Receive and store product
     def receiveShipment(self,originNode,timeWhenShipped,quantity,product):
         #print("Node %r receiving shipment of %r units of %r from node %r" % (self, quantity, product, originNode))
-        previouslyOutstanding = noneToZero(findPrevValueRecur(self.downstreamOutstanding, originNode, product, self.currentTime)[0])
-        self.downstreamOutstanding[self.currentTime][(originNode,product)] = previouslyOutstanding - quantity
-        updateAggregatesPersistent(self,self.downstreamOutstanding,self.currentTime,originNode,product,-quantity)
-        self.shipmentsReceived[self.currentTime][(originNode,product)] = quantity
-        updateAggregatesTemporal(self,self.shipmentsReceived,self.currentTime,originNode,product,quantity)
+        self.downstreamOutstanding.carry(self.currentTime, originNode, product, -quantity)
+        self.shipmentsReceived.record(self.currentTime, originNode, product, quantity)
         # Check there is room to store the new products
         if self.getAvailableStorage() > quantity*(product.warehouseSize):
             self.storageInUse += quantity*(product.warehouseSize)
@@ -663,9 +1864,8 @@ class supplyChainNode(object):
             # If not, store what we can and record any losses
             self.storageInUse = self.storageCapacity
             productKept = int(self.getAvailableStorage()/product.warehouseSize)
-            self.overstock[self.currentTime][product] = max(quantity - productKept,0)
+            self.overstock.set(self.currentTime, product, max(quantity - productKept,0))
             #print("Not enough warehouse space,  discarding %r units of %r" % (quantity - productKept, product))
-        self.supplyChain.add_edge(originNode, self, {(timeWhenShipped,originNode,self): (-self.simulationLength,quantity,product)})
 
     # Unpack recently stored products
     def unpackShipments(self):
@@ -673,54 +1873,37 @@ class supplyChainNode(object):
         if not self.currentTime > 0:
             return
         # Add shipments to inventory (after some delay)
-        currentInventory = self.inventory[self.currentTime]
+        if not self.downstream:
+            return
         for product in self.products:
-            for node in self.downstream:
-                # If received yesterday, add to inventory today.
-                # Variable 'unpacking' times could be implemented as an attribute.
-                boxed = self.shipmentsReceived[self.currentTime -1].get((node,product),0)
-                currentInventory[product] = currentInventory.get(product,0) + boxed
-
-    # Build products according to recipes
+            # If received yesterday, add to inventory today.
+            # Variable 'unpacking' times could be implemented as an attribute.
+            boxed = sum([self.shipmentsReceived.get(self.currentTime -1, (node,product),0) for node in self.downstream])
+            self.inventory.add(self.currentTime, product, boxed)
+
+    # Build products according to recipes, as many as processing capacity and
+    # component stock allow. Build priority is recipe (buildInstructions) order.
+    # N.B. If we want slightly less greedy production, change actual
+    # inventory check to target inventory check.
     def buildProducts(self):
-        for key, value in self.buildInstructions.iteritems():
-            if len(value) > 1:
-                break
-        else:
+        recipes = self.recipes
+        if not recipes.buildRows:
             return
-        currentInventory = self.inventory[self.currentTime]
-        # Build priority is according to dictionary order (i.e. pretty much random!)
-        # N.B. If we want slightly less greedy production, change actual
-        # inventory check to target inventory check.
-        for product in self.buildInstructions:
-            componentMax = []
-            # Find the limiting factor in production by dividing current stock by number in recipe
-            for componentProduct in self.buildInstructions[product]:
-                componentStock = currentInventory.get(componentProduct,0)
-                numInBuild = self.buildInstructions[product][componentProduct]
-                try:
-                    componentMax.append(int(componentStock/numInBuild))
-                except ZeroDivisionError:
-                    #print ('Do not put zero-use components in to build instructions!')
-                    raise
-            # Produce as many as possible, updating records accordingly
-            newProducts = min(self.processingCapacity[product], min(componentMax))
-            self.unitsBuilt[self.currentTime][product] = newProducts
-            #print "%d units of %s built." % (newProducts, product)
-            currentInventory[product] = currentInventory.get(product,0) + newProducts
-            for componentProduct in self.buildInstructions[product]:
-                currentInventory[componentProduct] = currentInventory.get(componentProduct,0)
-                currentInventory[componentProduct] -= newProducts*self.buildInstructions[product][componentProduct]
-                if currentInventory[componentProduct] < 0:
-                    raise Exception('WHAT?! buildProducts is broken, check arithmetic for num new products produced.')
+        currentInventory = self.inventory
+        t = self.currentTime
+        stock = currentInventory.getAt(t, self.recipeStock)
+        built = recipes.build(stock, self.processingCapacity)
+        if (stock[recipes.columns] < 0).any():
+            raise Exception('WHAT?! buildProducts is broken, check arithmetic for num new products produced.')
+        for i in recipes.buildRows:
+            self.unitsBuilt.set(t, recipes.outputs[i], built.item(i))
+        for j in recipes.changed:
+            currentInventory.set(t, recipes.products[j], stock.item(j))
 
     # Do the daily chores (irrespective of orders, etc.)
     def updateInventory(self):
         assert self.currentTime > 0
-        previousInventory = self.inventory[self.currentTime-1].copy()
-        for product, quantity in previousInventory.iteritems():
-            #print ("Updating inventory of %r to be %r" % (product, quantity))
-            self.inventory[self.currentTime][product] = quantity
+        self.inventory.copyRow(self.currentTime-1, self.currentTime)
         self.unpackShipments()
         self.buildProducts()
         
@@ -735,23 +1918,20 @@ class supplyChainNode(object):
     
     # Make a sale!
     def makeSale(self,market,product,quantity):
-        currInven = self.inventory[self.currentTime].get(product,0)
+        currInven = self.inventory.get(self.currentTime, product,0)
         if currInven >= quantity:
             #print str(quantity) + ' units of ' + product.name + ' sold at ' + self.name
-            self.ordersReceived[self.currentTime][(market,product)]=quantity
-            updateAggregatesTemporal(self,self.ordersReceived,self.currentTime,market,product,quantity)
-            self.inventory[self.currentTime][product] -= quantity
-            self.shipmentsMade[self.currentTime][(market,product)] = quantity
-            updateAggregatesTemporal(self,self.shipmentsMade,self.currentTime,market,product,quantity)
-            self.supplyChain.add_edge(self,market,{(self.currentTime,self,market):(0,quantity,product)})
-            self.unitsSold[self.currentTime][product] = quantity
-            self.unitsSold[self.simulationLength][product] = self.unitsSold[self.simulationLength].get(product,0) + quantity
+            self.ordersReceived.record(self.currentTime, market, product, quantity)
+            self.inventory.add(self.currentTime, product, -quantity)
+            self.shipmentsMade.record(self.currentTime, market, product, quantity)
+            self.supplyChain.transport.ship(self, market, quantity, product, self.currentTime)
+            self.unitsSold.set(self.currentTime, product, quantity)
+            self.unitsSold.set(self.simulationLength, product, self.unitsSold.get(self.simulationLength, product,0) + quantity)
             return 1
         else:
             try:
                 shortfall = quantity - currInven
-                self.salesLost[self.currentTime][(market,product)] = shortfall
-                updateAggregatesTemporal(self, self.salesLost, self.currentTime,market,product,shortfall)
+                self.salesLost.record(self.currentTime, market, product, shortfall)
                 self.makeSale(market,product,currInven)
             except TypeError:
                 #print product, currInven
@@ -760,28 +1940,21 @@ class supplyChainNode(object):
     
     # Check for shipments that have arrived
     def checkForShipments(self):
-        ' Looks at all incoming edges and checks for any shipments that have \
-        spent the requisite time on the edge to arrive'
-        for downstreamNode in self.downstream:
-            edata = self.supplyChain[downstreamNode][self]
-            if isinstance(edata,dict):
-                for key in edata:
-                    if isinstance(key,tuple) and not (edata[key] is None):
-                        if edata[key][0] >= edata.get('timeToTraverse',0):
-                            quant, prod = edata[key][1:3]
-                            timeWhenShipped = key[0]
-                            originNode = key[1]
-                            if key[2] == self:
-                                self.receiveShipment(originNode,timeWhenShipped, quant, prod)
-                            # An 'else' clause here could deal with routing shipments to other nodes!
+        ' Receives every shipment that has spent the requisite time on its edge \
+        to arrive, as scheduled on the transport calendar'
+        for shipment in self.supplyChain.transport.arrivals(self, self.currentTime):
+            self.receiveShipment(shipment.origin, shipment.timeWhenShipped, shipment.quantity, shipment.product)
+            # Routing shipments on to other nodes could be dealt with here!
         
     # Calculate the node health
     def calculateHealth(self):
         ''' Returns a crude metric of node health '''
         prodHealth = []
+        # Stock and targets are whole numbers; the division is a float one,
+        # so stock part way to its target scores part marks.
         for product in self.products:
                 target = self.targetInventory[product]
-                stockScore = max(1 - (abs(self.inventory[self.currentTime][product] - target)/target),0)
+                stockScore = max(1 - (abs(self.inventory.get(self.currentTime, product) - target)/float(target)),0)
                 prodHealth.append(stockScore)
         meanScore = (sum([x**2 for x in prodHealth])/len(prodHealth))**0.5
         self.health = meanScore
@@ -790,15 +1963,49 @@ class supplyChainNode(object):
     def getHealth(self):
         return self.health
 
+    def getHealthHistory(self):
+        return self.supplyChain.getNodeHealthHistory(self)
+
+    # The node's state at the end of the timestep for result sinks: inventory,
+    # health, sales lost this timestep, backlog and backlog age. Markets step
+    # first, so this timestep's sales are booked under the node's previous time.
+    def getTickSummary(self):
+        inventory = sum([self.inventory.get(self.currentTime, product) for product in self.products])
+        backlog = sum([self.orderBook[product].totalRemaining for product in self.products])
+        salesLost = self.salesLost.get(self.currentTime-1, ('allNodes','allProducts'))
+        return (inventory, self.health, salesLost, backlog, self.getBacklogAge())
+
     # Make a timestep
     def makeTimeStep(self):
+        if self.supplyChain.profiler is not None:
+            self.supplyChain.profiler.profileStep(self, self.timeStepPhases())
+            return
         self.getNeighbours()
-        self.currentTime += 1
+        self.advanceTime()
         self.updateInventory()
         self.checkForShipments()
         self.makeAllShipments()
         self.makeAllOrders()
+        self.postHealth()
+
+    # The phases of makeTimeStep as (name, method) pairs, for the network's
+    # profiler. Keep in step with makeTimeStep.
+    def timeStepPhases(self):
+        return [('getNeighbours', self.getNeighbours),
+                ('advanceTime', self.advanceTime),
+                ('updateInventory', self.updateInventory),
+                ('checkForShipments', self.checkForShipments),
+                ('makeAllShipments', self.makeAllShipments),
+                ('makeAllOrders', self.makeAllOrders),
+                ('postHealth', self.postHealth)]
+
+    def advanceTime(self):
+        self.currentTime += 1
+
+    # Work out the node's health and let the network know.
+    def postHealth(self):
         self.health = self.calculateHealth()
+        self.supplyChain.updateHealth(self, self.health)
 
 
 # Retail market object
@@ -812,58 +2019,86 @@ class supplyChainRetailMarket(object):
         self.initialDemand = args[3]
         self.products = []
         self.currentTime = kwargs.get('startTime',0)
-        self.marketDemand = [self.initialDemand for __ in range(self.simulationLength)]
+        self.marketDemand = self.supplyChain.newHistory(self.initialDemand)
         self.seed = kwargs.get('rngSeed',0)
         self.marketShare = kwargs.get('marketShare',None)
         self.label = self.name
         self.longName = kwargs.get('name','Missing longName')
         # Market reputation probably a better term
         if self.marketShare is None:
-            self.marketShare = [dict() for __ in range(self.simulationLength)]
-        self.ordersMade = [dict() for __ in range(self.simulationLength+1)]
-        self.downstreamOutstanding = [dict() for __ in range(self.simulationLength)]
-        self.shipmentsReceived= [dict() for __ in range(self.simulationLength+1)]
-        self.upstream = []
-        self.downstream = []
+            self.marketShare = self.supplyChain.newHistory(dict)
+        self.ordersMade = self.supplyChain.newLedger()
+        self.downstreamOutstanding = self.supplyChain.newLedger()
+        self.shipmentsReceived= self.supplyChain.newLedger()
+        self.upstream = ()
+        self.downstream = ()
+        self.neighboursVersion = None
         self.depth = 0
         self.health = 1.0 
+        self.myHash = hash((self.name, self.supplyChain.name))
 
     def __repr__(self):
         return ("supplyChainRetailMarket(name=%r,currDemand=%r)" 
             % (self.name, self.marketDemand[self.currentTime]))
 
+    # As for supplyChainNode, hash by name so that iteration order (and so the
+    # results of a run) does not depend on where the objects sit in memory.
+    def __eq__(self, other):
+        return isinstance(other, self.__class__) and self.myHash == other.myHash
+    def __ne__(self, other):
+        return not self.__eq__(other)
+    def __hash__(self):
+        return self.myHash
+
     def poissonPDF(x,mu):
         return math.exp(x*math.log(mu) - mu - math.lgamma(x))
     
-    # Get poisson random num
+    # Draw the market's demand noise (a standard normal per timestep) for
+    # /startTime/ onwards, all at once, from the market's own NumPy generator.
+    # It is seeded by the market's rngSeed and name and the network's
+    # demandSeed, so it does not depend on any other random draws.
+    def seedDemand(self, startTime=0):
+        seed = [self.seed, zlib.crc32(str(self.name)) & 0xffffffff, self.supplyChain.demandSeed]
+        noise = np.random.RandomState(seed).standard_normal(self.simulationLength + 1)
+        if startTime == 0:
+            self.demandNoise = noise
+        else:
+            self.demandNoise[startTime:] = noise[startTime:]
+
+    # Demand this timestep, following on from /prev_value/.
     def getMarketDemand(self,prev_value):
-        return max(math.ceil(prev_value + (prev_value**0.5)*random.gauss(0,1) - 0.5), math.floor(self.initialDemand*0.3))
+        noise = self.demandNoise.item(self.currentTime)
+        return max(math.ceil(prev_value + (prev_value**0.5)*noise - 0.5), math.floor(self.initialDemand*0.3))
 
     def getGraphContext(self):
         ' Should only be run immediately after adding the node into the supplyChain. '
+        self.seedDemand()
         self.participants = {self.currentTime: (self.supplyChain).predecessors(self)}
         if self.marketShare[self.currentTime] == dict():
             for node in self.participants[self.currentTime]:
                 # Note the 'product' portion of the key tuple is redundant
                 self.marketShare[self.currentTime][(node,self.product)] = 1.0
         for downstreamNode in self.downstream:
-            self.ordersMade[self.currentTime][(downstreamNode ,self.product)] = 0
-            self.ordersMade[self.simulationLength][(downstreamNode, self.product)] = 0
-            self.downstreamOutstanding[self.currentTime][(downstreamNode,self.product)] = 0
-            self.shipmentsReceived[self.currentTime][( downstreamNode,self.product)] = 0
-            self.shipmentsReceived[self.simulationLength][(downstreamNode,self.product)] = 0
+            self.ordersMade.set(self.currentTime, (downstreamNode ,self.product), 0)
+            self.ordersMade.set(self.simulationLength, (downstreamNode, self.product), 0)
+            self.downstreamOutstanding.set(self.currentTime, (downstreamNode,self.product), 0)
+            self.shipmentsReceived.set(self.currentTime, ( downstreamNode,self.product), 0)
+            self.shipmentsReceived.set(self.simulationLength, (downstreamNode,self.product), 0)
         # Create node aggregates.
-        self.ordersMade[self.currentTime][( 'allNodes', self.product)] = 0
-        self.downstreamOutstanding[self.currentTime][( 'allNodes', self.product)] = 0
-        self.shipmentsReceived[self.currentTime][('allNodes', self.product)] = 0
-        self.ordersMade[self.simulationLength][('allNodes', self.product)] = 0
-        self.shipmentsReceived[self.simulationLength][('allNodes', self.product)] = 0
+        self.ordersMade.set(self.currentTime, ( 'allNodes', self.product), 0)
+        self.downstreamOutstanding.set(self.currentTime, ( 'allNodes', self.product), 0)
+        self.shipmentsReceived.set(self.currentTime, ('allNodes', self.product), 0)
+        self.ordersMade.set(self.simulationLength, ('allNodes', self.product), 0)
+        self.shipmentsReceived.set(self.simulationLength, ('allNodes', self.product), 0)
     
 
-    # Query the graph for the node's neighbours            
+    # Query the graph for the node's neighbours, unless the structure of the
+    # graph is unchanged since they were last found.
     def getNeighbours(self):
-        self.upstream = (self.supplyChain).successors(self)
-        self.downstream = (self.supplyChain).predecessors(self)
+        if self.neighboursVersion != self.supplyChain.structureVersion:
+            self.upstream = tuple(self.supplyChain.successors(self))
+            self.downstream = tuple(self.supplyChain.predecessors(self))
+            self.neighboursVersion = self.supplyChain.structureVersion
     
     
     # Make an order to a downstream node
@@ -872,17 +2107,8 @@ class supplyChainRetailMarket(object):
         if quantity < 0:
             raise Exception('Negative quantity!: ' + str(quantity))
         if quantity > threshold:
-            prevValue = self.ordersMade[self.currentTime].get((targetNode,product),0)
-            self.ordersMade[self.currentTime][(targetNode,product)] = prevValue + quantity
-            updateAggregatesTemporal(self,self.ordersMade,self.currentTime,targetNode,product,quantity)
-            previousValue = findPrevValueRecur(self.downstreamOutstanding, targetNode, product, self.currentTime)[0]
-            try:
-                self.downstreamOutstanding[self.currentTime][(targetNode,product)] = previousValue + quantity
-            except TypeError:
-                #print('Probably a None value from findPrevValueRecur. Converting to zero!')
-                previousValue = noneToZero(previousValue)
-                self.downstreamOutstanding[self.currentTime][(targetNode,product)] = previousValue + quantity
-            updateAggregatesPersistent(self,self.downstreamOutstanding,self.currentTime,targetNode,product,quantity)
+            self.ordersMade.record(self.currentTime, targetNode, product, quantity, add=True)
+            self.downstreamOutstanding.carry(self.currentTime, targetNode, product, quantity)
             proportionFilled = targetNode.makeSale(self,product,quantity)
             self.marketShare[self.currentTime][(targetNode,product)] += proportionFilled
         else:
@@ -895,37 +2121,16 @@ class supplyChainRetailMarket(object):
 
     # Receive and store product
     def receiveShipment(self,originNode,timeWhenShipped,quantity,product):
-        previouslyOutstanding = noneToZero(findPrevValueRecur(self.downstreamOutstanding, originNode, product, self.currentTime)[0])
-        self.downstreamOutstanding[self.currentTime][(originNode,product)] = previouslyOutstanding - quantity
-        updateAggregatesPersistent(self,self.downstreamOutstanding,self.currentTime,originNode,product,-quantity)
-        self.shipmentsReceived[self.currentTime][(originNode,product)] = quantity
-        updateAggregatesTemporal(self,self.shipmentsReceived,self.currentTime,originNode,product,quantity)
-        self.supplyChain.add_edge(originNode, self, {(timeWhenShipped,originNode,self):(-self.simulationLength,quantity,product)})
+        self.downstreamOutstanding.carry(self.currentTime, originNode, product, -quantity)
+        self.shipmentsReceived.record(self.currentTime, originNode, product, quantity)
     
     # Check for shipments that have arrived
     def checkForShipments(self):
-        ' Looks at all incoming edges and checks for any shipments that have \
-        spent the requisite time on the edge to arrive'
-        for downstreamNode in self.downstream:
-            edata = self.supplyChain[downstreamNode][self]
-            if isinstance(edata,dict):
-                timeToTraverse = edata['timeToTraverse']
-                for key in edata:
-                    if isinstance(key,tuple):
-                        if edata[key] is None:
-                            continue
-                        if edata[key][0] >= timeToTraverse:
-                            currData = edata[key]
-                            try:
-                                quant, prod = currData[1:3]
-                            except:
-                                #print currData
-                                raise
-                            timeWhenShipped = key[0]
-                            originNode = key[1]
-                            if key[2] == self:
-                                self.receiveShipment(originNode,timeWhenShipped, quant, prod)
-                            # An 'else' clause here could deal with routing shipments to other nodes!
+        ' Receives every shipment that has spent the requisite time on its edge \
+        to arrive, as scheduled on the transport calendar'
+        for shipment in self.supplyChain.transport.arrivals(self, self.currentTime):
+            self.receiveShipment(shipment.origin, shipment.timeWhenShipped, shipment.quantity, shipment.product)
+            # Routing shipments on to other nodes could be dealt with here!
                             
     def makeAllOrders(self):
         self.marketShare[self.currentTime] = self.marketShare[self.currentTime -1].copy() # This is creating a pointer. FIX ME
@@ -949,240 +2154,262 @@ class supplyChainRetailMarket(object):
     
     def calculateHealth(self):
         try:
-            self.health = self.shipmentsReceived[-1].get(('allNodes','allProducts'),0)/self.ordersMade[-1].get(('allNodes','allProducts'),0)
+            self.health = self.shipmentsReceived.total(('allNodes','allProducts'))/float(self.ordersMade.total(('allNodes','allProducts')))
         except ZeroDivisionError:
             self.health = 1
         return self.health
     
     def getHealth(self):
         return self.health
+
+    def getHealthHistory(self):
+        return self.supplyChain.getNodeHealthHistory(self)
+
+    # Markets hold no stock; their backlog is what they have ordered but not received.
+    def getTickSummary(self):
+        backlog = self.ordersMade.total(('allNodes','allProducts')) - self.shipmentsReceived.total(('allNodes','allProducts'))
+        return (0, self.health, 0, backlog, 0)
     
     def makeTimeStep(self):
-        self.currentTime += 1
+        if self.supplyChain.profiler is not None:
+            self.supplyChain.profiler.profileStep(self, self.timeStepPhases())
+            return
+        self.advanceTime()
         self.checkForShipments()
         self.makeAllOrders()
+        self.postHealth()
+
+    # The phases of makeTimeStep as (name, method) pairs, for the network's
+    # profiler. Keep in step with makeTimeStep.
+    def timeStepPhases(self):
+        return [('advanceTime', self.advanceTime),
+                ('checkForShipments', self.checkForShipments),
+                ('makeAllOrders', self.makeAllOrders),
+                ('postHealth', self.postHealth)]
+
+    def advanceTime(self):
+        self.currentTime += 1
+
+    # Work out the market's health and let the network know.
+    def postHealth(self):
         self.health = self.calculateHealth()
+        self.supplyChain.updateHealth(self, self.health)
 
     
     
 
-# Commodity market object
+# Commodity market object: a source of raw material that produces
+# productSupply[t] units of its product each timestep and ships them to its
+# customers (successors). Orders wait in an order book, as at a
+# supplyChainNode, and stock is shared out between them by
+# allocationPolicy, one of supplyChainAllocation.POLICIES. The network
+# allocates for all of its commodity markets together (see
+# stepCommodityMarkets).
 class supplyChainCommodityMarket(object):
-    #def __init__(self,*args,**kwargs):
-    #    self.name = str(args[0]) # (str) human readable name for the object
-    #    self.supplyChain = args[1] # (supplyChainNetwork)
-    #    assert isinstance(self.supplyChain, supplyChainNetwork)
-    #    self.productList = args[2]
-    #    self.product = self.productList[0]
-    #    # Process optional arguments
-    #    self.currentTime = kwargs.get('currentTime',0) # (int) Time at which to initialize node, defaults to 0.
-    #    self.minOrder = {prod: (kwargs.get('minOrder',dict())).get(prod, 0) for prod in productList} # (dict) Minimum order accepted, keyed by product. Defaults to 0.
-    #    self.inventory = [dict() for x in range(self.simulationLength)] # Inventory array (by time) of dicts (each keyed by product)
-    #    self.oldestOrder = dict((product, dict()) for product in self.products) # Dict of dicts, first keyed on product, second keyed on node. Stores time of oldest outstanding orders
-    #    self.oldestOrderLastCall = -1 # Currently unused, potential optimisation
-    #    self.myHash = hash((self.name, self.supplyChain.name)) # To allow use as keys in dictionaries, etc.
-    #    self.stockistPreferences = dict((product,dict()) for product in self.products)
-    #    
-    #    self.depth = None
-    
-    def __init__(self,label,graph,product,initialSupply,minOrder,initialInventory,customerRelationships=dict(),startTime=0):
+    def __init__(self,label,graph,product,initialSupply,minOrder,initialInventory,**kwargs):
         self.name = label
+        self.label = self.name
+        self.longName = kwargs.get('name','Missing longName')
         self.tier = 100
         self.supplyChain = graph
         self.simulationLength = self.supplyChain.simulationLength
-        self.currentTime = startTime
-        self.productSupply = [0 for __ in range(self.simulationLength)]
-        self.productSupply[self.currentTime] = initialSupply
-        self.inventory = [0 for __ in range(self.simulationLength)]
-        self.inventory[self.currentTime] = initialInventory
+        self.currentTime = kwargs.get('startTime',0)
         self.product = product
         self.products = [self.product]
-        self.resourceSupply = {self.currentTime: initialSupply}
-        self.minOrder = minOrder # (int) Minimum order for upstream nodes
-        # Initialize some other essentials
-        self.inventory = [dict() for x in range(self.simulationLength)] # Inventory array (by time) of dicts (each keyed by product)
-        self.oldestOrder = dict((product, dict()) for product in self.products) # Dict of dicts, first keyed on product, second keyed on node. Stores time of oldest outstanding orders
-        self.oldestOrderLastCall = -1 # Currently unused, potential optimisation
-        # Market reputation probably a better term
-        self.customerRelationships = customerRelationships
-        self.ordersReceived = dict()
-        self.upstreamOutstanding = dict()
-        self.shipmentsMade=dict()
-        self.upstream = []
-        self.downstream = []
-        self.totalReputation = [0 for x in range(0,self.simulationLength)]
+        self.allocationPolicy = checkPolicy(kwargs.get('allocationPolicy','fifo'))
+        self.productSupply = np.empty(self.simulationLength + 1, dtype=np.int64) # Units produced at each timestep.
+        self.productSupply.fill(initialSupply)
+        if not isinstance(minOrder, dict):
+            minOrder = {self.product: minOrder}
+        self.minOrder = minOrder # (dict) Minimum order accepted, keyed by product.
+        self.inventory = self.supplyChain.newLedger(productKeyed=True) # Inventory ledger (by time and product)
+        self.inventory.set(self.currentTime, self.product, initialInventory)
+        self.orderBook = dict((product, supplyChainOrderBook()) for product in self.products) # Unfilled orders by product.
+        self.ordersReceived = self.supplyChain.newLedger()
+        self.upstreamOutstanding = self.supplyChain.newLedger()
+        self.shipmentsMade = self.supplyChain.newLedger()
+        self.upstream = ()
+        self.downstream = ()
+        self.neighboursVersion = None
+        self.depth = kwargs.get('depth',None)
+        self.health = 1.0
+        self.myHash = hash((self.name, self.supplyChain.name))
 
     def __repr__(self):
         return ("supplyChainCommodityMarket(name=%r,upstreamOutstanding=%r)" % 
-            (self.name, self.upstreamOutstanding[self.currentTime][('allNodes','allProducts')]))
+            (self.name, self.upstreamOutstanding.get(self.currentTime, ('allNodes','allProducts'))))
+
+    # As for supplyChainNode, hash by name.
+    def __eq__(self, other):
+        return isinstance(other, self.__class__) and self.myHash == other.myHash
+    def __ne__(self, other):
+        return not self.__eq__(other)
+    def __hash__(self):
+        return self.myHash
 
     def getGraphContext(self):
-        self.participants = {self.currentTime: (self.supplyChain).successors(self)}
-        if self.customerRelationships == dict():
-            for node in self.participants[self.currentTime]:
-                # Note the 'product' portion of the key tuple is redundant
-                self.customerRelationships[self.currentTime][(node,self.product)] = 1
-                self.totalReputation[self.currentTime] += 1
+        ' Should only be run immediately after adding the node into the supplyChain. '
+        self.getNeighbours()
+        # One deeper than the nearest customer, as for supplyChainNode.
+        customerDepths = [node.depth for node in self.upstream if node.depth is not None]
+        if customerDepths:
+            self.depth = min(customerDepths) + 1
         for upstreamNode in self.upstream:
-            self.ordersReceived[self.currentTime][( upstreamNode ,self.product)] = 0
-            self.upstreamOutstanding[self.currentTime][( upstreamNode ,self.product)] = 0
-            self.shipmentsMade[self.currentTime][( upstreamNode ,self.product)] = 0
+            self.ordersReceived.set(self.currentTime, ( upstreamNode ,self.product), 0)
+            self.ordersReceived.set(self.simulationLength, ( upstreamNode ,self.product), 0)
+            self.upstreamOutstanding.set(self.currentTime, ( upstreamNode ,self.product), 0)
+            self.shipmentsMade.set(self.currentTime, ( upstreamNode ,self.product), 0)
+            self.shipmentsMade.set(self.simulationLength, ( upstreamNode ,self.product), 0)
         # Create node aggregates.
-        self.ordersReceived[self.currentTime][( 'allNodes', self.product)] = 0
-        self.upstreamOutstanding[self.currentTime][( 'allNodes', self.product)] = 0
-        self.shipmentsMade[self.currentTime][( 'allNodes', self.product)] = 0
-
-    # Query the graph for the node's neighbours.         
+        for ledger in [self.ordersReceived, self.upstreamOutstanding, self.shipmentsMade]:
+            ledger.set(self.currentTime, ( 'allNodes', self.product), 0)
+            ledger.set(self.currentTime, ( 'allNodes', 'allProducts'), 0)
+        self.ordersReceived.set(self.simulationLength, ('allNodes', 'allProducts'), 0)
+        self.shipmentsMade.set(self.simulationLength, ('allNodes', 'allProducts'), 0)
+
+    # Query the graph for the node's neighbours, unless the structure of the
+    # graph is unchanged since they were last found.
     def getNeighbours(self):
-        self.upstream = (self.supplyChain).successors(self)
-        self.downstream = (self.supplyChain).predecessors(self)
+        if self.neighboursVersion != self.supplyChain.structureVersion:
+            self.upstream = tuple(self.supplyChain.successors(self))
+            self.downstream = tuple(self.supplyChain.predecessors(self))
+            self.neighboursVersion = self.supplyChain.structureVersion
 
+    # Add this timestep's output to the stock.
     def produceMaterials(self):
-        newMaterials = self.getMarketDemand(self.productSupply[self.currentTime-1])
-        self.inventory[self.currentTime] += newMaterials
-    
+        self.inventory.add(self.currentTime, self.product, self.productSupply.item(self.currentTime))
 
     # Receive an order from an upstream node.
     def receiveOrder(self,originNode,quantity,product):
         if quantity > self.minOrder[product]:
-            self.ordersReceived[self.currentTime][(originNode,product)] = quantity
-            updateAggregatesTemporal(self,self.ordersReceived,self.currentTime,originNode,product,quantity)
-            previouslyOutstanding = noneToZero(findPrevValueRecur(self.upstreamOutstanding, originNode, product, self.currentTime)[0])
-            self.upstreamOutstanding[self.currentTime][(originNode,product)] = previouslyOutstanding + quantity
-            updateAggregatesPersistent(self,self.upstreamOutstanding,self.currentTime,originNode,product,quantity)
+            self.ordersReceived.record(self.currentTime, originNode, product, quantity)
+            self.upstreamOutstanding.carry(self.currentTime, originNode, product, quantity)
+            self.orderBook[product].addOrder(originNode, quantity, self.currentTime)
         else:
             pass
             #print('Node ' + originNode.name + ' attempted to order ' + str(quantity) + ' units of ' + product.name + ', fewer than the minimum order (' +str(self.minOrder[product]) + ') for ' + self.name + '.')
             #print('Order cancelled.')
-    
-    def updateRelationships(self):
-        for node in self.upstream:
-            self.customerRelationships[(self.currenTime,node,self.product)]
 
-    
     # Make a shipment to an upstream node.
     def makeShipment(self,targetNode,quantity,product):
         # Make sure sufficient product exists
         assert quantity > 0
-        if quantity > self.inventory[self.currentTime][product]:
-            pass
+        if quantity > self.inventory.get(self.currentTime, product):
             #print 'Attempted to ship more stock than currently available in inventory'
-            #print 'Shipment cancelled'
-        elif not targetNode in self.supplyChain.successors(self):
-            pass
+            return False
+        elif not targetNode in self.upstream:
             #print 'Attempted to ship to a node without a valid edge in place'
-            #print 'Shipment cancelled'
-            #print "N.B. getNeighbours() can be used to update a node's knowledge of its neighbours"
-        else:
-            # Place the shipment on the edge
-            self.supplyChain.add_edge(self, targetNode, {(self.currentTime,self,targetNode):(0,quantity,product)})
-            self.inventory[self.currentTime][product] -= quantity
-            # Update the outstanding orders
-            previouslyOutstanding = noneToZero(findPrevValueRecur(self.upstreamOutstanding, targetNode, product, self.currentTime)[0])
-            self.upstreamOutstanding[self.currentTime][(targetNode,product)] = previouslyOutstanding - quantity
-            updateAggregatesPersistent(self,self.upstreamOutstanding,self.currentTime,targetNode,product,-quantity)
-            self.shipmentsMade[self.currentTime][(targetNode,product)] = quantity
-            updateAggregatesTemporal(self,self.shipmentsMade,self.currentTime,targetNode,product,quantity)
-    
-    # Finds the time period of the oldest outstanding order from /node/
-    # returns the outstanding quantity and the period in which it was ordered.
-    def findOldestOutstandingOrder(self,node,product,startTime):
-        quantity, orderTime = findNextValueRecur(self.ordersReceived, node, product, 0)
-        shipment, shipmentTime = findNextValueRecur(self.shipmentsMade, node, product, 0)
-        while shipment > 0 and shipmentTime < self.currentTime + 1:
-            quantity -= shipment
-            if quantity <= 0:
-                nextOrder = findNextValueRecur(self.ordersReceived, node, product, orderTime)
-                quantity  += nextOrder[0]
-                orderTime = nextOrder[1]
-            shipment, shipmentTime = findNextValueRecur(self.shipmentsMade, node, product, shipmentTime)
-        return (quantity, orderTime)
-    
-    # Make shipments of /product/ according to order in which orders were placed.
-    def makeAllProductShipments(self,product):
-        totalOutstanding = noneToZero(findPrevValueRecur(self.upstreamOutstanding,'allNodes',product,self.currentTime)[0])
-        # Check there are some orders to fulfil!
-        if totalOutstanding == 0:
-            return True
-        # Check there is any stock to fill orders with
-        if self.inventory[self.currentTime][product] == 0:
-            return True
-        # If we have enough product to fulfill all orders, do so
-        currInventory = self.inventory[self.currentTime].get(product,0)
-        if currInventory >= totalOutstanding:
-            for node in self.upstream:
-                currOutstanding = findPrevValueRecur(self.upstreamOutstanding,node,product,self.currentTime)[0]
-                if currOutstanding > 0:
-                    self.makeShipment(node, currOutstanding, product)
-            return True 
-        # Otherwise, fulfil those orders you can starting with the oldest.
-        else:
-            # Keep going until no more outstanding orders or no more inventory
-            while self.inventory[self.currentTime][product] > 0 and totalOutstanding > 0:
-                # Only bother with the complicated stuff if there's more than one upstream neighbour
-                if len(self.upstream)>1:
-                    # Go through all nodes to find who should get priority
-                    for node in self.upstream:
-                        currOutstanding = findPrevValueRecur(self.upstreamOutstanding,node,product,self.currentTime)[0]
-                        if currOutstanding > 0:
-                            oldestOrders = self.oldestOrder[product]
-                            oldestOrders[node] = self.findOldestOutstandingOrder(node, product, 0)
-                            self.oldestOrderLastCall = self.currentTime
-                            noBest = [0, self.currentTime]
-                            candBest = oldestOrders[node]
-                            if candBest[1] < oldestOrders.get('allNodes',noBest)[1]:
-                                oldestOrders['allNodes'] = candBest
-                                nextNode = node
-                            elif (candBest[1] == oldestOrders.get('allNodes',noBest)[1]
-                                and candBest[0] >= oldestOrders.get('allNodes',noBest)[0]):
-                                oldestOrders['allNodes'] = candBest
-                                nextNode = node
-                        else:
-                            continue
-                    # Having found the oldest order, fulfil in totality if possible.
-                    outstandingOld = oldestOrders.get('allNodes',[0])[0]
-                    if outstandingOld < 1:
-                        return False # Something strange
-                    shipmentSize = min(currInventory, outstandingOld)
-                    self.makeShipment(nextNode, shipmentSize, product)
-                    #print(self.name + ' shipped ' + str(shipmentSize) + ' units of ' + product.name + 'to ' + nextNode.name +'.')
-                else:
-                    prodRemaining = self.inventory[self.currentTime][product]
-                    self.makeShipment(self.upstream[0],prodRemaining,product)
-                    #print(self.name + ' shipped ' + str(prodRemaining) + ' units of ' + product.name + ' to its sole upstream neighbour, ' + self.upstream[0].name +'.')
-            return True
-
-    # Make shipments of all products
+            return False
+        # Place the shipment on the edge
+        self.supplyChain.transport.ship(self, targetNode, quantity, product, self.currentTime)
+        self.inventory.add(self.currentTime, product, -quantity)
+        # Update the outstanding orders
+        self.upstreamOutstanding.carry(self.currentTime, targetNode, product, -quantity)
+        self.orderBook[product].consume(targetNode, quantity)
+        self.shipmentsMade.record(self.currentTime, targetNode, product, quantity, add=True)
+        return True
+
+    # Ship what stock allows against the order book (see allocateShipments).
     def makeAllShipments(self):
-        for product in self.products:
-            self.makeAllProductShipments(product)
-    
+        allocateShipments([self])
+
     # Copy over inventory info
     def updateInventory(self):
-        previousInventory = self.inventory[self.currentTime-1]
-        for product, quantity in previousInventory.iteritems():
-            self.inventory[self.currentTime][product] = quantity
+        self.inventory.copyRow(self.currentTime-1, self.currentTime)
         self.produceMaterials()
-    
+
+    # Share of the units ordered that have been shipped.
+    def calculateHealth(self):
+        try:
+            self.health = self.shipmentsMade.total(('allNodes','allProducts'))/float(self.ordersReceived.total(('allNodes','allProducts')))
+        except ZeroDivisionError:
+            self.health = 1
+        return self.health
+
+    def getHealth(self):
+        return self.health
+
+    def getHealthHistory(self):
+        return self.supplyChain.getNodeHealthHistory(self)
+
+    def getBacklogAge(self,product=None):
+        return self.orderBook[self.product].backlogAge(self.currentTime)
+
+    def getTickSummary(self):
+        backlog = self.orderBook[self.product].totalRemaining
+        return (self.inventory.get(self.currentTime, self.product), self.health, 0, backlog, self.getBacklogAge())
+
     def makeTimeStep(self):
-        self.currentTime += 1        
-        self.updateInvetory()
+        if self.supplyChain.profiler is not None:
+            self.supplyChain.profiler.profileStep(self, self.timeStepPhases())
+            return
+        self.advanceTime()
+        self.updateInventory()
         self.makeAllShipments()
+        self.postHealth()
+
+    # The phases of makeTimeStep as (name, method) pairs, for the network's
+    # profiler. Keep in step with makeTimeStep.
+    def timeStepPhases(self):
+        return [('advanceTime', self.advanceTime),
+                ('updateInventory', self.updateInventory),
+                ('makeAllShipments', self.makeAllShipments),
+                ('postHealth', self.postHealth)]
+
+    def advanceTime(self):
+        self.currentTime += 1
+
+    # Work out the market's health and let the network know.
+    def postHealth(self):
+        self.health = self.calculateHealth()
+        self.supplyChain.updateHealth(self, self.health)
+
+
+# Make the timestep of every commodity market in /markets/ at once,
+# allocating their stock together. Each market steps as makeTimeStep would.
+def stepCommodityMarkets(markets):
+    if markets and markets[0].supplyChain.profiler is not None:
+        for market in markets:
+            market.makeTimeStep()
+        return
+    for market in markets:
+        market.advanceTime()
+        market.updateInventory()
+    allocateShipments(markets)
+    for market in markets:
+        market.postHealth()
+
+# Ship the stock of each of /markets/ against its order book. The open
+# orders of all the markets with the same product and allocationPolicy go
+# through supplyChainAllocation.allocate in one call, and each customer is
+# sent what was allocated to its orders, customers with the oldest orders
+# first.
+def allocateShipments(markets):
+    batches = collections.OrderedDict()
+    for market in markets:
+        for product in market.products:
+            if market.orderBook[product].totalRemaining > 0 and market.inventory.get(market.currentTime, product) > 0:
+                batches.setdefault((product, market.allocationPolicy), []).append(market)
+    for (product, policy), batch in batches.iteritems():
+        supply, starts, quantities, orders = [], [0], [], []
+        for market in batch:
+            entries = market.orderBook[product].openOrders()
+            supply.append(market.inventory.get(market.currentTime, product))
+            quantities.extend(entry[4] for entry in entries)
+            orders.extend(entry[3] for entry in entries)
+            starts.append(len(quantities))
+        filled = allocate(supply, starts, quantities, policy).tolist()
+        for i, market in enumerate(batch):
+            shipments = collections.OrderedDict()
+            for j in range(starts[i], starts[i+1]):
+                if filled[j] > 0:
+                    shipments[orders[j]] = shipments.get(orders[j], 0) + filled[j]
+            for customer, quantity in shipments.iteritems():
+                market.makeShipment(customer, quantity, product)
     
 
 def moveShipments(supplyChain):
-    for node1, node2 in supplyChain.edges():
-        edata = supplyChain[node1][node2]
-        if isinstance(edata,dict):
-            for key in edata:
-                if isinstance(key,tuple):
-                    if edata[key] is None:
-                        continue
-                    travelTime, quant, prod = edata[key]
-                    edata[key]  = (travelTime + 1, quant, prod)
-            for key, val in edata.items():
-                if val == None:
-                    del supplyChain[node1][node2][key]
+    supplyChain.moveShipments()
 
 
 
@@ -1249,8 +2476,8 @@ def createSupplyChainObject(nodeAttribDict, supplyChain):
                 optionalArgs[key] = value
     return nodeClass(*args, **optionalArgs)
 
-def decayInt(ratio):
-    r = random.random()
+def decayInt(ratio,rng=random):
+    r = rng.random()
     decrement = 0.5
     r -= decrement
     output = 0
@@ -1277,7 +2504,7 @@ def getBaseProduct(nodeData,finishedProduct,productObjects):
         product = productObjects[product]
     return product
 
-def getComponentProducts(nodeName,nodeData,productObjects,G):
+def getComponentProducts(nodeName,nodeData,productObjects,G,rng=random):
     ''' Returns a dictionary of products from downstream nodes
     along with (randomised) integers which represent the quantity
     used in the recipe for building the node's base product '''
@@ -1299,11 +2526,11 @@ def getComponentProducts(nodeName,nodeData,productObjects,G):
             # If we've not already encountered this product at another dsNode
             if not dsProducts.get(productObjects[prodName]):
                 # Add it to dsProducts dict with a value somewhere between 1 (likely) and 6 (extremely unlikely)
-                dsProducts[productObjects[prodName]] = dsProducts.get(prodName,1) + decayInt(0.52)
+                dsProducts[productObjects[prodName]] = dsProducts.get(prodName,1) + decayInt(0.52,rng)
             # Otherwise
             else:
                 # Increment the value by some integer between 0 (likely) and 5 (extremely unlikely)
-                dsProducts[productObjects[prodName]] += decayInt(0.52)
+                dsProducts[productObjects[prodName]] += decayInt(0.52,rng)
     return dsProducts
     
 def getBuildInstructions(nodeData,baseProduct,componentProducts):
@@ -1323,30 +2550,68 @@ def getNodeRole(nodeName,G):
         else:
                 return 'supply chain'
 
-def getImpliedDemand(graph,myNode,dataDict):
+# Units of its base product that the node at /myNode/ should aim to hold, given
+# what its customers (successors) need. Customers whose targetInventory is not
+# yet in /dataDict/ contribute their own implied demand, which is kept in /memo/.
+# Working through the graph in topologicalOrder means that never happens; when
+# it does, those customers are worked out from an explicit stack rather than
+# by recursion, so a long chain of them can't hit the recursion limit.
+def getImpliedDemand(graph,myNode,dataDict,memo=None):
+    if memo is None:
+        memo = dict()
+    def pending(node):
+        return [usNode for usNode in graph.successors(node) if dataDict[usNode]['nodeRole'] == 'supply chain'
+                and dataDict[usNode].get('targetInventory') is None and not usNode in memo]
+    # Each customer still to work out is finished only once its own pending
+    # customers are. /path/ holds the customers waiting on others, so meeting
+    # one of them again means the graph has a cycle.
+    stack = [(usNode, False) for usNode in pending(myNode)]
+    path = set([myNode])
+    while stack:
+        node, ready = stack.pop()
+        if ready:
+            memo[node] = impliedDemandFrom(graph,node,dataDict,memo)
+            path.discard(node)
+            continue
+        if node in memo:
+            continue
+        stack.append((node, True))
+        path.add(node)
+        for usNode in pending(node):
+            if usNode in path:
+                raise supplyChainCycleError(list(path))
+            stack.append((usNode, False))
+    return impliedDemandFrom(graph,myNode,dataDict,memo)
+
+# Implied demand of /myNode/ (see getImpliedDemand) once every customer has a
+# targetInventory in /dataDict/ or an implied demand in /memo/.
+def impliedDemandFrom(graph,myNode,dataDict,memo):
     impliedDemand = 0
     for usNode in graph.successors(myNode):
             usNodeData = dataDict[usNode]
             if usNodeData['nodeRole'] ==  'retail market':
                 impliedDemand += int(2*math.floor(usNodeData['initialDemand']/len(graph.predecessors(usNode))))
             elif usNodeData['nodeRole'] == 'supply chain':
-                target = usNodeData.get('targetInventory',getImpliedDemand(graph,usNode,dataDict))
+                target = usNodeData.get('targetInventory')
+                if target is None:
+                    target = memo[usNode]
                 if type(target) is dict:
                     target = target[dataDict[myNode]['product']]
                 impliedDemand += int(target/len(graph.successors(usNode)))
     return impliedDemand
 
-def getInitialDemand(minDemand):
-    return minDemand + decayInt(0.501)*100 + decayInt(0.501)*50 + decayInt(0.501)*10
+def getInitialDemand(minDemand,rng=random):
+    return minDemand + decayInt(0.501,rng)*100 + decayInt(0.501,rng)*50 + decayInt(0.501,rng)*10
 
-def generic2Supply(nxGraph,name,simLength,finishedProduct):
-    # Create the supplyChainNetwork object
-    scNetwork = supplyChainNetwork(name,simulationLength=simLength)
+# Work out the attributes of every supply chain actor, and the traverse time
+# of every edge, from a generic graph. Random choices are drawn from /rng/.
+# Returns (nodeSpecs, edgeSpecs): a list of attribute dictionaries for
+# createSupplyChainObject, in creation order, and a list of (label, label, edata).
+def compileSupplySpec(nxGraph,finishedProduct,rng=random):
     # Make a copy of the old graph's data
     originalNodes = nxGraph.nodes(data=True)
     newNodes = []
     newNodesDict = dict()
-    nodeMap = dict()
     # Sort the nodes so the list starts with the raw materials
     originalNodes = sorted(originalNodes, key=lambda x: x[1]['depth'], reverse=True)
     originalNodes = sorted(originalNodes, key=lambda x: x[1]['tier'], reverse=True)
@@ -1359,18 +2624,22 @@ def generic2Supply(nxGraph,name,simLength,finishedProduct):
         newData['nodeRole'] = getNodeRole(nodeName, nxGraph)
         newData['product'] = getBaseProduct(newData,finishedProduct,productObjects)
         if newData.get('tier') >= 0:
-            newData['dsProducts'] = getComponentProducts(nodeName,originalData,productObjects,nxGraph)
+            newData['dsProducts'] = getComponentProducts(nodeName,originalData,productObjects,nxGraph,rng)
             newData['buildInstructions'] = getBuildInstructions(newData,newData['product'],newData.get('dsProducts',dict()))
         newNodes.append(newData)
         newNodesDict[newData['label']] = newData
     newNodes = sorted(newNodes, key=itemgetter('tier'))
     newNodes = sorted(newNodes, key=itemgetter('depth'))
     for nodeData in newNodes:
-        targetInven = nodeData.get('targetInventory')
         if nodeData['nodeRole'] == 'retail market':
-            nodeData['initialDemand'] = getInitialDemand(50)
+            nodeData['initialDemand'] = getInitialDemand(50,rng)
             nodeData['rngSeed'] = 999
-        else:
+    # Work out targets customers first, so that each node's implied demand
+    # comes straight from its customers' targets.
+    for label in topologicalOrder(nxGraph):
+        nodeData = newNodesDict[label]
+        targetInven = nodeData.get('targetInventory')
+        if nodeData['nodeRole'] != 'retail market':
             if targetInven is None:
                 targetInven = {nodeData['product'] : 0}
             impliedDemand = getImpliedDemand(nxGraph,nodeData['label'],newNodesDict)
@@ -1381,115 +2650,615 @@ def generic2Supply(nxGraph,name,simLength,finishedProduct):
                 nodeData['processingCapacity'] = {nodeData['product'] : int(0.25*targetInven[nodeData['product']])}
             nodeData['targetInventory'] = targetInven
             nodeData['storageCapacity'] = len(nodeData['targetInventory'])*nodeData['targetInventory'][nodeData['product']]
-        nodeInstance = createSupplyChainObject(nodeData, scNetwork)
-        if nodeInstance == None:
-            pass
-        scNetwork.add_node(nodeInstance)
-        nodeMap[nodeData['label']] = nodeInstance
+    edgeSpecs = []
     for n1, n2, edata in nxGraph.edges(data=True):
         dist = edata.get('distance')
         if dist:
             edata.update({'timeToTraverse':math.ceil(dist/800000.0)})
         else:
-            edata.update({'timeToTraverse':1 + 10*decayInt(0.6) + decayInt(0.501)})
-        scNetwork.add_edge(nodeMap[n1],nodeMap[n2],attr_dict=edata)
+            edata.update({'timeToTraverse':1 + 10*decayInt(0.6,rng) + decayInt(0.501,rng)})
+        edgeSpecs.append((n1, n2, dict(edata)))
+    return newNodes, edgeSpecs
+
+# Create a supplyChainNetwork from the output of compileSupplySpec, leaving
+# out the actors labelled in /excludeLabels/ (and their edges). Delivered
+# shipments are only kept with /shipmentHistory/ (see supplyChainTransport).
+def spec2Supply(nodeSpecs,edgeSpecs,name,simLength,excludeLabels=(),historyWindow=None,shipmentHistory=False):
+    scNetwork = supplyChainNetwork(name,simulationLength=simLength,shipmentHistory=shipmentHistory,historyWindow=historyWindow)
+    nodeMap = dict()
+    for nodeData in nodeSpecs:
+        if nodeData['label'] in excludeLabels:
+            continue
+        nodeInstance = createSupplyChainObject(nodeData, scNetwork)
+        scNetwork.add_node(nodeInstance)
+        nodeMap[nodeData['label']] = nodeInstance
+    for n1, n2, edata in edgeSpecs:
+        if n1 in nodeMap and n2 in nodeMap:
+            scNetwork.add_edge(nodeMap[n1],nodeMap[n2],attr_dict=edata)
+    return scNetwork
+
+def generic2Supply(nxGraph,name,simLength,finishedProduct,rng=random,shipmentHistory=False):
+    nodeSpecs, edgeSpecs = compileSupplySpec(nxGraph,finishedProduct,rng)
+    return spec2Supply(nodeSpecs,edgeSpecs,name,simLength,shipmentHistory=shipmentHistory)
+
+# A compiled network: everything generic2Supply works out from a generic graph
+# and a seed, ready to be turned into fresh supplyChainNetworks cheaply. The
+# random state left over after compiling is kept so that an instantiated
+# network draws the same market noise as runSimulation would.
+# Templates are immutable; actors created from one share its (read only)
+# target inventory, recipe and capacity dictionaries.
+class supplyChainTemplate(object):
+    def __init__(self, nodeSpecs, edgeSpecs, rngState=None):
+        object.__setattr__(self, 'nodeSpecs', tuple(nodeSpecs))
+        object.__setattr__(self, 'edgeSpecs', tuple(edgeSpecs))
+        object.__setattr__(self, 'rngState', rngState)
+
+    def __repr__(self):
+        return "supplyChainTemplate(nodes=%r,edges=%r)" % (len(self.nodeSpecs), len(self.edgeSpecs))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('supplyChainTemplate is immutable')
+
+    # Compile graph G (which must already have depths, see calculateDepth).
+    # As with generic2Supply, G's edges gain a timeToTraverse attribute.
+    @classmethod
+    def fromGraph(cls, G, seed, finishedProduct=None):
+        if finishedProduct is None:
+            finishedProduct = supplyChainProduct('laptop')
+        rng = random.Random(seed)
+        nodeSpecs, edgeSpecs = compileSupplySpec(G, finishedProduct, rng)
+        return cls(nodeSpecs, edgeSpecs, rng.getstate())
+
+    # A fresh network, ready to step. Unless /rng/ is given, market noise
+    # carries on from the compile seed. /historyWindow/ bounds the history
+    # the actors keep (see supplyChainNetwork.newLedger); delivered shipments
+    # are only kept with /shipmentHistory/.
+    def instantiate(self, name, simulationLength, excludeLabels=(), rng=None, historyWindow=None, shipmentHistory=False):
+        scNetwork = spec2Supply(self.nodeSpecs, self.edgeSpecs, name, simulationLength, excludeLabels, historyWindow, shipmentHistory)
+        if rng is None:
+            rng = random.Random()
+            rng.setstate(self.rngState)
+        scNetwork.rng = rng
+        scNetwork.giveNodeContext()
+        return scNetwork
+
+    # Give G's edges the timeToTraverse attributes compiling it would have added.
+    def annotateGraph(self, G):
+        for n1, n2, edata in self.edgeSpecs:
+            if G.has_edge(n1, n2):
+                G[n1][n2]['timeToTraverse'] = edata['timeToTraverse']
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            cPickle.dump(self, f, cPickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as f:
+            template = cPickle.load(f)
+        if not isinstance(template, cls):
+            raise TypeError('%s does not hold a supplyChainTemplate' % (filename))
+        return template
+
+# The node and edge attributes that compiling a graph, or the actors built from
+# it, read. Anything else on the graph (footprint intensity, results, popups)
+# leaves the compiled network as it is.
+TEMPLATE_NODE_ATTRIBUTES = ('label', 'name', 'tier', 'depth', 'activity', 'product', 'dsProducts',
+                            'buildInstructions', 'targetInventory', 'storageCapacity', 'initialStorageUsed',
+                            'processingCapacity', 'minOrder', 'allocationPolicy', 'initialDemand', 'initialSupply',
+                            'initialInventory', 'marketShare', 'rngSeed', 'startTime', 'currentTime')
+TEMPLATE_EDGE_ATTRIBUTES = ('distance',)
+
+# Cached templates beyond this many, or unused for this many seconds, are removed.
+CACHE_MAX_ENTRIES = 64
+CACHE_MAX_AGE = 7*24*60*60
+
+class supplyChainCacheError(ValueError):
+    pass
+
+# A stable digest of graph G's nodes, edges and attributes, or only the
+# attributes named in /nodeAttributes/ and /edgeAttributes/ if they are given.
+def graphHash(G, nodeAttributes=None, edgeAttributes=None):
+    def canonical(value):
+        if isinstance(value, dict):
+            return sorted((canonical(key), canonical(val)) for key, val in value.iteritems())
+        if isinstance(value, (list, tuple)):
+            return [canonical(val) for val in value]
+        return value
+    def pick(data, keys):
+        return data if keys is None else dict((key, data[key]) for key in keys if key in data)
+    digest = hashlib.sha1()
+    for n, data in sorted(G.nodes_iter(data=True)):
+        digest.update(repr((n, canonical(pick(data, nodeAttributes)))))
+    for n1, n2, data in sorted(G.edges_iter(data=True)):
+        digest.update(repr((n1, n2, canonical(pick(data, edgeAttributes)))))
+    return digest.hexdigest()
+
+# /template/ (compiled from graph G) without the attributes it copied from G
+# that are not in TEMPLATE_NODE_ATTRIBUTES or TEMPLATE_EDGE_ATTRIBUTES.
+def structuralTemplate(template, G):
+    nodeSpecs = []
+    for nodeData in template.nodeSpecs:
+        original = G.node[nodeData['label']]
+        nodeSpecs.append(dict((key, value) for key, value in nodeData.iteritems()
+                              if key not in original or key in TEMPLATE_NODE_ATTRIBUTES))
+    edgeSpecs = [(n1, n2, dict((key, value) for key, value in edata.iteritems()
+                               if key == 'timeToTraverse' or key in TEMPLATE_EDGE_ATTRIBUTES))
+                 for n1, n2, edata in template.edgeSpecs]
+    return supplyChainTemplate(nodeSpecs, edgeSpecs, template.rngState)
+
+# Whether the file or directory with os.stat result /info/ belongs to this
+# user and nobody else can write to it (or, for /private/, read it). Where
+# there are no user ids (Windows) this is left to the directory's ACL.
+def ownedByUs(info, private=False):
+    if not hasattr(os, 'getuid'):
+        return True
+    return info.st_uid == os.getuid() and not info.st_mode & (0o077 if private else 0o022)
+
+# Make /cacheDir/ if need be, readable by this user only, and check that it is
+# a directory of ours that nobody else can write to.
+def checkCacheDir(cacheDir):
+    if not os.path.lexists(cacheDir):
+        try:
+            os.makedirs(cacheDir, 0o700)
+        except OSError:
+            if not os.path.isdir(cacheDir):
+                raise
+    info = os.lstat(cacheDir)
+    if not stat.S_ISDIR(info.st_mode):
+        raise supplyChainCacheError('Template cache %s is not a directory' % (cacheDir))
+    if not ownedByUs(info):
+        raise supplyChainCacheError('Template cache %s is not owned by this user, or others can write to it' % (cacheDir))
+
+# The template in cache file /filename/, or None if there is none we can trust:
+# the file must be a regular file of ours that only we can read or write.
+def readCacheEntry(filename):
+    try:
+        fd = os.open(filename, os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0) | getattr(os, 'O_BINARY', 0))
+    except OSError:
+        return None
+    with os.fdopen(fd, 'rb') as f:
+        info = os.fstat(fd)
+        if not stat.S_ISREG(info.st_mode) or not ownedByUs(info, private=True):
+            return None
+        try:
+            template = cPickle.load(f)
+        except (EOFError, TypeError, AttributeError, ImportError, IndexError, ValueError, KeyError, cPickle.UnpicklingError):
+            return None # Recompile over a damaged cache entry.
+    return template if isinstance(template, supplyChainTemplate) else None
+
+# Remove cache entries from /cacheDir/ that have not been used for /maxAge/
+# seconds, then the least recently used beyond /maxEntries/.
+def pruneCache(cacheDir, maxEntries=CACHE_MAX_ENTRIES, maxAge=CACHE_MAX_AGE):
+    entries = []
+    for entry in os.listdir(cacheDir):
+        if entry.endswith('.pickle') or entry.endswith('.tmp'):
+            filename = os.path.join(cacheDir, entry)
+            try:
+                entries.append((os.lstat(filename).st_mtime, filename))
+            except OSError:
+                pass # Removed by another process.
+    entries.sort(reverse=True)
+    cutOff = time.time() - maxAge
+    for i, (lastUsed, filename) in enumerate(entries):
+        if i >= maxEntries or lastUsed < cutOff:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+# Load the template for (G, seed) from /cacheDir/, compiling and saving it
+# if it is not there yet. Entries are keyed by the structure of G (see
+# TEMPLATE_NODE_ATTRIBUTES), so graphs that differ only in other attributes share one,
+# and the cache is pruned (see pruneCache) whenever a new entry is written.
+# /cacheDir/ must be private to this user (see checkCacheDir), since loading
+# an entry unpickles it.
+def cachedTemplate(G, seed, cacheDir, finishedProduct=None, maxEntries=CACHE_MAX_ENTRIES, maxAge=CACHE_MAX_AGE):
+    productName = 'laptop' if finishedProduct is None else finishedProduct.name
+    checkCacheDir(cacheDir)
+    key = graphHash(G, TEMPLATE_NODE_ATTRIBUTES, TEMPLATE_EDGE_ATTRIBUTES)
+    filename = os.path.join(cacheDir, '%s-%s-%s.pickle' % (key, seed, productName))
+    template = readCacheEntry(filename)
+    if template is not None:
+        os.utime(filename, None)
+        template.annotateGraph(G)
+    else:
+        template = structuralTemplate(supplyChainTemplate.fromGraph(G, seed, finishedProduct), G)
+        # Write then rename, so concurrent runs never read a partial file.
+        handle, tempName = tempfile.mkstemp(suffix='.tmp', dir=cacheDir)
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                cPickle.dump(template, f, cPickle.HIGHEST_PROTOCOL)
+            if os.name == 'nt' and os.path.exists(filename):
+                os.remove(filename)
+            os.rename(tempName, filename)
+        except:
+            os.remove(tempName)
+            raise
+        pruneCache(cacheDir, maxEntries, maxAge)
+    return template
+
+CHECKPOINT_VERSION = 1
+
+# Pickle the state of /scNetwork/ to file object /f/. The actors and the
+# network are pickled by reference: a header lists the actors' classes and
+# hashes, so that readCheckpoint can make empty actors to stand for them
+# before any dictionary keyed by an actor is rebuilt.
+def writeCheckpoint(scNetwork, f):
+    actors = scNetwork.nodes()
+    references = dict((id(actor), 'actor%d' % (i)) for i, actor in enumerate(actors))
+    references[id(scNetwork)] = 'network'
+    pickler = cPickle.Pickler(f, cPickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = lambda obj: references.get(id(obj))
+    header = {'version': CHECKPOINT_VERSION,
+              'actors': [(actor.__class__, getattr(actor, 'myHash', None)) for actor in actors]}
+    pickler.dump(header)
+    networkState = dict(scNetwork.__dict__)
+    del networkState['sinks'], networkState['rng'], networkState['profiler']
+    networkState['sinkNodes'] = None
+    if scNetwork.rng is random:
+        rngState = ('random', random.getstate())
+    else:
+        rngState = ('private', scNetwork.rng)
+    pickler.dump((networkState, [actor.__dict__ for actor in actors], rngState))
+
+# Rebuild the network pickled to /f/ by writeCheckpoint. With restoreRandom,
+# a network that drew from the random module sets the module back to its
+# saved state; otherwise it is given a random.Random in that state.
+def readCheckpoint(f, restoreRandom=True):
+    references = dict()
+    unpickler = cPickle.Unpickler(f)
+    unpickler.persistent_load = references.__getitem__
+    header = unpickler.load()
+    if not isinstance(header, dict) or header.get('version') != CHECKPOINT_VERSION:
+        raise ValueError('not a version %d supply chain checkpoint' % (CHECKPOINT_VERSION))
+    scNetwork = supplyChainNetwork.__new__(supplyChainNetwork)
+    references['network'] = scNetwork
+    actors = []
+    for i, (cls, myHash) in enumerate(header['actors']):
+        actor = cls.__new__(cls)
+        if myHash is not None:
+            actor.myHash = myHash
+        references['actor%d' % (i)] = actor
+        actors.append(actor)
+    networkState, actorStates, rngState = unpickler.load()
+    scNetwork.__dict__.update(networkState)
+    for actor, state in zip(actors, actorStates):
+        actor.__dict__.update(state)
+    scNetwork.sinks = []
+    scNetwork.profiler = None
+    kind, state = rngState
+    if kind == 'private':
+        scNetwork.rng = state
+    elif restoreRandom:
+        random.setstate(state)
+        scNetwork.rng = random
+    else:
+        scNetwork.rng = random.Random()
+        scNetwork.rng.setstate(state)
     return scNetwork
     
 
-def exportAsGeneric(scNetwork, oldGraph=None, filename=None):
+# Attributes of the actors of /scNetwork/ and of its edges, as columns:
+#   nodes   'label', 'time', 'health', 'product', 'currInventory' (units by
+#           product name) and 'salesLost', a list per attribute aligned
+#           with 'label', holding None where an actor has no such attribute
+#   edges   'source' and 'target' labels of each edge, customers first, and
+#           with /shipments/, 'shipments': the shipments made along each
+#           edge as {timeWhenShipped: {'timeOnEdge', 'quantity', 'product'}}
+def exportColumns(scNetwork, shipments=False):
+    actors = scNetwork.orderedNodes()
+    nodes = dict((name, [None]*len(actors)) for name in EXPORT_NODE_COLUMNS)
+    nodes['label'] = [actor.name for actor in actors]
+    nodes['time'] = [actor.currentTime for actor in actors]
+    nodes['health'] = [actor.health for actor in actors]
+    for i, actor in enumerate(actors):
+        if isinstance(actor, supplyChainNode):
+            inventory = actor.inventory.row(actor.currentTime)
+            if len(actor.buildInstructions) > 0:
+                nodes['product'][i] = next(iter(actor.buildInstructions)).name
+            elif len(inventory) == 1:
+                nodes['product'][i] = actor.products[0].name
+            nodes['currInventory'][i] = dict((product.name, quantity) for product, quantity in inventory.iteritems())
+            nodes['salesLost'][i] = actor.salesLost.total(('allNodes','allProducts'))
+    edges = {'source': [], 'target': []}
+    for actor in actors:
+        if actor.label is None:
+            continue
+        for customer in actor.upstream:
+            if customer is not None and customer.label is not None:
+                edges['source'].append(actor)
+                edges['target'].append(customer)
+    if shipments:
+        edges['shipments'] = edgeShipmentColumn(scNetwork.transport, edges['source'], edges['target'])
+    edges['source'] = [actor.label for actor in edges['source']]
+    edges['target'] = [actor.label for actor in edges['target']]
+    return {'nodes': nodes, 'edges': edges}
+
+EXPORT_NODE_COLUMNS = ('label', 'time', 'health', 'product', 'currInventory', 'salesLost')
+
+# The shipments made along each edge /origins/[i] -> /targets/[i], read from
+# the columns of the transport's stores in one pass per store. Delivered
+# shipments (if history is kept) have their timeOnEdge offset by
+# -simulationLength. A shipment in transit replaces a delivered one made at
+# the same time.
+def edgeShipmentColumn(transport, origins, targets):
+    actorIndex = transport.actorIndex
+    edgeIndex = dict(((actorIndex.get(origin), actorIndex.get(target)), i)
+                     for i, (origin, target) in enumerate(zip(origins, targets)))
+    column = [dict() for __ in origins]
+    productNames = [product.name for product in transport.products]
+    currentTime = transport.supplyChain.currentTime
+    for store, delivered in [(transport.history, True), (transport.shipments, False)]:
+        if store is None:
+            continue
+        rows = store.liveRows()
+        if delivered:
+            timeOnEdge = currentTime - store.timeReceived[rows] - transport.supplyChain.simulationLength
+        else:
+            timeOnEdge = currentTime - store.timePlaced[rows]
+        for origin, target, timeWhenShipped, onEdge, quantity, product in zip(store.origin[rows].tolist(),
+                store.target[rows].tolist(), store.timeWhenShipped[rows].tolist(), timeOnEdge.tolist(),
+                store.quantity[rows].tolist(), store.product[rows].tolist()):
+            i = edgeIndex.get((origin, target))
+            if i is not None:
+                column[i][timeWhenShipped] = {'timeOnEdge': onEdge, 'quantity': quantity, 'product': productNames[product]}
+    return column
+
+# Write the state of /scNetwork/ onto generic graph /oldGraph/ (or a new
+# one), from exportColumns, and save it to /filename/ if given. Shipment
+# history is only put on the edges with /shipments/, as building it takes
+# longer than the rest of the export on a long run.
+def exportAsGeneric(scNetwork, oldGraph=None, filename=None, shipments=False):
     if oldGraph is None:
         G = nx.DiGraph()
     else:
         G = oldGraph
-    # Loop through the graph, starting with the retail nodes.
-    for node in scNetwork.orderedNodes():
-        newData = dict()
-        t = node.currentTime
-        newData['time'] = t
-        if isinstance(node, supplyChainNode):
-            if len(node.buildInstructions) > 0:
-                outputProds = [prod for prod in node.buildInstructions]
-                newData['product'] = outputProds[0].name
-            elif len(node.inventory[t]) == 1:
-                newData['product'] = node.products[0].name
-            myInven = node.inventory[t]
-            mySimpleInven = dict()
-            prodHealthVals = []
-            for prod, quant in myInven.iteritems():
-                mySimpleInven[prod.name] = quant
-                prodHealthVals.append(quant/max(node.targetInventory[prod],1))
-            newData['currInventory'] = mySimpleInven
-            if hasattr(node, 'salesLost'):
-                newData['salesLost'] = node.salesLost[node.simulationLength].get(('allNodes','allProducts'),0)
-            dSum = 0
-            for prodHealth in prodHealthVals:
-                dSum += abs(1-prodHealth)
-            newData['health'] = node.health
-        elif isinstance(node, supplyChainRetailMarket):
-            newData['health'] = node.health
-        G.add_node(node.name, newData)
-        if len(node.upstream) > 0: 
-            for usNode in node.upstream:
-                if usNode is None:
-                    pass
-                edgeData = dict()
-                edge_attr_dict = scNetwork.get_edge_data(node,usNode)
-                for key, value in edge_attr_dict.iteritems():
-                    if type(key) is tuple:
-                        newKey = key[0]
-                        newVal = {'timeOnEdge': edge_attr_dict[key][0], 'quantity' : edge_attr_dict[key][1], 'product': edge_attr_dict[key][2].name}
-                        valString = ', '.join(newVal)
-                        edgeData[newKey] = newVal
-                if node.label is None or usNode.label is None:
-                        continue
-                G.add_edge(node.label,usNode.label,attr_dict=edgeData)
+    columns = exportColumns(scNetwork, shipments)
+    nodes = columns['nodes']
+    names = [name for name in EXPORT_NODE_COLUMNS if name != 'label']
+    G.add_nodes_from((label, dict((name, value) for name, value in zip(names, values) if value is not None))
+                     for label, values in zip(nodes['label'], zip(*[nodes[name] for name in names])))
+    edges = columns['edges']
+    if shipments:
+        G.add_edges_from(zip(edges['source'], edges['target'], edges['shipments']))
+    else:
+        G.add_edges_from(zip(edges['source'], edges['target']))
     if not filename is None:
-        nx.write_gexf(G, filename)
+        # Binary network files (see supplyChainBinary) also keep the health history.
+        results = resultColumns(scNetwork, G) if filename.endswith(binaryExtension) else None
+        writeGraph(G, filename, results)
     return G
 
+# Per-tick results of /scNetwork/ for the nodes of /G/, in G.nodes() order:
+# node health at every timestep so far (NaN for nodes not in the network).
+# With a historyWindow, only the timesteps still held are exported, the
+# last of them being the current timestep.
+def resultColumns(scNetwork, G):
+    scNetwork.checkHealthIndex()
+    column = dict((actor.label, i) for i, actor in enumerate(scNetwork.healthNodes))
+    labels = G.nodes()
+    times, rows = scNetwork.heldTimes()
+    health = np.empty((len(times), len(labels)))
+    health.fill(np.nan)
+    present = [(j, column[label]) for j, label in enumerate(labels) if label in column]
+    if present:
+        positions, columns = zip(*present)
+        health[:, positions] = scNetwork.nodeHealthHistory[np.ix_(rows, columns)]
+    return {'health': health}
+
+# Read a generic graph from /filename/, GEXF or binary (see supplyChainBinary).
 def getGexf(filename,simLength):
-    G = nx.read_gexf(filename)
+    G = readGraph(filename)
     new = generic2Supply(G,filename,simLength)
     return new
 
-def calculateDepth(G):
-    ''' Add depth attribute to all nodes in networkX graph G'''
-    
-    def setNodeDepth(G,theNode):
-        ''' Recursively calculate the depth of a particular node '''
-        if len(G.successors(theNode)) == 0:
-            G.node[theNode]['depth'] = 0
+# Raised when a supply chain graph has a cycle, so has no topological order.
+class supplyChainCycleError(ValueError):
+    def __init__(self, nodes):
+        self.nodes = nodes # Nodes on, or downstream of, a cycle.
+        ValueError.__init__(self, 'Supply chain graph has a cycle through some of: %r' % (sorted(nodes)[:10],))
+
+def topologicalOrder(G):
+    ''' Nodes of G ordered so that each comes after all of its successors
+    (i.e. retail markets first, raw materials last). '''
+    remaining = dict((n, len(G.successors(n))) for n in G.nodes_iter())
+    order = [n for n, count in remaining.iteritems() if count == 0]
+    i = 0
+    while i < len(order):
+        for dsNode in G.predecessors(order[i]):
+            remaining[dsNode] -= 1
+            if remaining[dsNode] == 0:
+                order.append(dsNode)
+        i += 1
+    if len(order) < len(remaining):
+        raise supplyChainCycleError([n for n, count in remaining.iteritems() if count > 0])
+    return order
+
+def calculateDepth(G, order=None):
+    ''' Add depth attribute to all nodes in networkX graph G: the number of
+    edges to the nearest node with no successors (a retail market). Also
+    labels each node with its name. Returns a dictionary of depths. '''
+    if order is None:
+        order = topologicalOrder(G)
+    depths = dict()
+    for theNode in order:
+        usDepths = [depths[usNode] for usNode in G.successors(theNode)]
+        depths[theNode] = min(usDepths) + 1 if usDepths else 0
+        G.node[theNode]['depth'] = depths[theNode]
+        G.node[theNode]['label'] = theNode
+    return depths
+
+
+# Explode finished goods demand through the recipes of /scNetwork/ in one
+# pass, from the retail markets to the raw materials. /demand/ is keyed by
+# retail market, and defaults to each market's current demand. As orders
+# are, a market's demand is split between its suppliers by market share,
+# and a node's demand for a product it does not build between its suppliers
+# by stockist preference (or equally). Demand for a product the node has a
+# recipe for becomes demand for the components (recipes.componentDemand).
+# Returns (rawDemand, nodeDemand): units wanted of each product that nobody
+# supplies, keyed by product, and units wanted from each node, keyed by
+# (node, product).
+def explodeBillOfMaterials(scNetwork, demand=None):
+    markets = [actor for actor in scNetwork.nodes_iter() if isinstance(actor, supplyChainRetailMarket)]
+    if demand is None:
+        demand = dict((market, market.marketDemand[market.currentTime]) for market in markets)
+    nodeDemand = collections.defaultdict(float)
+    rawDemand = collections.defaultdict(float)
+    for actor in topologicalOrder(scNetwork):
+        wanted = dict()
+        if isinstance(actor, supplyChainRetailMarket):
+            wanted[actor.product] = demand.get(actor, 0)
+            shares = actor.marketShare[actor.currentTime]
+            preferences = {actor.product: dict((node, shares.get((node, actor.product), 0)) for node in actor.downstream)}
+        elif isinstance(actor, supplyChainNode):
+            recipes = actor.recipes
+            outputUnits = np.zeros(len(recipes.outputs))
+            for product in actor.products:
+                units = nodeDemand.get((actor, product), 0)
+                i = recipes.productIndex.get(product)
+                if i is not None and i < len(recipes.outputs) and recipes.rowStart[i+1] > recipes.rowStart[i]:
+                    outputUnits[i] = units
+                elif units:
+                    wanted[product] = units
+            for j, units in enumerate(recipes.componentDemand(outputUnits)):
+                if units:
+                    wanted[recipes.products[j]] = wanted.get(recipes.products[j], 0) + units
+            preferences = actor.stockistPreferences
         else:
-            minDepth = 0
-            for usNode in G.successors(theNode):
-                usNodeDepth = G.node[usNode].get('depth',setNodeDepth(G,usNode))
-                if usNodeDepth < minDepth:
-                    minDepth = usNodeDepth
-            G.node[theNode]['depth'] = minDepth + 1
-
-    nodeList = []
-    for thisNode in G.nodes():
-        nodeList.append(G.node[thisNode])
-        nodeList[-1]['label'] = thisNode
-    nodeList = sorted(nodeList, key=itemgetter('tier'))
-    for myNode in nodeList:
-        setNodeDepth(G,myNode['label'])   
-    
-
-def runSimulation(G,timesteps,randSeed,networkName=None,initOutFile=None,finOutFile=None):
+            continue
+        for product, units in wanted.iteritems():
+            suppliers = [node for node in actor.downstream if product in node.products]
+            if not suppliers:
+                rawDemand[product] += units
+                continue
+            weights = [preferences.get(product, dict()).get(supplier, 0) for supplier in suppliers]
+            if sum(weights) <= 0:
+                weights = [1.0 for supplier in suppliers]
+            for supplier, weight in zip(suppliers, weights):
+                nodeDemand[(supplier, product)] += units*weight/float(sum(weights))
+    return dict(rawDemand), dict(nodeDemand)
+
+
+ENGINES = ['object', 'vector']
+
+# Step /scNetwork/ /timesteps/ times with the given engine (see runSimulation).
+def stepNetwork(scNetwork, timesteps, engine='object'):
+    if not engine in ENGINES:
+        raise ValueError("engine must be 'object' or 'vector', not %r" % (engine,))
+    if engine == 'vector':
+        from supplyChainVector import supplyChainVectorEngine
+        supplyChainVectorEngine(scNetwork).run(timesteps)
+    else:
+        for i in range(timesteps):
+            scNetwork.makeTimeStep()
+    return scNetwork.health
+
+# Run the model on graph G for /timesteps/ steps. engine='vector' steps the
+# network with the batched NumPy engine in supplyChainVector instead of node by
+# node; see that module for how far its results can differ. With a cacheDir,
+# the compiled network is kept there (see cachedTemplate) for later runs.
+# Each of /sinks/ (see supplyChainSink) is sent a record every timestep and
+# closed at the end of the run. A /profiler/ (see supplyChainProfiler) is
+# sent the time taken by each phase of the run.
+# Delivered shipments are only kept, and put on G's edges, with /exportShipments/.
+# G (and initOutFile and finOutFile) may be GEXF or binary network files;
+# output files ending in .scn are written in the binary format.
+# A /template/ already compiled from G with randSeed (see
+# supplyChainTemplate.fromGraph) is run as it is, rather than compiled again.
+def runSimulation(G,timesteps,randSeed,networkName=None,initOutFile=None,finOutFile=None,engine='object',cacheDir=None,sinks=(),profiler=None,historyWindow=None,exportShipments=False,template=None):
+    if not engine in ENGINES:
+        raise ValueError("engine must be 'object' or 'vector', not %r" % (engine,))
+    if profiler is not None:
+        start = profiler.clock()
     if type(G) == str:
-        G = nx.read_gexf(G)
+        G = readGraph(G)
     if networkName is None:
         networkName = 'supplyChain' + datetime.datetime.today().strftime('%Y-%m-%d %H:%M:%S')
     calculateDepth(G)
-    random.seed(randSeed)
     simLength = timesteps + 1
-    laptop = supplyChainProduct('laptop')
-    scNetwork = generic2Supply(G,networkName,simLength, laptop)
-    scNetwork.giveNodeContext()
+    if template is None:
+        if cacheDir is None:
+            template = supplyChainTemplate.fromGraph(G, randSeed)
+        else:
+            template = cachedTemplate(G, randSeed, cacheDir)
+    scNetwork = template.instantiate(networkName, simLength, historyWindow=historyWindow, shipmentHistory=exportShipments)
+    scNetwork.profiler = profiler
+    for sink in sinks:
+        scNetwork.addSink(sink)
     if not initOutFile is None:
-        exportAsGeneric(scNetwork,G,initOutFile)
-    for i in range(timesteps):
-        scNetwork.makeTimeStep()
+        exportAsGeneric(scNetwork,G,initOutFile,exportShipments)
+    if profiler is not None:
+        profiler.record('runSimulation', None, 'setup', profiler.clock() - start)
+        start = profiler.clock()
+    stepNetwork(scNetwork, timesteps, engine)
+    scNetwork.closeSinks()
     networkHealth = scNetwork.health
-    return exportAsGeneric(scNetwork,G,finOutFile), networkHealth 
+    if profiler is not None:
+        profiler.record('runSimulation', None, 'stepNetwork', profiler.clock() - start)
+        start = profiler.clock()
+    G = exportAsGeneric(scNetwork,G,finOutFile,exportShipments)
+    if profiler is not None:
+        profiler.record('runSimulation', None, 'export', profiler.clock() - start)
+    return G, networkHealth
+
+# Health and total lost sales of every actor in /labels/ (NaN and 0 for
+# actors not in the network).
+def nodeOutcomes(scNetwork, labels):
+    actors = dict((node.label, node) for node in scNetwork.nodes_iter())
+    nodeHealth = np.empty(len(labels))
+    salesLost = np.zeros(len(labels), dtype=np.int64)
+    for i, label in enumerate(labels):
+        node = actors.get(label)
+        if node is None:
+            nodeHealth[i] = np.nan
+            continue
+        nodeHealth[i] = node.health
+        if isinstance(node, supplyChainNode):
+            salesLost[i] = node.salesLost.total(('allNodes','allProducts'))
+    return nodeHealth, salesLost
+
+# Paired runs of graph G with and without a shock, using common random
+# numbers. For each of /seeds/, the baseline and the shocked network are
+# instantiated from the same compiled template (compiled with /randSeed/)
+# with the same random.Random(seed), so every retail market draws the same
+# demand noise in both runs and the differences between them are due to the
+# shock alone. The shock removes the actors labelled /removeNodes/ (e.g. a
+# freeze footprint) and then calls /shock/(scNetwork), if given, before the
+# shocked network is run.
+#
+# Returns a dict with the actor 'labels', the network 'baseline' and
+# 'shocked' health and 'healthDelta' for each seed, and (seeds x actors)
+# 'nodeHealthDelta' and 'salesLostDelta' arrays of shocked minus baseline
+# (NaN health for removed actors).
+def runPaired(G,timesteps,randSeed,removeNodes=(),shock=None,seeds=(0,),networkName='supplyChainPaired',engine='object',cacheDir=None):
+    if type(G) == str:
+        G = readGraph(G)
+    G = G.copy()
+    calculateDepth(G)
+    if cacheDir is None:
+        template = supplyChainTemplate.fromGraph(G, randSeed)
+    else:
+        template = cachedTemplate(G, randSeed, cacheDir)
+    labels = [nodeData['label'] for nodeData in template.nodeSpecs]
+    result = {'labels': labels, 'seeds': list(seeds),
+              'baseline': np.empty(len(seeds)), 'shocked': np.empty(len(seeds)),
+              'nodeHealthDelta': np.empty((len(seeds), len(labels))),
+              'salesLostDelta': np.empty((len(seeds), len(labels)), dtype=np.int64)}
+    for i, seed in enumerate(seeds):
+        outcomes = []
+        for shocked in [False, True]:
+            excludeLabels = set(removeNodes) if shocked else ()
+            scNetwork = template.instantiate(networkName, timesteps + 1, excludeLabels, random.Random(seed))
+            if shocked and shock is not None:
+                shock(scNetwork)
+            stepNetwork(scNetwork, timesteps, engine)
+            outcomes.append((scNetwork.health,) + nodeOutcomes(scNetwork, labels))
+        (baseHealth, baseNodeHealth, baseSalesLost), (shockHealth, shockNodeHealth, shockSalesLost) = outcomes
+        result['baseline'][i] = baseHealth
+        result['shocked'][i] = shockHealth
+        result['nodeHealthDelta'][i] = shockNodeHealth - baseNodeHealth
+        result['salesLostDelta'][i] = shockSalesLost - baseSalesLost
+    result['healthDelta'] = result['shocked'] - result['baseline']
+    return result 
@@ -0,0 +1,786 @@
+#!/usr/bin/python
+
+import os
+import math
+import sys
+import random
+import shutil
+import tempfile
+import cPickle
+import numpy as np
+import networkx as nx
+from nose.tools import eq_, raises
+from supplyChainBenchmark import tieredSupplyNetwork, SIZES
+import supplyChainModel as scm
+from supplyChainReachability import supplyChainReachability
+
+
+def tinyNetwork(seed=0):
+    G = tieredSupplyNetwork(seed=seed, **SIZES['tiny'])
+    scm.calculateDepth(G)
+    return G
+
+
+class TestTemplateCache:
+    def setUp(self):
+        self.cacheDir = os.path.join(tempfile.mkdtemp(), 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.cacheDir))
+
+    def entries(self):
+        return sorted(entry for entry in os.listdir(self.cacheDir) if entry.endswith('.pickle'))
+
+    def test_private_directory(self):
+        scm.cachedTemplate(tinyNetwork(), 999, self.cacheDir)
+        if hasattr(os, 'getuid'):
+            eq_(os.stat(self.cacheDir).st_mode & 0o777, 0o700)
+        eq_(len(self.entries()), 1)
+
+    def test_key_ignores_other_attributes(self):
+        G = tinyNetwork()
+        first = scm.cachedTemplate(G, 999, self.cacheDir)
+        for n, data in G.nodes_iter(data=True):
+            data['intensity'] = u'1.5'
+            data['health'] = 0.5
+            data['popup'] = '<div>%s</div>' % (n)
+        second = scm.cachedTemplate(G, 999, self.cacheDir)
+        eq_(len(self.entries()), 1)
+        eq_([nodeData['label'] for nodeData in first.nodeSpecs], [nodeData['label'] for nodeData in second.nodeSpecs])
+        assert all('intensity' not in nodeData for nodeData in second.nodeSpecs), "template holds the footprint intensity"
+
+    def test_structure_changes_key(self):
+        G = tinyNetwork()
+        scm.cachedTemplate(G, 999, self.cacheDir)
+        n1, n2 = G.edges()[0]
+        G[n1][n2]['distance'] *= 2
+        scm.cachedTemplate(G, 999, self.cacheDir)
+        eq_(len(self.entries()), 2)
+
+    def test_annotates_graph(self):
+        G = tinyNetwork()
+        scm.cachedTemplate(G, 999, self.cacheDir)
+        H = tinyNetwork()
+        scm.cachedTemplate(H, 999, self.cacheDir)
+        eq_(sorted(G.edges(data=True)), sorted(H.edges(data=True)))
+        assert all('timeToTraverse' in data for __, __, data in H.edges_iter(data=True)), "cached template did not annotate the graph"
+
+    @raises(scm.supplyChainCacheError)
+    def test_shared_directory(self):
+        if not hasattr(os, 'getuid'):
+            raise scm.supplyChainCacheError('no user ids here')
+        os.makedirs(self.cacheDir)
+        os.chmod(self.cacheDir, 0o777)
+        scm.cachedTemplate(tinyNetwork(), 999, self.cacheDir)
+
+    @raises(scm.supplyChainCacheError)
+    def test_symlinked_directory(self):
+        target = tempfile.mkdtemp()
+        try:
+            os.symlink(target, self.cacheDir)
+            scm.cachedTemplate(tinyNetwork(), 999, self.cacheDir)
+        finally:
+            shutil.rmtree(target)
+
+    def test_planted_entry_ignored(self):
+        G = tinyNetwork()
+        scm.cachedTemplate(G, 999, self.cacheDir)
+        filename = os.path.join(self.cacheDir, self.entries()[0])
+        with open(filename, 'wb') as f:
+            cPickle.dump('planted', f)
+        if hasattr(os, 'getuid'):
+            os.chmod(filename, 0o644)
+        template = scm.cachedTemplate(G, 999, self.cacheDir)
+        assert isinstance(template, scm.supplyChainTemplate), "planted cache entry was loaded"
+        eq_(scm.readCacheEntry(filename).nodeSpecs, template.nodeSpecs)
+
+    def test_damaged_entry_recompiled(self):
+        G = tinyNetwork()
+        expected = scm.cachedTemplate(G, 999, self.cacheDir)
+        filename = os.path.join(self.cacheDir, self.entries()[0])
+        # A bad string literal (ValueError), a missing memo entry and a truncated file.
+        for damaged in ["S'unterminated\n.", 'g0\n.', '\x80\x02']:
+            with open(filename, 'wb') as f:
+                f.write(damaged)
+            eq_(scm.readCacheEntry(filename), None)
+            template = scm.cachedTemplate(G, 999, self.cacheDir)
+            eq_(template.nodeSpecs, expected.nodeSpecs)
+            eq_(scm.readCacheEntry(filename).nodeSpecs, expected.nodeSpecs)
+
+    def test_prune_entries(self):
+        for seed in range(3):
+            scm.cachedTemplate(tinyNetwork(seed), 999, self.cacheDir, maxEntries=2)
+        eq_(len(self.entries()), 2)
+
+    def test_prune_age(self):
+        scm.cachedTemplate(tinyNetwork(0), 999, self.cacheDir)
+        old = os.path.join(self.cacheDir, self.entries()[0])
+        os.utime(old, (0, 0))
+        scm.cachedTemplate(tinyNetwork(1), 999, self.cacheDir)
+        eq_(len(self.entries()), 1)
+        assert not os.path.exists(old), "stale cache entry was kept"
+
+    def test_run_compiled_template(self):
+        # A template compiled beforehand, as SupplyChain.get_impact leaves for run_model.
+        G = tinyNetwork()
+        template = scm.supplyChainTemplate.fromGraph(G, 999)
+        G, health = scm.runSimulation(G, 10, 999, networkName='compiled', template=template)
+        expectedG, expectedHealth = scm.runSimulation(tinyNetwork(), 10, 999, networkName='compiled')
+        eq_(health, expectedHealth)
+        eq_(sorted(G.nodes(data=True)), sorted(expectedG.nodes(data=True)))
+
+
+class TestShipmentHistory:
+    def setUp(self):
+        self.template = scm.supplyChainTemplate.fromGraph(tinyNetwork(), 999)
+
+    def run(self, **kwargs):
+        scNetwork = self.template.instantiate('shipmentHistory', 21, **kwargs)
+        for __ in range(20):
+            scNetwork.makeTimeStep()
+        return scNetwork
+
+    def test_off_by_default(self):
+        scNetwork = self.run()
+        assert scNetwork.transport.history is None, "delivered shipments were kept"
+
+    def test_opt_in(self):
+        scNetwork = self.run(shipmentHistory=True)
+        assert len(scNetwork.transport.history.liveRows()) > 0, "no delivered shipments were kept"
+
+    def test_same_results(self):
+        eq_(self.run().health, self.run(shipmentHistory=True).health)
+
+    def test_export_shipments(self):
+        G, __ = scm.runSimulation(tinyNetwork(), 20, 999, networkName='shipmentHistory', exportShipments=True)
+        delivered = [shipment for __, __, data in G.edges_iter(data=True)
+                     for key, shipment in data.iteritems() if isinstance(key, int) and shipment['timeOnEdge'] < 0]
+        assert delivered, "no delivered shipments on the exported edges"
+
+
+# A run checkpointed part way through and carried on from the checkpoint
+# should end the same as the run made in one go.
+class TestCheckpoint:
+    def setUp(self):
+        self.template = scm.supplyChainTemplate.fromGraph(tinyNetwork(), 999)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def outcome(self, scNetwork):
+        nodes = dict()
+        for node in scNetwork.nodes_iter():
+            salesLost = node.salesLost.total(('allNodes', 'allProducts')) if isinstance(node, scm.supplyChainNode) else None
+            nodes[node.label] = (node.currentTime, node.health, salesLost)
+        return scNetwork.health, nodes
+
+    def uninterrupted(self, timesteps):
+        scNetwork = self.template.instantiate('checkpoint', timesteps + 1)
+        for __ in range(timesteps):
+            scNetwork.makeTimeStep()
+        return self.outcome(scNetwork)
+
+    def test_restore(self):
+        scNetwork = self.template.instantiate('checkpoint', 31)
+        for __ in range(12):
+            scNetwork.makeTimeStep()
+        path = os.path.join(self.directory, 'run.checkpoint')
+        scNetwork.checkpoint(path)
+        del scNetwork
+        restored = scm.supplyChainNetwork.restore(path)
+        eq_(restored.currentTime, 12)
+        for __ in range(18):
+            restored.makeTimeStep()
+        eq_(self.outcome(restored), self.uninterrupted(30))
+
+    def test_write_and_read(self):
+        scNetwork = self.template.instantiate('checkpoint', 31)
+        for __ in range(7):
+            scNetwork.makeTimeStep()
+        path = os.path.join(self.directory, 'run.pickle')
+        with open(path, 'wb') as f:
+            scm.writeCheckpoint(scNetwork, f)
+        for __ in range(23):
+            scNetwork.makeTimeStep()
+        with open(path, 'rb') as f:
+            restored = scm.readCheckpoint(f, restoreRandom=True)
+        for __ in range(23):
+            restored.makeTimeStep()
+        expected = self.uninterrupted(30)
+        eq_(self.outcome(scNetwork), expected)
+        eq_(self.outcome(restored), expected)
+
+    def test_fork(self):
+        scNetwork = self.template.instantiate('checkpoint', 31)
+        for __ in range(10):
+            scNetwork.makeTimeStep()
+        forked = scNetwork.fork()
+        for network in [scNetwork, forked]:
+            for __ in range(20):
+                network.makeTimeStep()
+        eq_(self.outcome(forked), self.outcome(scNetwork))
+
+    @raises(ValueError)
+    def test_not_a_checkpoint(self):
+        path = os.path.join(self.directory, 'other.pickle')
+        with open(path, 'wb') as f:
+            cPickle.dump({'version': 0}, f)
+        with open(path, 'rb') as f:
+            scm.readCheckpoint(f)
+
+
+# Actors keeping only the last few timesteps of history should run just as
+# they do keeping all of it.
+class TestHistoryWindow:
+    def setUp(self):
+        self.template = scm.supplyChainTemplate.fromGraph(tinyNetwork(), 999)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def outcome(self, scNetwork):
+        nodes = dict()
+        for node in scNetwork.nodes_iter():
+            if isinstance(node, scm.supplyChainNode):
+                inventory = [node.inventory.get(node.currentTime, product) for product in node.products]
+                nodes[node.label] = (node.health, node.salesLost.total(('allNodes', 'allProducts')), inventory)
+            else:
+                nodes[node.label] = (node.health, None, None)
+        return scNetwork.health, nodes
+
+    def run(self, timesteps, engine='object', historyWindow=None):
+        scNetwork = self.template.instantiate('window', timesteps + 1, historyWindow=historyWindow)
+        scm.stepNetwork(scNetwork, timesteps, engine)
+        return self.outcome(scNetwork)
+
+    def test_same_results(self):
+        for engine in scm.ENGINES:
+            expected = self.run(20, engine)
+            for historyWindow in [2, 5]:
+                eq_(self.run(20, engine, historyWindow), expected,
+                    "a window of %d changed the %s engine's results" % (historyWindow, engine))
+
+    def test_restore(self):
+        scNetwork = self.template.instantiate('window', 31, historyWindow=3)
+        for __ in range(12):
+            scNetwork.makeTimeStep()
+        path = os.path.join(self.directory, 'run.checkpoint')
+        scNetwork.checkpoint(path)
+        del scNetwork
+        restored = scm.supplyChainNetwork.restore(path)
+        eq_(restored.historyWindow, 3)
+        for __ in range(18):
+            restored.makeTimeStep()
+        eq_(self.outcome(restored), self.run(30))
+
+    def test_health_history_bounded(self):
+        full = self.template.instantiate('window', 21)
+        windowed = self.template.instantiate('window', 21, historyWindow=4)
+        for scNetwork in [full, windowed]:
+            scm.stepNetwork(scNetwork, 20)
+        eq_(windowed.healthHistory.shape, (4,))
+        eq_(windowed.nodeHealthHistory.shape, (4, len(windowed.healthNodes)))
+        assert np.array_equal(windowed.getHealthHistory(), full.getHealthHistory()[-4:])
+        node = windowed.healthNodes[0]
+        assert np.array_equal(windowed.getNodeHealthHistory(node), full.getNodeHealthHistory(full.healthNodes[0])[-4:])
+        G = nx.DiGraph()
+        G.add_nodes_from(node.label for node in full.healthNodes)
+        eq_(scm.resultColumns(windowed, G)['health'].shape, (4, len(G)))
+        assert np.array_equal(scm.resultColumns(windowed, G)['health'], scm.resultColumns(full, G)['health'][-4:])
+
+    @raises(ValueError)
+    def test_window_too_short(self):
+        self.template.instantiate('window', 21, historyWindow=1)
+
+
+# Implied demand worked out for customers with no targetInventory yet, as
+# happens when compiling out of topological order.
+class TestImpliedDemand:
+    def chain(self, length):
+        G = nx.DiGraph()
+        dataDict = {'m': {'nodeRole': 'retail market', 'initialDemand': 100}}
+        previous = 'm'
+        for i in range(length):
+            label = 'n%d' % (i)
+            G.add_edge(label, previous)
+            dataDict[label] = {'nodeRole': 'supply chain', 'product': 'component'}
+            previous = label
+        return G, dataDict, previous
+
+    def test_long_chain(self):
+        G, dataDict, deepest = self.chain(3*sys.getrecursionlimit())
+        eq_(scm.getImpliedDemand(G, deepest, dataDict), 200)
+
+    # The recursive walk getImpliedDemand used to make.
+    def recursive(self, G, node, dataDict):
+        impliedDemand = 0
+        for usNode in G.successors(node):
+            usNodeData = dataDict[usNode]
+            if usNodeData['nodeRole'] == 'retail market':
+                impliedDemand += int(2*(usNodeData['initialDemand']//len(G.predecessors(usNode))))
+            elif usNodeData['nodeRole'] == 'supply chain':
+                impliedDemand += int(self.recursive(G, usNode, dataDict)/len(G.successors(usNode)))
+        return impliedDemand
+
+    def test_matches_recursion(self):
+        G = tinyNetwork()
+        nodeSpecs, __ = scm.compileSupplySpec(G, scm.supplyChainProduct('laptop'), random.Random(999))
+        dataDict = dict((nodeData['label'], dict(nodeData)) for nodeData in nodeSpecs)
+        for nodeData in dataDict.itervalues():
+            nodeData.pop('targetInventory', None)
+        memo = dict()
+        for label, nodeData in sorted(dataDict.iteritems()):
+            if nodeData['nodeRole'] == 'supply chain':
+                eq_(scm.getImpliedDemand(G, label, dataDict, memo), self.recursive(G, label, dataDict),
+                    "implied demand of %s differs from the recursive walk" % (label))
+
+    @raises(scm.supplyChainCycleError)
+    def test_cycle(self):
+        G, dataDict, deepest = self.chain(5)
+        G.add_edge('n1', 'n3')
+        scm.getImpliedDemand(G, 'n4', dataDict)
+
+
+# Network health counts only the actors in the network, when some are
+# removed part way through a run.
+class TestHealthIndex:
+    def setUp(self):
+        G = tieredSupplyNetwork(**SIZES['small'])
+        scm.calculateDepth(G)
+        self.scNetwork = scm.supplyChainTemplate.fromGraph(G, 999).instantiate('healthIndex', 21)
+
+    def rms(self):
+        return (sum(node.health**2 for node in self.scNetwork.nodes_iter())/float(len(self.scNetwork)))**0.5
+
+    def test_remove_actors(self):
+        scNetwork = self.scNetwork
+        for __ in range(5):
+            scNetwork.makeTimeStep()
+        removed = sorted(scNetwork.nodes(), key=lambda node: node.name)[::5][:20]
+        kept = [node for node in scNetwork.nodes() if not node in removed]
+        history = dict((node, scNetwork.getNodeHealthHistory(node).copy()) for node in kept)
+        scNetwork.remove_nodes_from(removed)
+        for __ in range(10):
+            scNetwork.makeTimeStep()
+            assert abs(scNetwork.health - self.rms()) < 1e-12, \
+                "network health %r is not the RMS %r of the remaining actors" % (scNetwork.health, self.rms())
+        eq_(len(scNetwork.healthNodes), len(kept))
+        for node in kept:
+            assert np.array_equal(scNetwork.getNodeHealthHistory(node)[:6], history[node]), \
+                "health history of %s changed when other actors were removed" % (node.name)
+        assert abs(scNetwork.calculateHealth() - self.rms()) < 1e-12, "calculateHealth counts removed actors"
+
+    def test_remove_before_stepping(self):
+        scNetwork = self.scNetwork
+        scNetwork.remove_nodes_from(scNetwork.nodes()[:10])
+        for __ in range(10):
+            scNetwork.makeTimeStep()
+        assert abs(scNetwork.health - self.rms()) < 1e-12, "network health counts removed actors"
+
+
+# A counterparty, as findNextValueRecur needs, for ledger tests outside a network.
+class ledgerCounterparty(object):
+    def __init__(self, name, simulationLength, currentTime):
+        self.name = name
+        self.supplyChain = scm.supplyChainNetwork('ledger', simulationLength)
+        self.currentTime = currentTime
+
+    def __repr__(self):
+        return self.name
+
+
+# The array ledger should answer as the list of per-timestep dicts it replaced.
+class TestLedger:
+    def setUp(self):
+        self.ledger = scm.supplyChainLedger(20)
+
+    def test_missing_and_zero(self):
+        ledger = self.ledger
+        ledger.set(3, ('a', 'steel'), 0)
+        assert ledger.has(3, ('a', 'steel')), "a recorded 0 was taken for nothing recorded"
+        assert not ledger.has(4, ('a', 'steel')), "a timestep with nothing recorded has a value"
+        assert not ledger.has(3, ('b', 'steel')), "an unknown key has a value"
+        eq_(ledger.get(3, ('a', 'steel'), None), 0)
+        eq_(ledger.get(4, ('a', 'steel'), None), None)
+        eq_(ledger.findPrev(('a', 'steel'), 10), (0, 3))
+        eq_(ledger.findPrev(('a', 'steel'), 2), (None, 0))
+        eq_(ledger[3], {('a', 'steel'): 0})
+        eq_(ledger[4], {})
+
+    def test_grow(self):
+        ledger = self.ledger
+        expected = dict()
+        for i in range(12):
+            for j in range(i + 1):
+                key = ('node%d' % (j), 'product%d' % (i))
+                ledger.set(i, key, 100*i + j)
+                expected[(i, key)] = 100*i + j
+        eq_(len(ledger.nodes), 12)
+        eq_(len(ledger.products), 12)
+        for (t, key), value in expected.items():
+            eq_(ledger.get(t, key, None), value, "%r at %d was lost growing the store" % (key, t))
+            eq_(ledger.findPrev(key, 20), (value, t))
+
+    def test_delete(self):
+        ledger = self.ledger
+        for t, value in [(2, 5), (6, 7), (9, 1)]:
+            ledger.set(t, ('a', 'steel'), value)
+        ledger.delete(9, ('a', 'steel'))
+        eq_(ledger.findPrev(('a', 'steel'), 15), (7, 6))
+        ledger.delete(6, ('a', 'steel'))
+        eq_(ledger.findPrev(('a', 'steel'), 15), (5, 2))
+        ledger.set(4, ('a', 'steel'), 3)
+        eq_(ledger.findPrev(('a', 'steel'), 15), (3, 4))
+        ledger.delete(2, ('a', 'steel'))
+        ledger.delete(4, ('a', 'steel'))
+        eq_(ledger.findPrev(('a', 'steel'), 15), (None, 0))
+        eq_(ledger.findNext(('a', 'steel'), 0, 15), (None, 16))
+
+    def test_copy_row(self):
+        ledger = scm.supplyChainLedger(20, productKeyed=True)
+        ledger.set(4, 'steel', 8)
+        ledger.set(4, 'glass', 0)
+        ledger.set(5, 'glass', 3)
+        ledger.set(7, 'steel', 2)
+        ledger.copyRow(4, 5)
+        eq_(ledger[5], {'steel': 8, 'glass': 0})
+        eq_(ledger.findPrev('steel', 6), (8, 5))
+        eq_(ledger.findPrev('steel', 10), (2, 7))
+        eq_(ledger.findPrev('glass', 10), (0, 5))
+
+    def test_set_many(self):
+        ledger = self.ledger
+        ledger.set(2, ('a', 'steel'), 4)
+        ledger.setMany([1, 20], [('a', 'steel'), ('b', 'steel')], 0)
+        eq_(ledger.findPrev(('a', 'steel'), 10), (4, 2))
+        eq_(ledger.findPrev(('b', 'steel'), 10), (0, 1))
+        eq_(ledger.total(('b', 'steel'), None), 0)
+
+    def test_record(self):
+        ledger = self.ledger
+        ledger.record(3, 'a', 'steel', 5)
+        ledger.record(3, 'b', 'steel', 2)
+        ledger.record(3, 'a', 'glass', 1)
+        ledger.record(3, 'a', 'steel', 4, add=True)
+        ledger.record(5, 'a', 'steel', 6)
+        eq_(ledger.get(3, ('a', 'steel')), 9)
+        eq_(ledger.get(3, ('allNodes', 'steel')), 11)
+        eq_(ledger.get(3, ('a', 'allProducts')), 10)
+        eq_(ledger.get(3, ('allNodes', 'allProducts')), 12)
+        eq_(ledger.get(5, ('allNodes', 'allProducts')), 6)
+        eq_(ledger.total(('a', 'steel')), 15)
+        eq_(ledger.total(('allNodes', 'allProducts')), 18)
+
+    def test_carry(self):
+        ledger = self.ledger
+        ledger.carry(2, 'a', 'steel', 5)
+        ledger.carry(2, 'b', 'steel', 3)
+        ledger.carry(6, 'a', 'steel', -2)
+        eq_(ledger.findPrev(('a', 'steel'), 10), (3, 6))
+        eq_(ledger.findPrev(('b', 'steel'), 10), (3, 2))
+        eq_(ledger.findPrev(('allNodes', 'steel'), 10), (6, 6))
+        eq_(ledger.findPrev(('allNodes', 'allProducts'), 4), (8, 2))
+        # Carrying into an earlier timestep starts from what was recorded before it.
+        ledger.carry(4, 'a', 'steel', 1)
+        eq_(ledger.get(4, ('a', 'steel')), 6)
+        eq_(ledger.findPrev(('a', 'steel'), 5), (6, 4))
+
+    def test_copy_layout(self):
+        ledger = self.ledger
+        ledger.setMany([0, 20], [('a', 'steel'), ('allNodes', 'steel')], 0)
+        copied = scm.supplyChainLedger(20)
+        assert copied.copyLayout(ledger, values=True), "an empty ledger did not take the layout"
+        copied.record(1, 'a', 'steel', 4)
+        eq_(copied.total(('allNodes', 'steel')), 4)
+        eq_(ledger.total(('allNodes', 'steel')), 0)
+        eq_(ledger.get(1, ('a', 'steel'), None), None)
+        assert not copied.copyLayout(ledger), "a ledger holding keys took another's layout"
+
+    def test_matches_dicts(self):
+        rng = random.Random(0)
+        simulationLength = 20
+        counterparties = [ledgerCounterparty(name, simulationLength, 15) for name in ['a', 'b', 'c']]
+        products = ['steel', 'glass']
+        ledger = scm.supplyChainLedger(simulationLength)
+        dicts = [dict() for __ in range(simulationLength + 1)]
+        for __ in range(300):
+            t = rng.randint(0, simulationLength)
+            key = (rng.choice(counterparties), rng.choice(products))
+            if rng.random() < 0.2:
+                ledger.delete(t, key)
+                dicts[t].pop(key, None)
+            else:
+                value = rng.randint(-5, 20)
+                ledger.set(t, key, value)
+                dicts[t][key] = value
+            for counterparty in counterparties:
+                for product in products:
+                    startTime = rng.randint(0, simulationLength)
+                    eq_(ledger.findPrev((counterparty, product), startTime),
+                        scm.findPrevValueRecur(dicts, counterparty, product, startTime),
+                        "findPrev of %r at %d" % ((counterparty, product), startTime))
+                    startTime = rng.randint(0, counterparty.currentTime)
+                    eq_(scm.findNextValueRecur(ledger, counterparty, product, startTime),
+                        scm.findNextValueRecur(dicts, counterparty, product, startTime),
+                        "findNext of %r at %d" % ((counterparty, product), startTime))
+
+
+# Health divides stock by target, and units shipped by units ordered, as
+# floats. (The per-timestep dicts the ledger replaced held some stock as
+# ints, and floored the division for those nodes.)
+class TestHealth:
+    def setUp(self):
+        self.widget, self.gadget = scm.supplyChainProduct('widget'), scm.supplyChainProduct('gadget')
+        nodeSpecs = [{'label': 'm', 'nodeRole': 'retail market', 'product': self.widget, 'initialDemand': 8, 'rngSeed': 0},
+                     {'label': 's', 'nodeRole': 'supply chain', 'targetInventory': {self.widget: 10, self.gadget: 10},
+                      'storageCapacity': 100}]
+        scNetwork = scm.spec2Supply(nodeSpecs, [('s', 'm', {'timeToTraverse': 1})], 'health', 5)
+        scNetwork.giveNodeContext()
+        self.actors = dict((actor.label, actor) for actor in scNetwork.nodes_iter())
+
+    def test_node(self):
+        s = self.actors['s']
+        s.inventory.set(s.currentTime, self.widget, 7)
+        s.inventory.set(s.currentTime, self.gadget, 15)
+        expected = ((0.7**2 + 0.5**2)/2)**0.5
+        assert abs(s.calculateHealth() - expected) < 1e-12, "node health is %r" % (s.health)
+        s.inventory.set(s.currentTime, self.gadget, 30)
+        assert abs(s.calculateHealth() - (0.7**2/2)**0.5) < 1e-12, "node health is %r" % (s.health)
+
+    def test_market(self):
+        m, s = self.actors['m'], self.actors['s']
+        m.ordersMade.record(1, s, self.widget, 8)
+        m.shipmentsReceived.record(2, s, self.widget, 6)
+        eq_(m.calculateHealth(), 0.75)
+
+
+# Paired runs draw the same market demand with and without the shock, so a
+# shock that changes nothing changes none of the results.
+class TestRunPaired:
+    def setUp(self):
+        self.G = tinyNetwork()
+        self.seeds = (0, 1, 2)
+        self.networks = []
+
+    def capture(self, scNetwork):
+        self.networks.append(scNetwork)
+
+    def test_no_op_shock(self):
+        result = scm.runPaired(self.G, 20, 999, shock=self.capture, seeds=self.seeds)
+        eq_(len(self.networks), len(self.seeds), "the shock was not called once for every seed")
+        eq_(result['healthDelta'].tolist(), [0.0]*len(self.seeds))
+        eq_(result['nodeHealthDelta'].shape, (len(self.seeds), len(result['labels'])))
+        assert (result['nodeHealthDelta'] == 0).all(), "a no-op shock changed actor health"
+        assert (result['salesLostDelta'] == 0).all(), "a no-op shock changed lost sales"
+        assert len(set(result['baseline'])) > 1, "the seeds gave the same baseline"
+
+    def test_removed_suppliers(self):
+        removed = self.G.predecessors('m0')
+        template = scm.supplyChainTemplate.fromGraph(tinyNetwork(), 999)
+        cutOff = supplyChainReachability.fromTemplate(template).cutOff(removed)['cutOff']
+        assert 'm0' in cutOff, "removing every supplier of m0 did not cut it off"
+        baseline = scm.runPaired(self.G, 20, 999, shock=self.capture, seeds=self.seeds)
+        result = scm.runPaired(self.G, 20, 999, removeNodes=removed, shock=self.capture, seeds=self.seeds)
+        eq_(result['baseline'].tolist(), baseline['baseline'].tolist())
+        for label in removed:
+            assert np.isnan(result['nodeHealthDelta'][:, result['labels'].index(label)]).all(), \
+                "removed actor %s has a health delta" % (label)
+        for i, seed in enumerate(self.seeds):
+            unshocked = dict((node.label, node) for node in self.networks[i].nodes_iter())
+            shocked = dict((node.label, node) for node in self.networks[len(self.seeds) + i].nodes_iter())
+            for label in removed:
+                assert label not in shocked, "%s was not removed" % (label)
+            for label in cutOff:
+                eq_(list(shocked[label].marketDemand), list(unshocked[label].marketDemand),
+                    "demand at %s differs once it is cut off, seed %d" % (label, seed))
+
+
+# Demand exploded through a hand-built two-tier recipe: market m buys
+# laptops from assembler a and reseller r (3:1 by market share); a builds
+# each laptop from two screens and a case, buying screens from s1 and s2
+# (3:1 by preference) and cases from c. Nobody supplies r, s1, s2 or c.
+class TestBillOfMaterials:
+    def setUp(self):
+        laptop, screen, case = [scm.supplyChainProduct(name) for name in ['laptop', 'screen', 'case']]
+        nodeSpecs = [{'label': 'm', 'nodeRole': 'retail market', 'product': laptop, 'initialDemand': 8, 'rngSeed': 0},
+                     {'label': 'a', 'nodeRole': 'supply chain', 'targetInventory': {laptop: 10, screen: 20, case: 10},
+                      'storageCapacity': 100, 'buildInstructions': {laptop: {screen: 2, case: 1}},
+                      'processingCapacity': {laptop: 5}},
+                     {'label': 'r', 'nodeRole': 'supply chain', 'targetInventory': {laptop: 10}, 'storageCapacity': 100}]
+        nodeSpecs += [{'label': label, 'nodeRole': 'supply chain', 'targetInventory': {product: 10}, 'storageCapacity': 100}
+                      for label, product in [('s1', screen), ('s2', screen), ('c', case)]]
+        edgeSpecs = [(n1, n2, {}) for n1, n2 in [('a', 'm'), ('r', 'm'), ('s1', 'a'), ('s2', 'a'), ('c', 'a')]]
+        self.scNetwork = scm.spec2Supply(nodeSpecs, edgeSpecs, 'billOfMaterials', 5)
+        self.scNetwork.giveNodeContext()
+        self.actors = dict((actor.label, actor) for actor in self.scNetwork.nodes_iter())
+        self.products = laptop, screen, case
+        market = self.actors['m']
+        market.marketShare[market.currentTime][(self.actors['a'], laptop)] = 3.0
+        market.marketShare[market.currentTime][(self.actors['r'], laptop)] = 1.0
+        self.actors['a'].stockistPreferences[screen] = {self.actors['s1']: 3.0, self.actors['s2']: 1.0}
+
+    def test_explode(self):
+        laptop, screen, case = self.products
+        rawDemand, nodeDemand = scm.explodeBillOfMaterials(self.scNetwork, {self.actors['m']: 8})
+        eq_(rawDemand, {laptop: 2, screen: 12, case: 6})
+        eq_(dict(((actor.label, product.name), units) for (actor, product), units in nodeDemand.items()),
+            {('a', 'laptop'): 6, ('r', 'laptop'): 2, ('s1', 'screen'): 9, ('s2', 'screen'): 3, ('c', 'case'): 6})
+
+    def test_equal_split_without_preferences(self):
+        laptop, screen, case = self.products
+        self.actors['a'].stockistPreferences[screen] = dict()
+        rawDemand, nodeDemand = scm.explodeBillOfMaterials(self.scNetwork, {self.actors['m']: 8})
+        eq_(nodeDemand[(self.actors['s1'], screen)], 6)
+        eq_(nodeDemand[(self.actors['s2'], screen)], 6)
+        eq_(rawDemand, {laptop: 2, screen: 12, case: 6})
+
+
+# The FIFO book of unfilled orders behind makeAllProductShipments.
+class TestOrderBook:
+    def setUp(self):
+        self.book = scm.supplyChainOrderBook()
+        self.book.addOrder('b', 4, 1)
+        self.book.addOrder('a', 5, 0)
+        self.book.addOrder('c', 2, 1)
+        self.book.addOrder('a', 3, 2)
+
+    def test_fifo(self):
+        # Oldest first; among orders made at the same time, the smallest.
+        eq_([(entry[3], entry[0]) for entry in self.book.openOrders()], [('a', 0), ('c', 1), ('b', 1), ('a', 2)])
+        eq_(self.book.oldest()[3], 'a')
+        eq_(self.book.totalRemaining, 14)
+        eq_(len(self.book), 4)
+
+    def test_partial_fill(self):
+        eq_(self.book.consume('a', 7), 0)
+        eq_(self.book.outstanding('a'), 1)
+        eq_(self.book.oldestFrom('a')[0], 2)
+        eq_(self.book.oldest()[3], 'c')
+        eq_(self.book.totalRemaining, 7)
+        # Shipping more than is on the book returns the excess.
+        eq_(self.book.consume('c', 5), 3)
+        eq_(self.book.oldestFrom('c'), None)
+        eq_(len(self.book), 2)
+
+    def test_backlog(self):
+        self.book.consume('a', 2)
+        eq_(self.book.backlog(5), [('a', 0, 3, 5), ('c', 1, 2, 4), ('b', 1, 4, 4), ('a', 2, 3, 3)])
+        eq_(self.book.backlogAge(5), 5)
+        self.book.consume('a', 3)
+        eq_(self.book.backlogAge(5), 4)
+        for customer in ['a', 'b', 'c']:
+            self.book.consume(customer, 10)
+        eq_(self.book.backlog(5), [])
+        eq_(self.book.backlogAge(5), 0)
+        eq_(self.book.totalRemaining, 0)
+
+
+# A supplier short of stock fills the oldest orders first, whoever made them.
+class TestShortStockShipments:
+    def setUp(self):
+        self.widget = scm.supplyChainProduct('widget')
+        nodeSpecs = [{'label': label, 'nodeRole': 'supply chain', 'targetInventory': {self.widget: 10}, 'storageCapacity': 100}
+                     for label in ['s', 'c1', 'c2']]
+        edgeSpecs = [('s', 'c1', {'timeToTraverse': 1}), ('s', 'c2', {'timeToTraverse': 1})]
+        scNetwork = scm.spec2Supply(nodeSpecs, edgeSpecs, 'shortStock', 5)
+        scNetwork.giveNodeContext()
+        self.actors = dict((actor.label, actor) for actor in scNetwork.nodes_iter())
+
+    def test_oldest_first(self):
+        s, c1, c2 = self.actors['s'], self.actors['c1'], self.actors['c2']
+        s.receiveOrder(c2, 5, self.widget)
+        s.currentTime = 1
+        s.receiveOrder(c1, 2, self.widget)
+        s.receiveOrder(c2, 4, self.widget)
+        s.inventory.set(1, self.widget, 8)
+        s.makeAllProductShipments(self.widget)
+        # c2's first order (5), then c1's (2), then 1 of c2's second order (4).
+        book = s.orderBook[self.widget]
+        eq_(book.outstanding(c1), 0)
+        eq_(book.outstanding(c2), 3)
+        eq_(s.inventory.get(1, self.widget), 0)
+        eq_(s.orderBook[self.widget].backlog(3), [(c2, 1, 3, 2)])
+        eq_(s.getBacklogAge(), 0)
+        s.currentTime = 3
+        eq_(s.getBacklogAge(), 2)
+
+
+# Results of a fixed run, pinned after orders came to be filled from the
+# FIFO order book (so that a change to how they are filled shows up here).
+class TestOrderBookRegression:
+    def test_pinned(self):
+        scNetwork = scm.supplyChainTemplate.fromGraph(tinyNetwork(), 999).instantiate('orderBook', 21)
+        for __ in range(20):
+            scNetwork.makeTimeStep()
+        assert abs(scNetwork.health - 0.21317241746787863) < 1e-12, "network health is %r" % (scNetwork.health)
+        nodes = dict((actor.label, actor) for actor in scNetwork.nodes_iter() if isinstance(actor, scm.supplyChainNode))
+        salesLost = dict((label, node.salesLost.total(('allNodes', 'allProducts'))) for label, node in nodes.items())
+        eq_(dict((label, lost) for label, lost in salesLost.items() if lost), {'t0.0': 1031, 't0.1': 890, 't0.2': 1090})
+        backlog = dict((label, (sum(node.orderBook[product].totalRemaining for product in node.products), node.getBacklogAge()))
+                       for label, node in nodes.items())
+        eq_(dict((label, value) for label, value in backlog.items() if value[0]),
+            {'t1.0': (121, 12), 't1.1': (189, 10), 't1.2': (123, 12), 't1.3': (342, 15), 't1.5': (5, 4),
+             't2.0': (323, 16), 't2.1': (1908, 18), 't2.2': (944, 17), 't2.3': (1705, 17), 't2.4': (223, 17),
+             't2.5': (2325, 18), 't2.6': (685, 17), 't2.7': (318, 16), 't2.8': (685, 16), 't2.9': (651, 16),
+             't2.10': (155, 16), 't2.11': (854, 19)})
+
+
+# Retail market demand as ab4ec1b drew it, from the global random module.
+def baselineDemand(market, prev_value):
+    return max(math.ceil(prev_value + (prev_value**0.5)*random.gauss(0,1) - 0.5), math.floor(market.initialDemand*0.3))
+
+# The object engine against results from ab4ec1b, the commit before the
+# ledger, with health divided as floats (see TestHealth) and retail markets
+# hashed by name rather than by id, so that they do not depend on memory
+# layout. The network is built of chains (every actor has one supplier and
+# one customer), where filling short orders from the FIFO book gives what
+# ab4ec1b gave, and demand is drawn as ab4ec1b drew it. Everything else is
+# compared exactly, except network health, which is now summed as actors
+# report in and so can differ in the last bit.
+class TestBaselineRegression:
+    def setUp(self):
+        self.getMarketDemand = scm.supplyChainRetailMarket.__dict__['getMarketDemand']
+        scm.supplyChainRetailMarket.getMarketDemand = baselineDemand
+
+    def tearDown(self):
+        scm.supplyChainRetailMarket.getMarketDemand = self.getMarketDemand
+
+    def test_chains(self):
+        G = tieredSupplyNetwork(seed=0, tiers=(3, 3, 3), markets=3, fanIn=(1, 1), fanOut=(1, 1))
+        scm.calculateDepth(G)
+        random.seed(999)
+        scNetwork = scm.generic2Supply(G, 'baseline', 31, scm.supplyChainProduct('laptop'))
+        # Drawing the network's demand seed takes from the global random
+        # module, which ab4ec1b did not do.
+        state = random.getstate()
+        scNetwork.giveNodeContext()
+        random.setstate(state)
+        health = []
+        for __ in range(30):
+            scNetwork.makeTimeStep()
+            health.append(scNetwork.health)
+        expected = [0.6879906930757413, 0.6602823800108822, 0.6800092652429878, 0.6846246608125067, 0.6774360115949848,
+                    0.6527151012648397, 0.6552336091112297, 0.6177319219077755, 0.6129560287527217, 0.5959409490352036,
+                    0.5860606048180389, 0.5800356620398399, 0.5760343868855765, 0.5733293658884289, 0.5714503838225473,
+                    0.5700681136386748, 0.568984519319104, 0.5681025881473167, 0.5673617904665167, 0.5668013291192777,
+                    0.5662868666908939, 0.5658218028870076, 0.5654289105290121, 0.5650658520074595, 0.5647601719710886,
+                    0.5644859159802166, 0.5642621135777703, 0.5640596633871311, 0.5638875991056012, 0.5637388457756297]
+        for t, (value, expectedValue) in enumerate(zip(health, expected)):
+            assert abs(value - expectedValue) < 1e-12, "network health at %d is %r, not %r" % (t + 1, value, expectedValue)
+        actors = dict((actor.label, actor) for actor in scNetwork.nodes_iter())
+        eq_(dict((label, actors[label].health) for label in ['m0', 'm1', 'm2']),
+            {'m0': 0.05056890012642225, 'm1': 0.07234908433190143, 'm2': 0.145366444579043})
+        nodes = dict((label, (node.health, dict((product.name, node.inventory.get(node.currentTime, product)) for product in node.products),
+                              node.salesLost.total(('allNodes', 'allProducts'))))
+                     for label, node in actors.items() if isinstance(node, scm.supplyChainNode))
+        eq_(nodes, {'t0.0': (0.28867513459481287, {'laptop': 0, 'component 1.0': 810, 'component 1.1': 0}, 4233),
+                    't0.1': (0.7071067811865476, {'laptop': 0, 'component 1.0': 960}, 8206),
+                    't0.2': (0.7071067811865476, {'laptop': 0, 'component 1.0': 60}, 2253),
+                    't1.0': (1.0, {'component 1.0': 60, 'component 2.0': 60}, 0),
+                    't1.1': (0.7071067811865476, {'component 1.1': 0, 'component 2.0': 270}, 0),
+                    't1.2': (0.4487332109736535, {'component 1.0': 990, 'component 2.0': 1050, 'component 2.1': 0}, 0),
+                    't2.0': (0.0, {'component 2.0': 0}, 0),
+                    't2.1': (0.0, {'component 2.1': 0}, 0),
+                    't2.2': (1.0, {'component 2.0': 60}, 0)})
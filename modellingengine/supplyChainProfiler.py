@@ -0,0 +1,102 @@
+#!/usr/bin/python
+
+'''
+Opt-in profiling of supply chain runs.
+
+A supplyChainProfiler is attached with the profiler argument of
+runSimulation (or by setting supplyChainNetwork.profiler). While it is
+attached, every actor's makeTimeStep is timed phase by phase (see
+supplyChainNode.timeStepPhases), as are the network's own steps and those
+of the vector engine. Wall time and call counts are
+accumulated by actor class, tier and phase, and wall time by actor:
+
+    profiler = supplyChainProfiler()
+    G, health = runSimulation(G, 50, 999, profiler=profiler)
+    print profiler.summary()
+    report = profiler.report()
+
+With no profiler attached (the default), makeTimeStep only checks for
+one, so the cost is a single attribute lookup per actor and timestep.
+'''
+
+import collections
+import timeit
+
+
+# Accumulates time by (actor class, tier, phase) and by actor.
+class supplyChainProfiler(object):
+    def __init__(self, clock=timeit.default_timer):
+        self.clock = clock
+        self.seconds = collections.defaultdict(float) # (class name, tier, phase) -> wall time.
+        self.calls = collections.defaultdict(int) # (class name, tier, phase) -> number of calls.
+        self.actorSeconds = collections.defaultdict(float) # Actor label -> wall time stepping it.
+        self.actorCalls = collections.defaultdict(int) # Actor label -> timesteps.
+
+    def __repr__(self):
+        return "supplyChainProfiler(phases=%r,actors=%r)" % (len(self.seconds), len(self.actorSeconds))
+
+    # Add /seconds/ spent in /phase/ by an actor of class /className/ in /tier/.
+    def record(self, className, tier, phase, seconds, calls=1):
+        self.seconds[(className, tier, phase)] += seconds
+        self.calls[(className, tier, phase)] += calls
+
+    # Run each of /phases/, a list of (phase name, callable), timing each one
+    # against /actor/. With /hot/, also time the actor as a whole.
+    def profileStep(self, actor, phases, hot=True):
+        clock = self.clock
+        times = []
+        begin = start = clock()
+        for phase, method in phases:
+            method()
+            now = clock()
+            times.append((phase, now - start))
+            start = now
+        className = actor.__class__.__name__
+        tier = getattr(actor, 'tier', None)
+        for phase, seconds in times:
+            self.seconds[(className, tier, phase)] += seconds
+            self.calls[(className, tier, phase)] += 1
+        if hot:
+            self.actorSeconds[actor.label] += start - begin
+            self.actorCalls[actor.label] += 1
+
+    # The accumulated times as a dict of plain values:
+    #   phases     one entry per (class, tier, phase), slowest first
+    #   byPhase, byClass, byTier
+    #              wall time summed over the other keys; byTier covers the
+    #              actors (nodes and markets) only
+    #   hotActors  the /top/ actors that took longest to step, slowest first
+    def report(self, top=10):
+        phases = []
+        byPhase = collections.defaultdict(float)
+        byClass = collections.defaultdict(float)
+        byTier = collections.defaultdict(float)
+        for (className, tier, phase), seconds in self.seconds.iteritems():
+            calls = self.calls[(className, tier, phase)]
+            phases.append({'class': className, 'tier': tier, 'phase': phase, 'seconds': seconds,
+                           'calls': calls, 'meanSeconds': seconds/calls if calls else 0.0})
+            byPhase[phase] += seconds
+            byClass[className] += seconds
+            if className in ('supplyChainNode', 'supplyChainRetailMarket', 'supplyChainCommodityMarket'):
+                byTier[tier] += seconds
+        phases.sort(key=lambda entry: (-entry['seconds'], entry['class'], entry['phase']))
+        hotActors = sorted(self.actorSeconds.iteritems(), key=lambda item: (-item[1], item[0]))[:top]
+        return {'phases': phases,
+                'byPhase': dict(byPhase),
+                'byClass': dict(byClass),
+                'byTier': dict(byTier),
+                'hotActors': [{'label': label, 'seconds': seconds, 'calls': self.actorCalls[label]}
+                              for label, seconds in hotActors]}
+
+    # The report as a printable table.
+    def summary(self, top=10):
+        report = self.report(top)
+        lines = ['%-28s %6s %-20s %10s %9s %12s' % ('class', 'tier', 'phase', 'seconds', 'calls', 'mean (us)')]
+        for entry in report['phases']:
+            lines.append('%-28s %6s %-20s %10.4f %9d %12.2f' % (entry['class'], entry['tier'], entry['phase'],
+                         entry['seconds'], entry['calls'], 1e6*entry['meanSeconds']))
+        lines.append('')
+        lines.append('%-28s %10s %9s' % ('slowest actors', 'seconds', 'steps'))
+        for entry in report['hotActors']:
+            lines.append('%-28s %10.4f %9d' % (entry['label'], entry['seconds'], entry['calls']))
+        return '\n'.join(lines)
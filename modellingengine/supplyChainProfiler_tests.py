@@ -0,0 +1,73 @@
+#!/usr/bin/python
+
+import collections
+from nose.tools import eq_
+from supplyChainBenchmark import tieredSupplyNetwork, SIZES
+import supplyChainModel as scm
+from supplyChainProfiler import supplyChainProfiler
+
+
+# A clock that moves on one second every time it is read, so that every
+# phase timed by profileStep takes exactly one second.
+class tickingClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        self.now += 1.0
+        return self.now
+
+
+ACTOR_CLASSES = (scm.supplyChainNode, scm.supplyChainRetailMarket, scm.supplyChainCommodityMarket)
+
+class TestProfiler:
+    def setUp(self):
+        self.G = tieredSupplyNetwork(seed=3, **SIZES['tiny'])
+        self.phases = dict((actorClass, actorClass.__dict__['timeStepPhases']) for actorClass in ACTOR_CLASSES)
+
+    def tearDown(self):
+        for actorClass, timeStepPhases in self.phases.items():
+            actorClass.timeStepPhases = timeStepPhases
+
+    # Actors of each (class, tier), and the phases of their makeTimeStep.
+    def actorPhases(self):
+        scm.calculateDepth(self.G)
+        scNetwork = scm.supplyChainTemplate.fromGraph(self.G.copy(), 999).instantiate('profiler', 6)
+        actors = collections.Counter()
+        phases = dict()
+        for actor in scNetwork.nodes_iter():
+            key = (actor.__class__.__name__, getattr(actor, 'tier', None))
+            actors[key] += 1
+            phases[key] = [phase for phase, method in actor.timeStepPhases()]
+        return actors, phases
+
+    def test_report(self):
+        timesteps = 5
+        profiler = supplyChainProfiler(clock=tickingClock())
+        scm.runSimulation(self.G.copy(), timesteps, 999, networkName='profiler', profiler=profiler)
+        actors, phases = self.actorPhases()
+        entries = dict(((entry['class'], entry['tier'], entry['phase']), entry) for entry in profiler.report()['phases'])
+        for (className, tier), count in actors.items():
+            eq_(len(phases[(className, tier)]), len(set(phases[(className, tier)])))
+            for phase in phases[(className, tier)]:
+                entry = entries.get((className, tier, phase))
+                assert entry is not None, "no time for %s in tier %r, phase %s" % (className, tier, phase)
+                eq_(entry['calls'], timesteps*count)
+                eq_(entry['seconds'], float(timesteps*count))
+        for phase in ['moveShipments', 'stepActors', 'currentHealth', 'emitRecord']:
+            eq_(entries[('supplyChainNetwork', None, phase)]['calls'], timesteps)
+        for phase in ['setup', 'stepNetwork', 'export']:
+            eq_(entries[('runSimulation', None, phase)]['calls'], 1)
+        eq_(sum(entry['calls'] for entry in profiler.report(top=100)['hotActors']), timesteps*sum(actors.values()))
+
+    def test_off_by_default(self):
+        def unprofiled(actor):
+            raise AssertionError('%r was profiled without a profiler' % (actor,))
+        for actorClass in ACTOR_CLASSES:
+            actorClass.timeStepPhases = unprofiled
+        expectedG, expectedHealth = scm.runSimulation(self.G.copy(), 5, 999, networkName='profiler')
+        for actorClass, timeStepPhases in self.phases.items():
+            actorClass.timeStepPhases = timeStepPhases
+        G, health = scm.runSimulation(self.G.copy(), 5, 999, networkName='profiler',
+                                      profiler=supplyChainProfiler(clock=tickingClock()))
+        eq_(health, expectedHealth)
@@ -0,0 +1,133 @@
+#!/usr/bin/python
+
+'''
+A fast first answer to which retail markets a disruption cuts off.
+
+supplyChainReachability indexes a compiled network (a supplyChainTemplate)
+once, and then says in milliseconds what a set of failed nodes (say, those
+in a freeze footprint) does to supply, without running the simulation:
+
+    index = supplyChainReachability.fromTemplate(template)
+    impact = index.cutOff(['t2.3', 't2.7'])
+    impact['cutOff']        # retail markets left with no supply
+    impact['exposed']       # markets downstream of a failure that can still be supplied
+    impact['lostProducts']  # finished products no market can get any more
+    impact['disabled']      # nodes that have failed or are starved of a component
+    index.criticality()     # markets cut off by each node failing on its own
+
+A node can supply if it has not failed and, for every component its
+recipes take, at least one of its suppliers of that component can supply.
+Raw materials need nothing; a retail market needs any one supplier.
+Components that nobody in the intact network supplies are left out, so
+only the failures make a difference. Stock in hand is ignored: a market
+that is cut off runs dry once its suppliers' stock runs out, which only
+the simulation can time.
+
+Nodes are held in topological order, suppliers first. Reachability is a
+bitset of retail markets per node (Python ints), the union of its
+customers' bitsets. Supply is worked out for many failure scenarios at
+once, with one bit per scenario, so criticality takes one pass however
+many nodes there are.
+'''
+
+import networkx as nx
+
+
+class supplyChainReachability(object):
+    def __init__(self, nodeSpecs, edgeSpecs):
+        G = nx.DiGraph()
+        G.add_nodes_from(nodeData['label'] for nodeData in nodeSpecs)
+        G.add_edges_from((n1, n2) for n1, n2, edata in edgeSpecs)
+        specs = dict((nodeData['label'], nodeData) for nodeData in nodeSpecs)
+        self.labels = nx.topological_sort(G) # Suppliers first.
+        self.position = dict((label, i) for i, label in enumerate(self.labels))
+        self.products = [productName(specs[label].get('product')) for label in self.labels]
+        self.isMarket = [specs[label].get('nodeRole') == 'retail market' for label in self.labels]
+        self.markets = [i for i, isMarket in enumerate(self.isMarket) if isMarket]
+        self.marketBit = dict((i, 1 << bit) for bit, i in enumerate(self.markets))
+        # For each node, the groups of suppliers it needs one of: one group
+        # per component, or a single group of every supplier for a market.
+        self.requirements = []
+        for label in self.labels:
+            suppliers = sorted(self.position[supplier] for supplier in G.predecessors(label))
+            if specs[label].get('nodeRole') == 'retail market':
+                groups = [suppliers] if suppliers else []
+            else:
+                components = set()
+                for recipe in specs[label].get('buildInstructions', dict()).itervalues():
+                    components.update(productName(component) for component in recipe)
+                groups = [[s for s in suppliers if self.products[s] == component] for component in sorted(components)]
+                groups = [group for group in groups if group]
+            self.requirements.append(groups)
+        # Markets downstream of each node (itself included, for a market).
+        self.reach = [0]*len(self.labels)
+        for i in reversed(range(len(self.labels))):
+            bits = self.marketBit.get(i, 0)
+            for customer in G.successors(self.labels[i]):
+                bits |= self.reach[self.position[customer]]
+            self.reach[i] = bits
+
+    def __repr__(self):
+        return "supplyChainReachability(nodes=%r,markets=%r)" % (len(self.labels), len(self.markets))
+
+    @classmethod
+    def fromTemplate(cls, template):
+        return cls(template.nodeSpecs, template.edgeSpecs)
+
+    # For each node, a bitset of the /scenarios/ in which it can supply,
+    # given /failed/: position -> bitset of the scenarios it fails in.
+    def supplied(self, failed, scenarios=1):
+        everything = (1 << scenarios) - 1
+        supplied = [0]*len(self.labels)
+        for i, groups in enumerate(self.requirements):
+            bits = everything & ~failed.get(i, 0)
+            for group in groups:
+                if not bits:
+                    break
+                anySupplier = 0
+                for supplier in group:
+                    anySupplier |= supplied[supplier]
+                bits &= anySupplier
+            supplied[i] = bits
+        return supplied
+
+    # Labels of the retail markets downstream of any of /labels/.
+    def downstreamMarkets(self, labels):
+        bits = 0
+        for label in labels:
+            if label in self.position:
+                bits |= self.reach[self.position[label]]
+        return [self.labels[i] for i in self.markets if bits & self.marketBit[i]]
+
+    # What the failure of the nodes /labels/ does to supply (see the module
+    # docstring). Labels not in the index are ignored.
+    def cutOff(self, labels):
+        failed = dict((self.position[label], 1) for label in labels if label in self.position)
+        supplied = self.supplied(failed)
+        cutOff = [self.labels[i] for i in self.markets if not supplied[i]]
+        stillSupplied = set(self.products[i] for i in self.markets if supplied[i])
+        return {'failed': [self.labels[i] for i in sorted(failed)],
+                'cutOff': cutOff,
+                'exposed': [label for label in self.downstreamMarkets(self.labels[i] for i in failed) if not label in cutOff],
+                'lostProducts': sorted(set(self.products[i] for i in self.markets) - stillSupplied),
+                'disabled': [label for i, label in enumerate(self.labels) if not supplied[i] and not self.isMarket[i]]}
+
+    # Number of retail markets cut off by each node failing on its own,
+    # keyed by label. Every node's failure is a scenario of the same pass.
+    def criticality(self):
+        scenarios = len(self.labels)
+        failed = dict((i, 1 << i) for i in range(scenarios))
+        supplied = self.supplied(failed, scenarios)
+        everything = (1 << scenarios) - 1
+        counts = [0]*scenarios
+        for i in self.markets:
+            unsupplied = everything & ~supplied[i]
+            while unsupplied:
+                lowest = unsupplied & -unsupplied
+                counts[lowest.bit_length() - 1] += 1
+                unsupplied ^= lowest
+        return dict(zip(self.labels, counts))
+
+
+def productName(product):
+    return getattr(product, 'name', product)
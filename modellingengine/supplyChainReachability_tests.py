@@ -0,0 +1,99 @@
+#!/usr/bin/python
+
+from nose.tools import eq_
+from supplyChainReachability import supplyChainReachability
+
+
+# Node and edge specs, in the form compileSupplySpec gives, for a hand-built
+# network. /nodes/ maps labels to (product, recipe components); a recipe of
+# None makes the node a retail market. /edges/ are (supplier, customer).
+def buildIndex(nodes, edges):
+    nodeSpecs = []
+    for label, (product, components) in sorted(nodes.items()):
+        if components is None:
+            nodeSpecs.append({'label': label, 'product': product, 'nodeRole': 'retail market'})
+        else:
+            nodeSpecs.append({'label': label, 'product': product, 'nodeRole': 'supply chain',
+                              'buildInstructions': {product: dict((component, 1) for component in components)}})
+    return supplyChainReachability(nodeSpecs, [(n1, n2, dict()) for n1, n2 in edges])
+
+
+# A market with two suppliers of the same product.
+class TestRedundantSuppliers:
+    def setUp(self):
+        self.index = buildIndex({'m': ('laptop', None), 'a': ('laptop', ()), 'b': ('laptop', ())},
+                                [('a', 'm'), ('b', 'm')])
+
+    def test_one_failure(self):
+        impact = self.index.cutOff(['a'])
+        eq_(impact['failed'], ['a'])
+        eq_(impact['cutOff'], [])
+        eq_(impact['exposed'], ['m'])
+        eq_(impact['lostProducts'], [])
+        eq_(impact['disabled'], ['a'])
+
+    def test_both_fail(self):
+        impact = self.index.cutOff(['a', 'b'])
+        eq_(impact['cutOff'], ['m'])
+        eq_(impact['exposed'], [])
+        eq_(impact['lostProducts'], ['laptop'])
+        eq_(sorted(impact['disabled']), ['a', 'b'])
+
+    def test_unknown_label(self):
+        impact = self.index.cutOff(['nowhere'])
+        eq_(impact['failed'], [])
+        eq_(impact['cutOff'], [])
+
+    def test_criticality(self):
+        eq_(self.index.criticality(), {'m': 1, 'a': 0, 'b': 0})
+
+
+# An assembler with one supplier of screens and two of cases, selling to two
+# markets.
+class TestSingleSupplier:
+    def setUp(self):
+        self.index = buildIndex({'m1': ('laptop', None), 'm2': ('laptop', None),
+                                 'x': ('laptop', ('screen', 'case')),
+                                 's': ('screen', ()), 'c1': ('case', ()), 'c2': ('case', ())},
+                                [('s', 'x'), ('c1', 'x'), ('c2', 'x'), ('x', 'm1'), ('x', 'm2')])
+
+    def test_single_supplier_fails(self):
+        impact = self.index.cutOff(['s'])
+        eq_(impact['cutOff'], ['m1', 'm2'])
+        eq_(impact['exposed'], [])
+        eq_(impact['lostProducts'], ['laptop'])
+        eq_(impact['disabled'], ['s', 'x'])
+
+    def test_redundant_supplier_fails(self):
+        impact = self.index.cutOff(['c1'])
+        eq_(impact['cutOff'], [])
+        eq_(impact['exposed'], ['m1', 'm2'])
+        eq_(impact['disabled'], ['c1'])
+
+    def test_downstream_markets(self):
+        eq_(self.index.downstreamMarkets(['c2']), ['m1', 'm2'])
+        eq_(self.index.downstreamMarkets([]), [])
+
+    def test_criticality(self):
+        eq_(self.index.criticality(), {'m1': 1, 'm2': 1, 'x': 2, 's': 2, 'c1': 0, 'c2': 0})
+
+
+# An assembler that nobody supplies with cases: only the screens it can get
+# make a difference.
+class TestMissingSupplier:
+    def setUp(self):
+        self.index = buildIndex({'m': ('laptop', None), 'x': ('laptop', ('screen', 'case')), 's': ('screen', ())},
+                                [('s', 'x'), ('x', 'm')])
+
+    def test_intact(self):
+        impact = self.index.cutOff([])
+        eq_(impact['cutOff'], [])
+        eq_(impact['disabled'], [])
+
+    def test_supplier_fails(self):
+        impact = self.index.cutOff(['s'])
+        eq_(impact['cutOff'], ['m'])
+        eq_(impact['disabled'], ['s', 'x'])
+
+    def test_criticality(self):
+        eq_(self.index.criticality(), {'m': 1, 'x': 1, 's': 1})
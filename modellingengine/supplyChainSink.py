@@ -0,0 +1,188 @@
+#!/usr/bin/python
+
+'''
+Streaming result sinks for supply chain runs.
+
+A sink is attached with supplyChainNetwork.addSink (or the sinks argument
+of runSimulation). open(labels) is called once with the node labels, in
+the order every later record uses. write(record) is called at the end of
+every timestep. close() is called when the run finishes.
+
+A record is a dict with the timestep 'time' and one array per field in
+FIELDS, each aligned with the labels:
+    inventory   units held, summed over products
+    health      node health
+    salesLost   retail sales lost during the timestep
+    backlog     units ordered by customers and not yet shipped (for a
+                retail market, units ordered and not yet received)
+    backlogAge  timesteps since the oldest unfilled order was made
+'''
+
+import os
+import glob
+import tempfile
+import numpy as np
+
+
+FIELDS = ('inventory', 'health', 'salesLost', 'backlog', 'backlogAge')
+FIELD_TYPES = {'inventory': np.int64, 'health': np.float64, 'salesLost': np.int64,
+               'backlog': np.int64, 'backlogAge': np.int64}
+
+
+# Interface for sinks; the default methods do nothing.
+class supplyChainResultSink(object):
+    def open(self, labels):
+        pass
+
+    def write(self, record):
+        pass
+
+    def close(self):
+        pass
+
+
+# Keeps the most recent /capacity/ timesteps in memory.
+class supplyChainRingBufferSink(supplyChainResultSink):
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.labels = None
+        self.written = 0
+
+    def __repr__(self):
+        return "supplyChainRingBufferSink(capacity=%r,held=%r)" % (self.capacity, len(self))
+
+    def __len__(self):
+        return min(self.written, self.capacity)
+
+    def open(self, labels):
+        self.labels = list(labels)
+        self.written = 0
+        self.time = np.zeros(self.capacity, dtype=np.int64)
+        self.data = dict((field, np.zeros((self.capacity, len(self.labels)), dtype=FIELD_TYPES[field]))
+                         for field in FIELDS)
+
+    def write(self, record):
+        row = self.written % self.capacity
+        self.time[row] = record['time']
+        for field in FIELDS:
+            self.data[field][row] = record[field]
+        self.written += 1
+
+    # The timesteps held, oldest first, as a dict like a record but with a
+    # row per timestep.
+    def window(self):
+        rows = np.arange(self.written - len(self), self.written) % self.capacity
+        window = dict((field, self.data[field][rows]) for field in FIELDS)
+        window['time'] = self.time[rows]
+        return window
+
+    # The most recent record, or None.
+    def latest(self):
+        if not self.written:
+            return None
+        row = (self.written - 1) % self.capacity
+        record = dict((field, self.data[field][row].copy()) for field in FIELDS)
+        record['time'] = int(self.time[row])
+        return record
+
+
+# Writes every /chunkSize/ timesteps to a NumPy .npz file named
+# <prefix>-<chunk number>.npz, holding 'labels', 'time' and a
+# (timesteps x nodes) array per field. Each file appears complete, so a
+# running simulation can be followed with readNpzChunks.
+class supplyChainNpzSink(supplyChainResultSink):
+    def __init__(self, prefix, chunkSize=100, compressed=True):
+        self.prefix = prefix
+        self.chunkSize = chunkSize
+        self.compressed = compressed
+        self.chunks = 0
+        self.buffer = []
+
+    def __repr__(self):
+        return "supplyChainNpzSink(prefix=%r,chunks=%r)" % (self.prefix, self.chunks)
+
+    def open(self, labels):
+        self.labels = np.array(list(labels))
+        self.chunks = 0
+        self.buffer = []
+        directory = os.path.dirname(os.path.abspath(self.prefix))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def write(self, record):
+        self.buffer.append(record)
+        if len(self.buffer) >= self.chunkSize:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        arrays = dict((field, np.array([record[field] for record in self.buffer], dtype=FIELD_TYPES[field]))
+                      for field in FIELDS)
+        arrays['time'] = np.array([record['time'] for record in self.buffer], dtype=np.int64)
+        arrays['labels'] = self.labels
+        filename = '%s-%05d.npz' % (self.prefix, self.chunks)
+        handle, tempName = tempfile.mkstemp(suffix='.npz', dir=os.path.dirname(os.path.abspath(filename)))
+        with os.fdopen(handle, 'wb') as f:
+            if self.compressed:
+                np.savez_compressed(f, **arrays)
+            else:
+                np.savez(f, **arrays)
+        os.rename(tempName, filename)
+        self.chunks += 1
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+
+# Read back the chunks written so far by a supplyChainNpzSink with /prefix/.
+def readNpzChunks(prefix):
+    result = None
+    for filename in sorted(glob.glob('%s-[0-9][0-9][0-9][0-9][0-9].npz' % (prefix))):
+        chunk = np.load(filename)
+        if result is None:
+            result = dict((key, [chunk[key]]) for key in FIELDS + ('time',))
+            result['labels'] = list(chunk['labels'])
+        else:
+            for key in FIELDS + ('time',):
+                result[key].append(chunk[key])
+    if result is None:
+        return None
+    for key in FIELDS + ('time',):
+        result[key] = np.concatenate(result[key])
+    return result
+
+
+# Appends each timestep to a Parquet file as a row group, one row per node
+# and timestep. Needs the optional pyarrow package.
+class supplyChainParquetSink(supplyChainResultSink):
+    def __init__(self, filename):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError('supplyChainParquetSink needs pyarrow; use supplyChainNpzSink without it.')
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.filename = filename
+        self.writer = None
+
+    def __repr__(self):
+        return "supplyChainParquetSink(filename=%r)" % (self.filename)
+
+    def open(self, labels):
+        self.labels = list(labels)
+        columns = [('time', self.pa.int64()), ('label', self.pa.string())]
+        columns += [(field, self.pa.from_numpy_dtype(np.dtype(FIELD_TYPES[field]))) for field in FIELDS]
+        self.schema = self.pa.schema(columns)
+        self.writer = self.pq.ParquetWriter(self.filename, self.schema)
+
+    def write(self, record):
+        arrays = [self.pa.array(np.repeat(record['time'], len(self.labels))), self.pa.array(self.labels)]
+        arrays += [self.pa.array(np.asarray(record[field], dtype=FIELD_TYPES[field])) for field in FIELDS]
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
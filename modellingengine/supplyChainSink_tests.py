@@ -0,0 +1,92 @@
+#!/usr/bin/python
+
+import os
+import glob
+import shutil
+import tempfile
+import numpy as np
+from nose.tools import eq_
+from supplyChainBenchmark import tieredSupplyNetwork, SIZES
+import supplyChainModel as scm
+import supplyChainSink as sks
+
+
+# Keeps a copy of every record it is sent.
+class recordingSink(sks.supplyChainResultSink):
+    def open(self, labels):
+        self.labels = list(labels)
+        self.records = []
+
+    def write(self, record):
+        self.records.append(dict((key, np.array(value, copy=True)) for key, value in record.iteritems()))
+
+
+# Sinks attached to an 11 timestep run, which neither the ring buffer's
+# capacity nor the chunk size divides.
+class TestSinks:
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.prefix = os.path.join(self.directory, 'results', 'run')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run(self, sinks, engine='object', timesteps=11):
+        return scm.runSimulation(tieredSupplyNetwork(**SIZES['tiny']), timesteps, 999, networkName='sinks',
+                                 engine=engine, sinks=sinks)
+
+    def test_ring_buffer_wraps(self):
+        ring = sks.supplyChainRingBufferSink(4)
+        everything = recordingSink()
+        G, health = self.run([ring, everything])
+        eq_(len(ring), 4)
+        window = ring.window()
+        eq_(window['time'].tolist(), [8, 9, 10, 11])
+        for field in sks.FIELDS:
+            eq_(window[field].shape, (4, len(ring.labels)))
+            expected = np.array([record[field] for record in everything.records[-4:]])
+            assert np.array_equal(window[field], expected), "the ring buffer lost %s as it wrapped" % (field)
+        latest = ring.latest()
+        eq_(latest['time'], 11)
+        eq_(latest['health'].tolist(), [G.node[label]['health'] for label in ring.labels])
+
+    def test_ring_buffer_not_full(self):
+        ring = sks.supplyChainRingBufferSink(20)
+        self.run([ring])
+        eq_(len(ring), 11)
+        eq_(ring.window()['time'].tolist(), range(1, 12))
+
+    def test_npz_chunks(self):
+        npz = sks.supplyChainNpzSink(self.prefix, chunkSize=3)
+        everything = recordingSink()
+        self.run([npz, everything])
+        filenames = sorted(glob.glob(self.prefix + '-*.npz'))
+        eq_([os.path.basename(filename) for filename in filenames],
+            ['run-00000.npz', 'run-00001.npz', 'run-00002.npz', 'run-00003.npz'])
+        eq_([len(np.load(filename)['time']) for filename in filenames], [3, 3, 3, 2])
+        eq_(npz.chunks, 4)
+        result = sks.readNpzChunks(self.prefix)
+        eq_(result['labels'], everything.labels)
+        eq_(result['time'].tolist(), range(1, 12))
+        for field in sks.FIELDS:
+            eq_(result[field].dtype, np.dtype(sks.FIELD_TYPES[field]))
+            expected = np.array([record[field] for record in everything.records])
+            assert np.array_equal(result[field], expected), "%s changed across the chunk boundaries" % (field)
+
+    def test_npz_nothing_written(self):
+        eq_(sks.readNpzChunks(self.prefix), None)
+
+    def test_engine_records(self):
+        runs = dict()
+        for engine in scm.ENGINES:
+            sink = recordingSink()
+            self.run([sink], engine)
+            runs[engine] = sink
+        eq_(runs['vector'].labels, runs['object'].labels)
+        for engine, sink in runs.items():
+            eq_([record['time'] for record in sink.records], range(1, 12))
+            for record in sink.records:
+                eq_(sorted(record), sorted(sks.FIELDS + ('time',)))
+                for field in sks.FIELDS:
+                    eq_(record[field].shape, (len(sink.labels),),
+                        "%s engine %s record has shape %r" % (engine, field, record[field].shape))
@@ -0,0 +1,505 @@
+#!/usr/bin/python
+
+'''
+Vectorised engine for the supply chain model.
+
+supplyChainVectorEngine compiles a supplyChainNetwork (as built by
+generic2Supply and giveNodeContext) into flat NumPy arrays and steps the
+whole network at once. Node state lives in (node, product) "slots", orders
+and shipments travel along CSR-ordered supplier links, and recipes are held
+as a sparse component list, so inventory update, unpacking, building,
+shipping and ordering become batched array operations per depth level
+(in the same level order as supplyChainNetwork.orderedNodes).
+
+Retail markets are stepped one at a time. Their demand comes from the same
+pre-drawn noise as in the object engine (see
+supplyChainRetailMarket.seedDemand), so it is identical in both engines.
+
+Differences from the object engine (which is the reference):
+  - Nodes of the same depth that do not trade with each other act
+    simultaneously, rather than one after the other in name order.
+  - When stock is short, customers are filled in full in order of how long
+    their outstanding balance has been positive, rather than order by
+    order from a FIFO order book.
+  - Several shipments arriving on one link in the same timestep are all
+    unpacked (the object engine keeps only the last).
+  - Warehouse overstock is not tracked; it does not feed back into stock.
+
+Tolerance: on tiered laptop networks of 20 to 1000 nodes run for 100
+timesteps, the final network health agrees with the object engine to within
+0.03 and each market's health to within 0.05 (0.07 after 40 timesteps, while
+the markets are still settling). Individual node health and
+inventories can differ much more, as small timing differences propagate
+up the chain, so compare networks and markets rather than single nodes.
+
+After run(), writeBack() copies the final inventory, health, lost sales,
+shipments in transit and (if the network keeps it) shipment history onto
+the network's actors so that exportAsGeneric works unchanged. Without
+shipment history, only the last few timesteps of shipments are held, so
+memory does not grow with the length of the run. The other ledgers are
+not reconstructed, so the network should not be stepped further with the
+object engine.
+
+Result sinks attached to the network are sent a record every timestep, as
+with the object engine. Backlog age there is how long a customer's balance
+has been outstanding, rather than the age of the oldest order.
+'''
+
+import math
+import collections
+import numpy as np
+import supplyChainModel as scm
+from supplyChainSink import FIELD_TYPES as sinkFieldTypes
+
+
+# Round non-negative values half away from zero, as the built in round does.
+def roundHalfUp(values):
+    floor = np.floor(values)
+    return (floor + (values - floor >= 0.5)).astype(np.int64)
+
+
+# A group of actors of the same depth, stepped together.
+class supplyChainVectorLevel(object):
+    def __init__(self, index, depth, markets=None):
+        self.index = index
+        self.depth = depth
+        self.markets = markets # List of market positions, or None for a level of supply chain nodes.
+
+    def __repr__(self):
+        return "supplyChainVectorLevel(index=%r,depth=%r)" % (self.index, self.depth)
+
+
+# Whole-network engine working on arrays rather than node objects.
+class supplyChainVectorEngine(object):
+    def __init__(self, scNetwork):
+        if scNetwork.currentTime != 0:
+            raise ValueError('The vector engine must be compiled from a network that has not been stepped.')
+        self.supplyChain = scNetwork
+        self.simulationLength = scNetwork.simulationLength
+        self.currentTime = 0
+        self.health = scNetwork.health
+        self.compile()
+
+    def __repr__(self):
+        return "supplyChainVectorEngine(supplyChain=%r,currentTime=%r)" % (self.supplyChain, self.currentTime)
+
+    # Build the arrays describing the network.
+    def compile(self):
+        orderedNodes = self.supplyChain.orderedNodes()
+        self.nodes = [node for node in orderedNodes if isinstance(node, scm.supplyChainNode)]
+        self.markets = [node for node in orderedNodes if isinstance(node, scm.supplyChainRetailMarket)]
+        if len(self.nodes) + len(self.markets) != len(orderedNodes):
+            raise ValueError('The vector engine only handles supply chain nodes and retail markets.')
+        marketIndex = dict((market, i) for i, market in enumerate(self.markets))
+
+        # Levels, in stepping order. A depth is split where a node trades with
+        # one already in its level, since the object engine steps them in turn.
+        self.levels = []
+        levelOf = dict()
+        for node in orderedNodes:
+            isMarket = isinstance(node, scm.supplyChainRetailMarket)
+            if (not self.levels or self.levels[-1].depth != node.depth
+                    or any(levelOf.get(neighbour) == len(self.levels) - 1 for neighbour in node.upstream + node.downstream)):
+                self.levels.append(supplyChainVectorLevel(len(self.levels), node.depth, [] if isMarket else None))
+            level = self.levels[-1]
+            if (level.markets is None) == isMarket:
+                raise ValueError('Retail markets must not share a depth with supply chain nodes.')
+            if level.markets is not None:
+                level.markets.append(marketIndex[node])
+            levelOf[node] = level.index
+        self.nodeLevel = np.array([levelOf[node] for node in self.nodes], dtype=np.int64)
+
+        # (node, product) slots.
+        slotIndex = dict()
+        slotNode, slotProduct, target, minOrder, inventory, isComplex = [], [], [], [], [], []
+        for i, node in enumerate(self.nodes):
+            for product in node.products:
+                slotIndex[(node, product)] = len(slotNode)
+                slotNode.append(i)
+                slotProduct.append(product)
+                target.append(node.targetInventory[product])
+                minOrder.append(node.minOrder[product])
+                inventory.append(node.inventory.get(node.currentTime, product))
+                isComplex.append(product in node.buildInstructions)
+        self.slotProduct = slotProduct
+        self.slotNode = np.array(slotNode, dtype=np.int64)
+        self.target = np.array(target, dtype=np.float64)
+        self.minOrder = np.array(minOrder, dtype=np.float64)
+        self.inventory = np.array(inventory, dtype=np.int64)
+        self.isComplex = np.array(isComplex, dtype=bool)
+        self.nodeProducts = np.bincount(self.slotNode, minlength=len(self.nodes))
+
+        # Supplier links (supplier, customer, product), grouped by supplier slot
+        # in the supplier's upstream order. Link i is also transport column i.
+        supplierSlot, customerSlot, columnOrigin, columnTarget, columnProduct = [], [], [], [], []
+        for node in self.nodes:
+            for product in node.products:
+                for customer in node.upstream:
+                    if isinstance(customer, scm.supplyChainNode) and product in customer.products:
+                        supplierSlot.append(slotIndex[(node, product)])
+                        customerSlot.append(slotIndex[(customer, product)])
+                        columnOrigin.append(node)
+                        columnTarget.append(customer)
+                        columnProduct.append(product)
+        self.numLinks = len(supplierSlot)
+        self.supplierSlot = np.array(supplierSlot, dtype=np.int64)
+        self.customerSlot = np.array(customerSlot, dtype=np.int64)
+        self.suppliers = np.bincount(self.customerSlot, minlength=len(slotNode))[self.customerSlot]
+
+        # Sale links (node -> market) follow, as transport columns numLinks onwards.
+        self.marketColumns = []
+        saleSlot = []
+        for market in self.markets:
+            columns = []
+            for node in market.downstream:
+                columns.append(self.numLinks + len(saleSlot))
+                saleSlot.append(slotIndex[(node, market.product)])
+                columnOrigin.append(node)
+                columnTarget.append(market)
+                columnProduct.append(market.product)
+            self.marketColumns.append(np.array(columns, dtype=np.int64))
+        self.saleSlot = np.array(saleSlot, dtype=np.int64)
+        self.marketShare = np.array([self.markets[m].marketShare[self.markets[m].currentTime].get((node, self.markets[m].product), 0)
+            for m in range(len(self.markets)) for node in self.markets[m].downstream], dtype=np.float64)
+
+        # Transport columns.
+        self.columnOrigin = columnOrigin
+        self.columnTarget = columnTarget
+        self.columnProduct = columnProduct
+        self.delay = np.array([max(int(math.ceil(self.supplyChain[u][v].get('timeToTraverse',0))), 0)
+            for u, v in zip(columnOrigin, columnTarget)], dtype=np.int64)
+        self.targetLevel = np.array([levelOf[v] for v in columnTarget], dtype=np.int64)
+        self.calendarLength = (int(self.delay.max()) if len(self.delay) else 0) + 2
+        self.calendar = np.zeros((self.calendarLength, len(columnOrigin)), dtype=np.int64)
+
+        # Recipes, as a sparse list of (output slot, component slot, quantity) entries.
+        recipeOutput, recipeCapacity, recipeRank, recipeBuilds = [], [], [], []
+        entryRecipe, entryOutput, entryComponent, entryQuantity = [], [], [], []
+        for node in self.nodes:
+            recipes = node.recipes
+            for rank, product in enumerate(recipes.outputs):
+                r = len(recipeOutput)
+                recipeOutput.append(slotIndex[(node, product)])
+                recipeCapacity.append(node.processingCapacity[product])
+                recipeRank.append(rank)
+                recipeBuilds.append(rank in recipes.buildRows)
+                for k in range(recipes.rowStart[rank], recipes.rowStart[rank+1]):
+                    entryRecipe.append(r)
+                    entryOutput.append(slotIndex[(node, product)])
+                    entryComponent.append(slotIndex[(node, recipes.products[recipes.columns[k]])])
+                    entryQuantity.append(recipes.quantities[k])
+        self.recipeOutput = np.array(recipeOutput, dtype=np.int64)
+        self.recipeCapacity = np.array(recipeCapacity, dtype=np.int64)
+        self.entryRecipe = np.array(entryRecipe, dtype=np.int64)
+        self.entryOutput = np.array(entryOutput, dtype=np.int64)
+        self.entryComponent = np.array(entryComponent, dtype=np.int64)
+        self.entryQuantity = np.array(entryQuantity, dtype=np.int64)
+
+        # Per-level index arrays.
+        recipeNode = self.slotNode[self.recipeOutput] if len(recipeOutput) else np.zeros(0, dtype=np.int64)
+        recipeRank = np.array(recipeRank, dtype=np.int64)
+        recipeBuilds = np.array(recipeBuilds, dtype=bool)
+        entryNode = self.slotNode[self.entryComponent] if len(entryComponent) else np.zeros(0, dtype=np.int64)
+        for level in self.levels:
+            if level.markets is not None:
+                continue
+            inLevel = self.nodeLevel == level.index
+            slots = np.flatnonzero(inLevel[self.slotNode])
+            level.slots = slots
+            level.customerLinks = np.flatnonzero(inLevel[self.slotNode[self.customerSlot]])
+            level.supplierLinks = np.flatnonzero(inLevel[self.slotNode[self.supplierSlot]])
+            level.buildRanks = []
+            levelRecipes = np.flatnonzero(inLevel[recipeNode] & recipeBuilds)
+            for rank in np.unique(recipeRank[levelRecipes]):
+                recipes = levelRecipes[recipeRank[levelRecipes] == rank]
+                entries = np.flatnonzero(np.in1d(self.entryRecipe, recipes))
+                # Position of each entry's recipe in /recipes/, for the per-recipe minimum.
+                level.buildRanks.append((recipes, entries, np.searchsorted(recipes, self.entryRecipe[entries])))
+            level.orderPhases = []
+            # Complex products are ordered first, as in makeAllOrders.
+            for complexPhase in (True, False):
+                phaseSlots = slots[self.isComplex[slots] == complexPhase]
+                entries = np.flatnonzero(inLevel[entryNode] & np.in1d(self.entryComponent, phaseSlots))
+                links = level.customerLinks[np.in1d(self.customerSlot[level.customerLinks], phaseSlots)]
+                level.orderPhases.append((phaseSlots,
+                                          entries, np.searchsorted(phaseSlots, self.entryComponent[entries]),
+                                          links, np.searchsorted(phaseSlots, self.customerSlot[links])))
+
+        # Dynamic state.
+        self.outstanding = np.zeros(self.numLinks, dtype=np.int64) # Ordered by the customer, not yet shipped.
+        self.outstandingSince = np.zeros(self.numLinks, dtype=np.int64) # When outstanding last became positive.
+        self.incoming = np.zeros(self.numLinks, dtype=np.int64) # Ordered by the customer, not yet received.
+        self.received = np.zeros(self.numLinks, dtype=np.int64) # Received at the customer's last timestep.
+        self.upstreamOutstanding = np.zeros(len(slotNode), dtype=np.int64)
+        self.downstreamOutstanding = np.zeros(len(slotNode), dtype=np.int64)
+        self.salesLost = np.zeros(len(self.nodes), dtype=np.int64)
+        self.marketOrdered = np.zeros(len(self.markets), dtype=np.int64)
+        self.marketReceived = np.zeros(len(self.markets), dtype=np.int64)
+        self.nodeHealth = np.ones(len(self.nodes))
+        self.marketHealth = np.ones(len(self.markets))
+        self.shipments = collections.deque() # Chunks of (columns, timeWhenShipped, timePlaced, level, quantities).
+        self.keepHistory = self.supplyChain.transport.history is not None # Keep every chunk, for the delivered history.
+
+    # Put /quantities/ on the transport /columns/. Without shipment history,
+    # chunks placed long enough ago to have been delivered are dropped.
+    def ship(self, columns, quantities, timeWhenShipped, level):
+        t = self.currentTime
+        self.calendar[(t + self.delay[columns]) % self.calendarLength, columns] += quantities
+        self.shipments.append((columns, timeWhenShipped, t, level.index, quantities))
+        if not self.keepHistory:
+            while self.shipments[0][2] < t - self.calendarLength:
+                self.shipments.popleft()
+
+    # Take delivery of everything due on /columns/.
+    def deliver(self, columns):
+        t = self.currentTime
+        rows = [(t - 1) % self.calendarLength, t % self.calendarLength]
+        arrived = self.calendar[rows[0], columns] + self.calendar[rows[1], columns]
+        self.calendar[rows[0], columns] = 0
+        self.calendar[rows[1], columns] = 0
+        return arrived
+
+    # Ship on supplier links, reducing the supplier's outstanding orders.
+    def shipOnLinks(self, links, quantities, level):
+        self.outstanding[links] -= quantities
+        np.add.at(self.upstreamOutstanding, self.supplierSlot[links], -quantities)
+        np.add.at(self.inventory, self.supplierSlot[links], -quantities)
+        self.ship(links, quantities, self.currentTime, level)
+
+    def makeMarketStep(self, level):
+        t = self.currentTime
+        for m in level.markets:
+            market = self.markets[m]
+            market.currentTime = t
+            columns = self.marketColumns[m]
+            self.marketReceived[m] += self.deliver(columns).sum()
+            market.marketDemand[t] = market.getMarketDemand(market.marketDemand[t-1])
+            if len(columns) == 0:
+                continue
+            shares = self.marketShare[columns - self.numLinks]
+            totalReputation = shares.sum()
+            # Each supplier's own share is read back through noneToZero, so
+            # truncated to a whole number, as in the object engine.
+            shares = np.trunc(shares)
+            if totalReputation == 0:
+                nodeShare = np.repeat(1.0/float(len(columns)), len(columns))
+            else:
+                nodeShare = shares/float(totalReputation)
+            quantity = roundHalfUp(nodeShare*market.marketDemand[t])
+            slots = self.saleSlot[columns - self.numLinks]
+            valid = quantity > self.minOrder[slots]
+            columns, slots, quantity = columns[valid], slots[valid], quantity[valid]
+            self.marketOrdered[m] += quantity.sum()
+            # Sell what stock allows; the rest is lost.
+            available = self.inventory[slots]
+            sold = np.minimum(available, quantity)
+            self.inventory[slots] -= sold
+            np.add.at(self.salesLost, self.slotNode[slots], quantity - sold)
+            proportionFilled = np.where(available >= quantity, 1.0, available/np.maximum(quantity, 1).astype(np.float64))
+            shares = shares*0.9
+            shares[valid] += proportionFilled
+            self.marketShare[self.marketColumns[m] - self.numLinks] = shares
+            # Nodes that have not yet stepped still show the previous timestep.
+            self.ship(columns, sold, np.where(self.nodeLevel[self.slotNode[slots]] < level.index, t, t-1), level)
+
+    def makeNodeStep(self, level):
+        t = self.currentTime
+        inventory = self.inventory
+        # Unpack yesterday's deliveries.
+        links = level.customerLinks
+        np.add.at(inventory, self.customerSlot[links], self.received[links])
+        # Build products.
+        for recipes, entries, position in level.buildRanks:
+            componentMax = inventory[self.entryComponent[entries]]//self.entryQuantity[entries]
+            limit = np.repeat(np.iinfo(np.int64).max, len(recipes))
+            np.minimum.at(limit, position, componentMax)
+            built = np.minimum(self.recipeCapacity[recipes], limit)
+            inventory[self.recipeOutput[recipes]] += built
+            np.add.at(inventory, self.entryComponent[entries], -built[position]*self.entryQuantity[entries])
+        # Check for shipments.
+        arrived = self.deliver(links)
+        self.incoming[links] -= arrived
+        np.add.at(self.downstreamOutstanding, self.customerSlot[links], -arrived)
+        self.received[links] = arrived
+        self.makeShipments(level)
+        for phase in level.orderPhases:
+            self.makeOrders(level, *phase)
+
+    # Fill outstanding orders for the level's products.
+    def makeShipments(self, level):
+        slots = level.slots
+        totalOutstanding = self.upstreamOutstanding[slots]
+        stock = self.inventory[slots]
+        active = (totalOutstanding != 0) & (stock != 0)
+        links = level.supplierLinks
+        linkSlots = self.supplierSlot[links]
+        waiting = links[self.outstanding[links] > 0]
+        waitingSlots = self.supplierSlot[waiting]
+        # Enough stock: everyone is shipped what they are owed.
+        enough = np.zeros(len(self.inventory), dtype=bool)
+        enough[slots[active & (stock >= totalOutstanding)]] = True
+        full = waiting[enough[waitingSlots]]
+        if len(full):
+            owed = np.bincount(self.supplierSlot[full], weights=self.outstanding[full], minlength=len(self.inventory))
+            overdrawn = owed[self.supplierSlot[full]] > self.inventory[self.supplierSlot[full]]
+            if overdrawn.any():
+                # Outstanding balances can be negative elsewhere, so go one at a time.
+                for link in full[overdrawn]:
+                    slot = self.supplierSlot[link]
+                    if self.outstanding[link] <= self.inventory[slot]:
+                        self.shipOnLinks(np.array([link]), np.array([self.outstanding[link]]), level)
+                full = full[~overdrawn]
+            self.shipOnLinks(full, self.outstanding[full], level)
+        # Not enough stock: fill the customers waiting longest first.
+        short = np.zeros(len(self.inventory), dtype=bool)
+        short[slots[active & (stock < totalOutstanding)]] = True
+        candidates = waiting[short[waitingSlots]]
+        if len(candidates):
+            # As in the order book, smaller balances go first among equals.
+            order = np.lexsort((candidates, self.outstanding[candidates], self.outstandingSince[candidates], self.supplierSlot[candidates]))
+            candidates = candidates[order]
+            candidateSlots = self.supplierSlot[candidates]
+            owed = self.outstanding[candidates]
+            # Stock already promised to older customers of the same supplier slot.
+            owedBefore = np.cumsum(owed) - owed
+            first = np.ones(len(candidates), dtype=bool)
+            first[1:] = candidateSlots[1:] != candidateSlots[:-1]
+            groupStart = np.maximum.accumulate(np.where(first, np.arange(len(candidates)), 0))
+            owedBefore -= owedBefore[groupStart]
+            quantity = np.clip(self.inventory[candidateSlots] - owedBefore, 0, owed)
+            filled = quantity > 0
+            self.shipOnLinks(candidates[filled], quantity[filled], level)
+
+    # Order to cover the deficit of /phaseSlots/, split equally between suppliers.
+    def makeOrders(self, level, phaseSlots, entries, entryPosition, links, linkPosition):
+        inventory = self.inventory
+        deficit = self.upstreamOutstanding[phaseSlots] - inventory[phaseSlots] - self.downstreamOutstanding[phaseSlots]
+        if len(entries):
+            outputs = self.entryOutput[entries]
+            complexDeficit = self.upstreamOutstanding[outputs] - inventory[outputs] - self.downstreamOutstanding[outputs]
+            np.add.at(deficit, entryPosition, np.maximum(complexDeficit, 0)*self.entryQuantity[entries])
+        deficit = np.maximum(deficit + self.target[phaseSlots], 0)
+        quantity = roundHalfUp((1.0/self.suppliers[links])*deficit[linkPosition])
+        valid = (deficit[linkPosition] > 0) & (quantity > self.minOrder[self.supplierSlot[links]])
+        links, quantity = links[valid], quantity[valid]
+        starting = links[(self.outstanding[links] <= 0) & (self.outstanding[links] + quantity > 0)]
+        # Orders are dated by the supplier's clock, which is a step behind if
+        # the supplier has yet to step.
+        self.outstandingSince[starting] = self.currentTime - (self.nodeLevel[self.slotNode[self.supplierSlot[starting]]] > level.index)
+        self.outstanding[links] += quantity
+        np.add.at(self.upstreamOutstanding, self.supplierSlot[links], quantity)
+        self.incoming[links] += quantity
+        np.add.at(self.downstreamOutstanding, self.customerSlot[links], quantity)
+
+    def calculateHealth(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            stockScore = np.maximum(1 - np.abs(self.inventory - self.target)/self.target, 0)
+            self.nodeHealth = np.sqrt(np.bincount(self.slotNode, weights=stockScore**2, minlength=len(self.nodes))/self.nodeProducts)
+        self.marketHealth = np.where(self.marketOrdered == 0, 1.0, self.marketReceived/np.maximum(self.marketOrdered, 1).astype(np.float64))
+        allHealth = np.concatenate((self.nodeHealth, self.marketHealth))
+        # Recorded in the network's health history, in its actor order.
+        if not hasattr(self, 'healthPosition'):
+            self.supplyChain.checkHealthIndex()
+            position = dict((node, i) for i, node in enumerate(self.nodes + self.markets))
+            self.healthPosition = np.array([position[node] for node in self.supplyChain.healthNodes], dtype=np.int64)
+        self.supplyChain.currentTime = self.currentTime
+        self.health = self.supplyChain.recordHealth(allHealth[self.healthPosition])
+        return self.health
+
+    def makeTimeStep(self):
+        profiler = self.supplyChain.profiler
+        if profiler is not None:
+            # Levels are timed under their depth, in place of a tier.
+            self.currentTime += 1
+            for level in self.levels:
+                start = profiler.clock()
+                self.stepLevel(level)
+                phase = 'makeNodeStep' if level.markets is None else 'makeMarketStep'
+                profiler.record(self.__class__.__name__, level.depth, phase, profiler.clock() - start)
+            profiler.profileStep(self, [('calculateHealth', self.calculateHealth), ('emitRecord', self.emitRecord)], hot=False)
+            return
+        self.currentTime += 1
+        for level in self.levels:
+            self.stepLevel(level)
+        self.calculateHealth()
+        self.emitRecord()
+
+    def stepLevel(self, level):
+        if level.markets is None:
+            self.makeNodeStep(level)
+        else:
+            self.makeMarketStep(level)
+
+    def emitRecord(self):
+        if self.supplyChain.sinks:
+            self.supplyChain.emitRecord(self.tickRecord())
+
+    # Record of the current timestep for the network's result sinks, in the
+    # same form and actor order as supplyChainNetwork.tickRecord.
+    def tickRecord(self):
+        t = self.currentTime
+        if not hasattr(self, 'sinkPosition'):
+            position = dict((node, i) for i, node in enumerate(self.nodes + self.markets))
+            self.sinkPosition = np.array([position[node] for node in self.supplyChain.sinkNodes], dtype=np.int64)
+            self.lastSalesLost = np.zeros(len(self.nodes), dtype=np.int64)
+        numNodes = len(self.nodes)
+        waiting = self.outstanding > 0
+        age = np.zeros(numNodes, dtype=np.int64)
+        np.maximum.at(age, self.slotNode[self.supplierSlot[waiting]], t - self.outstandingSince[waiting])
+        columns = {
+            'inventory': (np.bincount(self.slotNode, weights=self.inventory, minlength=numNodes), 0),
+            'health': (self.nodeHealth, self.marketHealth),
+            'salesLost': (self.salesLost - self.lastSalesLost, 0),
+            'backlog': (np.bincount(self.slotNode, weights=np.maximum(self.upstreamOutstanding, 0), minlength=numNodes),
+                        self.marketOrdered - self.marketReceived),
+            'backlogAge': (age, 0)}
+        self.lastSalesLost = self.salesLost.copy()
+        record = {'time': t}
+        for field, (nodeValues, marketValues) in columns.items():
+            values = np.concatenate((nodeValues, np.broadcast_to(marketValues, (len(self.markets),))))
+            record[field] = values[self.sinkPosition].astype(sinkFieldTypes[field])
+        return record
+
+    def run(self, timesteps):
+        for i in range(timesteps):
+            self.makeTimeStep()
+        self.writeBack()
+        return self.health
+
+    # Copy the results back onto the network's actors, for exportAsGeneric.
+    def writeBack(self):
+        t = self.currentTime
+        scNetwork = self.supplyChain
+        for slot, product in enumerate(self.slotProduct):
+            self.nodes[self.slotNode[slot]].inventory.set(t, product, self.inventory[slot])
+        for i, node in enumerate(self.nodes):
+            node.currentTime = t
+            node.health = float(self.nodeHealth[i])
+            if self.salesLost[i] or node.salesLost.has(self.simulationLength, ('allNodes','allProducts')):
+                node.salesLost.set(self.simulationLength, ('allNodes','allProducts'), self.salesLost[i])
+        for m, market in enumerate(self.markets):
+            market.currentTime = t
+            market.health = float(self.marketHealth[m])
+            for column in self.marketColumns[m]:
+                market.marketShare[t][(self.columnOrigin[column], market.product)] = float(self.marketShare[column - self.numLinks])
+        scNetwork.currentTime = t
+        scNetwork.health = self.health
+        transport = scNetwork.transport
+        for columns, timeWhenShipped, timePlaced, levelIndex, quantities in self.shipments:
+            arrival = timePlaced + self.delay[columns]
+            # A target that has already stepped this timestep collects the shipment next time.
+            arrival += (self.delay[columns] == 0) & (self.targetLevel[columns] <= levelIndex)
+            timesWhenShipped = np.broadcast_to(timeWhenShipped, columns.shape)
+            if not self.keepHistory:
+                inTransit = arrival > t
+                if not inTransit.any():
+                    continue
+                columns, timesWhenShipped, quantities, arrival = columns[inTransit], timesWhenShipped[inTransit], quantities[inTransit], arrival[inTransit]
+            for column, shipTime, quantity, arrivalTime in zip(columns, timesWhenShipped, quantities, arrival):
+                origin, target = self.columnOrigin[column], self.columnTarget[column]
+                if arrivalTime <= t:
+                    transport.recordDelivered(origin, target, int(quantity), self.columnProduct[column], int(shipTime),
+                        timePlaced, int(arrivalTime), int(arrivalTime))
+                else:
+                    transport.place(origin, target, int(quantity), self.columnProduct[column], int(shipTime),
+                        timePlaced, int(arrivalTime))
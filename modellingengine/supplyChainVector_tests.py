@@ -0,0 +1,70 @@
+#!/usr/bin/python
+
+from nose.tools import eq_
+from supplyChainBenchmark import tieredSupplyNetwork, SIZES
+import supplyChainModel as scm
+from supplyChainVector import supplyChainVectorEngine
+
+
+# The vector engine against the object engine, to the tolerance given in
+# supplyChainVector: network health within 0.03, market health within 0.05
+# after 100 timesteps and within 0.07 after 40.
+class TestVectorParity:
+    def setUp(self):
+        self.G = tieredSupplyNetwork(seed=3)
+        self.markets = [label for label, data in self.G.nodes_iter(data=True) if data['tier'] == -1]
+
+    def run(self, G, engine, timesteps):
+        G, health = scm.runSimulation(G.copy(), timesteps, 999, networkName='vectorParity', engine=engine)
+        return health, dict((label, G.node[label]['health']) for label in self.markets)
+
+    def check(self, G, timesteps, marketTolerance):
+        objectHealth, objectMarkets = self.run(G, 'object', timesteps)
+        vectorHealth, vectorMarkets = self.run(G, 'vector', timesteps)
+        assert abs(objectHealth - vectorHealth) <= 0.03, \
+            "network health %r (object) and %r (vector) differ by more than 0.03 after %r steps" % (objectHealth, vectorHealth, timesteps)
+        for label in self.markets:
+            assert abs(objectMarkets[label] - vectorMarkets[label]) <= marketTolerance, \
+                "market %s health %r (object) and %r (vector) differ by more than %r after %r steps" % (
+                    label, objectMarkets[label], vectorMarkets[label], marketTolerance, timesteps)
+
+    def test_parity_40(self):
+        self.check(self.G, 40, 0.07)
+
+    def test_parity_100(self):
+        self.check(self.G, 100, 0.05)
+
+    def test_parity_tiny(self):
+        G = tieredSupplyNetwork(seed=3, **SIZES['tiny'])
+        self.markets = [label for label, data in G.nodes_iter(data=True) if data['tier'] == -1]
+        self.check(G, 100, 0.05)
+
+
+# Without shipment history the engine holds only the shipments that may
+# still be in transit, and writes back just those.
+class TestVectorShipments:
+    def setUp(self):
+        G = tieredSupplyNetwork(seed=3, **SIZES['tiny'])
+        scm.calculateDepth(G)
+        self.template = scm.supplyChainTemplate.fromGraph(G, 999)
+
+    def run(self, timesteps, **kwargs):
+        scNetwork = self.template.instantiate('vectorShipments', timesteps + 1, **kwargs)
+        engine = supplyChainVectorEngine(scNetwork)
+        engine.run(timesteps)
+        return scNetwork, engine
+
+    def test_bounded(self):
+        scNetwork, engine = self.run(60)
+        assert all(timePlaced >= engine.currentTime - engine.calendarLength
+                   for __, __, timePlaced, __, __ in engine.shipments), "delivered shipments were kept"
+        assert scNetwork.transport.history is None
+
+    def test_same_in_transit(self):
+        scNetwork, __ = self.run(30)
+        withHistory, __ = self.run(30, shipmentHistory=True)
+        assert len(withHistory.transport.history.liveRows()) > 0, "no delivered shipments were written back"
+        inTransit = lambda network: sorted((origin.name, target.name, timeWhenShipped)
+                                           for origin, target, timeWhenShipped in network.transport.liveKeys)
+        eq_(inTransit(scNetwork), inTransit(withHistory))
+        eq_(scNetwork.health, withHistory.health)
@@ -2,12 +2,40 @@ __author__ = 'Simon Ruffle'
 
 from modellingbase import ModellingBase
 import supplyChainModel as scm
+from supplyChainReachability import supplyChainReachability
+from django.conf import settings
+
+# compiled supply chain networks are cached between page views in the directory the site's settings give,
+# if any (it must be private to the web server's user, see supplyChainModel.cachedTemplate)
+def templateCacheDir():
+    return getattr(settings, 'SUPPLYCHAIN_CACHE_DIR', None) or None
+
+# the network compiled from layer graph G, from the cache if there is one we can use
+# a cache directory that is not the web server's own is passed over rather than failing the page
+def compileTemplate(G):
+    scm.calculateDepth(G)
+    cacheDir = templateCacheDir()
+    if cacheDir is not None:
+        try:
+            return scm.cachedTemplate(G, 999, cacheDir)
+        except scm.supplyChainCacheError:
+            pass
+    return scm.supplyChainTemplate.fromGraph(G, 999)
+
+# the footprint intensity the scenario gave a node, which the footprint stores as a string (0 if there is none)
+def footprintIntensity(attributes):
+    try:
+        return float(attributes.get('intensity', 0))
+    except (TypeError, ValueError):
+        return 0.0
 
 class SupplyChain(ModellingBase):
     def __init__(self, scenario=None):
         ModellingBase.__init__(self, scenario)
         self.typeident = 'MSCH'     # an identifier for the type of model
         self.version = '0.1'        # version of model
+        self.impact = None          # the first answer from get_impact, if asked for
+        self.prepared = None        # (layer graph, iteration, footprint nodes, template) left by get_impact for run_model
 
     def get_run(self, runid):
 
@@ -16,14 +44,25 @@ class SupplyChain(ModellingBase):
     def run_model(self, network, activelayerid=0, iteration=0, delete_nodes=False):
 
         self.n = network
+        template = None
 
         # set up scenario, applying to active layer in network
         # if the scenario is freeze this will apply the freeze footprint
-        if self.s is not None:
+        # if get_impact has already applied it, the network it compiled is run as it is, or
+        # with delete_nodes, the footprint nodes it found are deleted without asking the footprint again
+        if self.prepared is not None and self.prepared[0] is self.n.layergraphs[activelayerid] and self.prepared[1] == iteration:
+            footprintnodes, template = self.prepared[2:]
+            if delete_nodes:
+                self.n.layergraphs[activelayerid].remove_nodes_from(footprintnodes)
+                template = None
+        elif self.s is not None:
             self.s.pre_model(self.n, activelayerid, iteration, delete_nodes)
+        self.prepared = None
 
         # modelling code here
-        self.n.layergraphs[activelayerid], health = scm.runSimulation(self.n.layergraphs[activelayerid], 10, 999)
+        if template is None:
+            template = compileTemplate(self.n.layergraphs[activelayerid])
+        self.n.layergraphs[activelayerid], health = scm.runSimulation(self.n.layergraphs[activelayerid], 10, 999, template=template)
 
         # run any clean up operation by the scenario after the modelling is complete
         if self.s is not None:
@@ -31,6 +70,28 @@ class SupplyChain(ModellingBase):
 
         return True
 
+    def get_impact(self, network, activelayerid=0, iteration=0):
+        # quick first answer to which retail markets the scenario cuts off, without stepping the model
+        # the site has no background runner, so the page shows it in the popups alongside run_model's results
+        # the scenario flags the nodes in its footprint with an intensity, and the reachability index of the
+        # compiled network says what losing those nodes does to supply (see supplyChainReachability)
+
+        # the scenario is applied to the layer here, once, and run_model goes on to run the compiled network
+        self.n = network
+        if self.s is not None:
+            self.s.pre_model(self.n, activelayerid, iteration, False)
+        G = self.n.layergraphs[activelayerid]
+        additional_attributes = self.s.additional_attributes if self.s is not None else []
+        footprintnodes = [guid for guid, attributes in G.nodes_iter(data=True)
+                          if any(attribute in attributes for attribute in additional_attributes)]
+
+        template = compileTemplate(G)
+        self.prepared = (G, iteration, footprintnodes, template)
+        index = supplyChainReachability.fromTemplate(template)
+        failed = [guid for guid, attributes in G.nodes_iter(data=True) if footprintIntensity(attributes) > 0]
+        self.impact = index.cutOff(failed)
+        return self.impact
+
     def get_results(self, cleanjson=True, activelayerid=0, iteration=0):
 
         # pass the tier attribute as the node style and set up the popup
@@ -49,6 +110,10 @@ class SupplyChain(ModellingBase):
                 attributes['intensity'] = 0
             attributes['popup'] += '<div class="e">Footprint intensity: ' + unicode(attributes['intensity']) + '</div>'
 
+            # flag the markets that get_impact found to be cut off
+            if self.impact is not None and guid in self.impact['cutOff']:
+                attributes['popup'] += '<div class="e">Supply cut off by the footprint</div>'
+
             #except:
             #    pass
 
@@ -51,6 +51,10 @@ USE_TZ = False
 # Example: "/home/media/media.lawrence.com/media/"
 MEDIA_ROOT = ''
 
+# Directory where compiled supply chain networks are cached between page views.
+# Leave empty to compile them afresh each time.
+SUPPLYCHAIN_CACHE_DIR = ''
+
 # URL that handles the media served from MEDIA_ROOT. Make sure to use a
 # trailing slash.
 # Examples: "http://media.lawrence.com/media/", "http://example.com/media/"
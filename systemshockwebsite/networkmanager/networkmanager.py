@@ -121,6 +121,9 @@ class NetworkManagerPage (Pagebase):
             if self.page_context['ix'] == '6':
                 # run Ben's supply chain model
                 supplychainmodel = SupplyChain(freezescenario)
+                # which markets the footprint cuts off, shown in the popups with the model's results
+                # (the view runs the model in the same request, so there is no earlier page to show it on)
+                supplychainmodel.get_impact(n, 0, 0)
                 supplychainmodel.run_model(n, 0, 0, shock)
                 #n.exportGexf('c:\\inetpub\\wwwroot\\networksessions\\pomegranite2.gexf')
                 supplychainmodel.get_results()
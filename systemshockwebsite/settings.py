@@ -67,6 +67,11 @@ MEDIA_ROOT = os.path.join(os.path.dirname(__file__),'mediastore').replace('\\','
 # my own enhancement where files that can be downloaded securely are sourced form the following alternative to MEDIA_ROOT
 SECURE_MEDIA_ROOT = os.path.join(os.path.dirname(__file__),'securemediastore').replace('\\','/')
 
+# directory where compiled supply chain networks are cached between page views (see modellingengine/supplychain.py)
+# leave empty to compile them afresh each time. Set it outside the checkout; it is created readable by the web
+# server's user only, and is not used if it belongs to anyone else or anyone else can write to it
+SUPPLYCHAIN_CACHE_DIR = ''
+
 # URL that handles the media served from MEDIA_ROOT. Make sure to use a
 # trailing slash.
 # Examples: "http://media.lawrence.com/media/", "http://example.com/media/"